@@ -0,0 +1,229 @@
+import itertools
+import argparse
+import joblib
+import numba as nb
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+from exercise_core import tqdm_joblib, concat_timebar_files, target_symbols
+
+# パラメータの格子を分割するときの、ワーカー1つあたりのタスク数の目安 (タスクの処理時間のばらつきをならすために少し多めに分ける)
+atr_grid_tasks_per_worker = 4
+
+# richman_exercise.ipynbのATRくんのポジションとトレードごとの対数リターンを求める関数 (ノートブックと同じ処理)
+@nb.njit(cache = True)
+def calc_position_return(buy_limit_hit, sell_limit_hit, buy_limit, sell_limit, close, force_exit_steps):
+    position = np.empty(buy_limit_hit.shape, dtype=float)
+    position[:] = 0.0
+
+    ret = np.empty(buy_limit_hit.shape, dtype=float)
+    ret[:] = 0.0
+
+    _pos = 0.0
+    _entry_price = np.nan
+    _entry_step = np.nan
+
+    for i in range(position.size):
+        _prev_pos = _pos
+
+        if _prev_pos > 0:
+            if sell_limit_hit[i] == True:
+                # 利確 (手数料は後で計算する)
+                _pos = 0.0
+                _ret = np.log(sell_limit[i]) - np.log(_entry_price)
+            elif force_exit_steps > 0 and i - _entry_step >= force_exit_steps:
+                # 強制イグジット
+                _pos = 0.0
+                _ret = np.log(close[i]) - np.log(_entry_price)
+            else:
+                # ポジションをそのまま維持
+                _pos = _prev_pos
+                _ret = 0.0
+        elif _prev_pos < 0:
+            if buy_limit_hit[i] == True:
+                # 利確 (手数料は後で計算する)
+                _pos = 0.0
+                _ret = -(np.log(buy_limit[i]) - np.log(_entry_price))
+            elif force_exit_steps > 0 and i - _entry_step >= force_exit_steps:
+                # 強制イグジット
+                _pos = 0.0
+                _ret = -(np.log(close[i]) - np.log(_entry_price))
+            else:
+                # ポジションをそのまま維持
+                _pos = _prev_pos
+                _ret = 0.0
+        else:
+            if buy_limit_hit[i] == True:
+                # ロングでエントリー
+                _pos = 1.0
+                _ret = 0.0
+                _entry_price = buy_limit[i]
+                _entry_step = i
+            elif sell_limit_hit[i] == True:
+                # ショートでエントリー
+                _pos = -1.0
+                _ret = 0.0
+                _entry_price = sell_limit[i]
+                _entry_step = i
+            else:
+                # ポジションをそのまま維持
+                _pos = _prev_pos
+                _ret = 0.0
+
+        position[i] = _pos
+        ret[i] = _ret
+
+    return position, ret
+
+# talib.ATRと同じ定義のATRを求める関数 (talibがなくても計算できるように、Wilderの平滑化を線形フィルタで計算する)
+# True Rangeは1本目から求め、window_size本目で最初のwindow_size本の単純平均、それ以降は (前のATR * (window_size - 1) + TR) / window_size
+def calc_atr(high: np.ndarray = None, low: np.ndarray = None, close: np.ndarray = None, window_size: int = 14) -> np.ndarray:
+    assert high is not None
+    assert low is not None
+    assert close is not None
+
+    _atr = np.full(close.size, np.nan)
+    if close.size <= window_size:
+        return _atr
+
+    _prev_close = close[:-1]
+    _true_range = np.maximum.reduce([high[1:] - low[1:], np.abs(high[1:] - _prev_close), np.abs(low[1:] - _prev_close)])
+
+    _first_atr = np.mean(_true_range[:window_size])
+    _atr[window_size] = _first_atr
+    if close.size > window_size + 1:
+        _atr[window_size + 1:], _ = lfilter([1.0 / window_size], [1.0, -(window_size - 1.0) / window_size], _true_range[window_size:], zi = [_first_atr * (window_size - 1.0) / window_size])
+
+    return _atr
+
+# 1つのパラメータの組み合わせについてATRくんのバックテストを行い、結果を1行の要約にして返す関数
+# simulate_atrkunと同じ計算をデータフレームを作らずに配列で行う (描画は行わない)
+# atrにはatr_factorを掛ける前のATRを渡す。bars_per_yearはシャープレシオの年率換算に使う
+def run_atr_backtest(high: np.ndarray = None, low: np.ndarray = None, close: np.ndarray = None, atr: np.ndarray = None, atr_factor: float = 0.5, fee: float = 0.02, force_exit_steps: int = 0, bars_per_year: float = 365 * 24) -> dict:
+    assert high is not None
+    assert low is not None
+    assert close is not None
+    assert atr is not None
+
+    # 1本後の時間足で有効な買指値、売指値を計算する
+    _atr = atr * atr_factor
+    _buy_limit = np.r_[np.nan, (close - _atr)[:-1]]
+    _sell_limit = np.r_[np.nan, (close + _atr)[:-1]]
+    with np.errstate(invalid = 'ignore'):
+        _buy_limit_hit = _buy_limit > low
+        _sell_limit_hit = _sell_limit < high
+
+    _position, _trade_logreturn = calc_position_return(_buy_limit_hit, _sell_limit_hit, _buy_limit, _sell_limit, close, force_exit_steps)
+
+    # 指値とポジションの差分が求まらない最初の行は使わない
+    _valid = np.flatnonzero(np.isnan(_buy_limit) == False)
+    _start = max(_valid[0] if _valid.size > 0 else close.size, 1)
+    _position_diff = (_position[1:] - _position[:-1])[_start - 1:]
+    _position = _position[_start:]
+
+    # トレードを行うごとに手数料は1回分カウントする
+    _fee = np.where(_position_diff != 0.0, fee * 0.01, 0.0)
+    _profit = _trade_logreturn[_start:] - _fee
+    _profit_cumsum = np.cumsum(_profit)
+
+    # イグジットしたトレードごとの利益は、直前のトレード (エントリー) からの累積利益の差
+    _trade_rows = np.flatnonzero(_position_diff != 0.0)
+    _profit_trade = np.diff(_profit_cumsum[_trade_rows])
+    _profit_trade = _profit_trade[_position[_trade_rows[1:]] == 0]
+    _trade_count = _profit_trade.size
+
+    _final_profit = _profit_cumsum[-1] if _profit_cumsum.size > 0 else 0.0
+    _profit_std = np.std(_profit)
+    _drawdown = np.maximum.accumulate(np.r_[0.0, _profit_cumsum]) - np.r_[0.0, _profit_cumsum]
+
+    return {
+        'final_profit': _final_profit,
+        'trade_count': _trade_count,
+        'expected_return_per_trade': _final_profit / _trade_count if _trade_count > 0 else np.nan,
+        'sd_per_trade': np.std(_profit_trade, ddof = 1) if _trade_count > 1 else np.nan,
+        'win_rate': np.mean(_profit_trade > 0) if _trade_count > 0 else np.nan,
+        'sharpe_ratio': np.mean(_profit) / _profit_std * np.sqrt(bars_per_year) if _profit_std > 0 else np.nan,
+        'max_drawdown': np.max(_drawdown),
+    }
+
+# 1つの銘柄・ウィンドウサイズについて、atr_factor, force_exit_steps, feeの組み合わせの一部をまとめてバックテストする関数
+# high, low, close, atrはタスクごとにワーカーに渡される。joblibはmax_nbytes (1MB) を超える配列だけを読み込み専用のメモリマップで渡すので、
+# 1時間足のような小さい配列はタスクごとにpickleして送られる (バックテスト1回分に比べれば十分小さい)
+def run_atr_backtest_batch(idx, high, low, close, atr, list_params, bars_per_year):
+    _list_results = []
+    for _atr_factor, _force_exit_steps, _fee in list_params:
+        _list_results.append(run_atr_backtest(high, low, close, atr, _atr_factor, _fee, _force_exit_steps, bars_per_year))
+    return (idx, _list_results)
+
+# 複数の銘柄のタイムバーをそれぞれ1回だけ読み込み、全てのウィンドウサイズのATRを先に求めてから、パラメータの格子の全ての組み合わせを並列にバックテストする関数
+# タスクは (銘柄, ウィンドウサイズ, atr_factor・force_exit_steps・feeの組み合わせの一部) で、全銘柄のタスクを1回のjoblibの並列処理で全コア数-1個のコアに分配する
+# 組み合わせはワーカーごとにatr_grid_tasks_per_worker個程度のタスクになるように分割するので、銘柄やウィンドウサイズが1つでも全てのコアを使う
+# dict_timebarsに {銘柄: タイムバー} を渡した場合は、タイムバーファイルを読み込まずにそれを使う
+# 戻り値はパラメータの組み合わせごとの最終利益、トレード回数、シャープレシオ、最大ドローダウンなどのデータフレーム (銘柄、ウィンドウサイズ、パラメータの順に並ぶ)
+def run_atr_backtest_grid_for_symbols(symbols: list = None, interval: int = 3600, window_sizes: list = (14,), atr_factors: list = (0.5,), force_exit_steps_list: list = (0,), fees: list = (0.02,), from_str: str = None, to_str: str = None, dict_timebars: dict = None) -> pd.DataFrame:
+    assert symbols is not None
+
+    _bars_per_year = 365 * 86400 / interval
+    _list_window_sizes = list(window_sizes)
+
+    _dict_arrays = {}
+    for _symbol in symbols:
+        if dict_timebars is not None and _symbol in dict_timebars:
+            _df_timebar = dict_timebars[_symbol]
+        else:
+            _df_timebar = concat_timebar_files(_symbol, interval, from_str, to_str, columns = ['high', 'low', 'close'])
+
+        _high = np.ascontiguousarray(_df_timebar['high'].values, dtype = float)
+        _low = np.ascontiguousarray(_df_timebar['low'].values, dtype = float)
+        _close = np.ascontiguousarray(_df_timebar['close'].values, dtype = float)
+        for _window_size in _list_window_sizes:
+            _dict_arrays[(_symbol, _window_size)] = (_high, _low, _close, calc_atr(_high, _low, _close, _window_size))
+
+    _list_params = list(itertools.product(atr_factors, force_exit_steps_list, fees))
+    _list_series = [(_symbol, _window_size) for _symbol in symbols for _window_size in _list_window_sizes]
+
+    # 組み合わせの総数をワーカー数 * atr_grid_tasks_per_worker個程度のタスクに分ける
+    _num_workers = max(joblib.cpu_count() - 1, 1)
+    _chunk_size = max(1, -(-len(_list_params) * len(_list_series) // (_num_workers * atr_grid_tasks_per_worker)))
+    _list_tasks = [(_symbol, _window_size, _start) for _symbol, _window_size in _list_series for _start in range(0, len(_list_params), _chunk_size)]
+
+    with tqdm_joblib(total = len(_list_tasks)):
+        results = joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(run_atr_backtest_batch)(_idx, *_dict_arrays[(_symbol, _window_size)], _list_params[_start:_start + _chunk_size], _bars_per_year) for _idx, (_symbol, _window_size, _start) in enumerate(_list_tasks)])
+
+    results.sort(key = lambda x: x[0])
+
+    _list_rows = []
+    for _idx, _list_results in results:
+        _symbol, _window_size, _start = _list_tasks[_idx]
+        for (_atr_factor, _force_exit_steps, _fee), _result in zip(_list_params[_start:_start + _chunk_size], _list_results):
+            _list_rows.append(dict(symbol = _symbol, window_size = _window_size, atr_factor = _atr_factor, force_exit_steps = _force_exit_steps, fee = _fee, **_result))
+
+    return pd.DataFrame(_list_rows)
+
+# 1つの銘柄についてパラメータの格子をバックテストする関数 (run_atr_backtest_grid_for_symbolsを1銘柄で呼ぶ)
+# df_timebarを渡した場合は、タイムバーファイルを読み込まずにそれを使う
+def run_atr_backtest_grid(symbol: str = None, interval: int = 3600, window_sizes: list = (14,), atr_factors: list = (0.5,), force_exit_steps_list: list = (0,), fees: list = (0.02,), from_str: str = None, to_str: str = None, df_timebar: pd.DataFrame = None) -> pd.DataFrame:
+    assert symbol is not None or df_timebar is not None
+
+    return run_atr_backtest_grid_for_symbols([symbol], interval, window_sizes, atr_factors, force_exit_steps_list, fees, from_str, to_str, None if df_timebar is None else {symbol: df_timebar})
+
+# 引数処理とバックテスト関数の起動部分
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--symbol', help = 'バックテストする対象の銘柄 例:BTCUSDT (省略時は全銘柄)')
+    parser.add_argument('--interval', type = int, default = 3600, help = '使うタイムバーの時間間隔 [秒]')
+    parser.add_argument('--window-size', type = int, nargs = '+', default = [14], help = 'ATRのウィンドウサイズ 例:7 14 28')
+    parser.add_argument('--atr-factor', type = float, nargs = '+', default = [0.5], help = 'ATRに掛ける係数 例:0.3 0.5 1.0')
+    parser.add_argument('--force-exit-steps', type = int, nargs = '+', default = [0], help = '強制イグジットまでの本数 (0は強制イグジットしない) 例:0 16')
+    parser.add_argument('--fee', type = float, nargs = '+', default = [0.02], help = '1トレードあたりの手数料 [%%] 例:0.0 0.02')
+    parser.add_argument('--output', default = 'atr_backtest_result.csv', help = '結果を保存するCSVファイル')
+    args = parser.parse_args()
+
+    if args.symbol:
+        _list_symbols = [args.symbol]
+    else:
+        _list_symbols = list(target_symbols.keys())
+
+    _df_result = run_atr_backtest_grid_for_symbols(_list_symbols, args.interval, args.window_size, args.atr_factor, args.force_exit_steps, args.fee)
+    _df_result.to_csv(args.output, index = False)
+    print(_df_result.sort_values('sharpe_ratio', ascending = False).head(20).to_string())
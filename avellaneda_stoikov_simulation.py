@@ -0,0 +1,200 @@
+import itertools
+import joblib
+import numpy as np
+import pandas as pd
+from exercise_core import tqdm_joblib
+
+# 論文の数値シミュレーションで使われているパラメータ (LimitedOrderBookHFT_exercise.ipynbと同じ)
+# s: 初期仲値、T: 終了時刻、sigma: 仲値のボラティリティ、dt: 時間刻み、gamma: リスク回避度、k, A: 指値の約定強度 A * exp(-k * delta) のパラメータ
+default_simulation_params = {
+    's': 100,
+    'T': 1,
+    'sigma': 2,
+    'dt': 0.005,
+    'gamma': 0.1,
+    'k': 1.5,
+    'A': 140,
+}
+
+# パスごとに独立した乱数列を作り、(パス数 x ステップ数) の一様乱数を仲値の変化用と指値の約定判定用に2つ返す関数
+# パスiの乱数列はseedとiだけで決まるので、パス数やバッチの分け方を変えても同じパスは同じ乱数になる
+def generate_path_uniforms(seed: int = 0, num_paths: int = None, num_steps: int = None, path_offset: int = 0):
+    assert num_paths is not None
+    assert num_steps is not None
+
+    _price_uniforms = np.empty((num_paths, num_steps))
+    _fill_uniforms = np.empty((num_paths, num_steps))
+    for _i in range(num_paths):
+        _rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key = (path_offset + _i,)))
+        _uniforms = _rng.random((2, num_steps))
+        _price_uniforms[_i] = _uniforms[0]
+        _fill_uniforms[_i] = _uniforms[1]
+
+    return (_price_uniforms, _fill_uniforms)
+
+# 論文の通りに、仲値が1ステップごとにsigma * sqrt(dt)だけランダムに上下するパスを (パス数 x (ステップ数 + 1)) の配列で返す関数
+def generate_random_walk_paths(price_uniforms: np.ndarray = None, s: float = None, sigma: float = None, dt: float = None) -> np.ndarray:
+    assert price_uniforms is not None
+
+    _changes = np.where(price_uniforms < 0.5, -1.0, 1.0) * sigma * np.sqrt(dt)
+    _paths = np.empty((price_uniforms.shape[0], price_uniforms.shape[1] + 1))
+    _paths[:, 0] = s
+    _paths[:, 1:] = s + np.cumsum(_changes, axis = 1)
+
+    return _paths
+
+# タイムバーのCloseを仲値として、ステップ数 + 1本ずつの重ならない区間に分けたパスの配列を返す関数
+# df_timebarにはconcat_timebar_filesやload_timebar_storeで読み込んだタイムバーを渡す
+# normalize_to_sを指定すると、各パスの最初の仲値がその値になるように比率でスケーリングする (論文のパラメータをそのまま使う場合など)
+def make_price_paths_from_timebar(df_timebar: pd.DataFrame = None, num_steps: int = None, normalize_to_s: float = None) -> np.ndarray:
+    assert df_timebar is not None
+    assert num_steps is not None
+
+    _close = df_timebar['close'].dropna().values.astype(float)
+    _num_paths = len(_close) // (num_steps + 1)
+    assert _num_paths > 0, 'タイムバーの本数がステップ数より少ないです'
+
+    _paths = _close[:_num_paths * (num_steps + 1)].reshape(_num_paths, num_steps + 1)
+    if normalize_to_s is not None:
+        _paths = _paths / _paths[:, :1] * normalize_to_s
+
+    return _paths
+
+# 仲値のパスから、1ステップあたりの変化の標準偏差をsqrt(dt)で割ったボラティリティを推定する関数
+def estimate_path_sigma(price_paths: np.ndarray = None, dt: float = None) -> float:
+    assert price_paths is not None
+    assert dt is not None
+
+    return float(np.std(np.diff(price_paths, axis = 1)) / np.sqrt(dt))
+
+# Avellaneda-Stoikovのマーケットメイクのシミュレーションを、全てのパスについて (パス数 x ステップ数) の配列で同時に進める関数
+# ノートブックのrun_simulationと同じく、各ステップで前のステップの指値に対して約定強度から約定確率を求め、1つの一様乱数で買い・売り・約定なしを決める
+# symmetric = Trueの場合は仲値を中心にした対称な指値、Falseの場合は在庫を考慮した無差別価格を中心にした指値を出す
+# price_pathsに (パス数 x (ステップ数 + 1)) の仲値の配列を渡すと、ランダムウォークの代わりにその仲値を使う
+# その場合は0からTまでをパスのステップ数で等分するので、dtはT / ステップ数になる (dtを指定する場合は、パスのステップ数とround(T / dt)が一致すること)
+# 戻り値は最終資産、最終在庫、最終現金の配列の辞書で、record = Trueの場合は各ステップの値の2次元配列も含める
+def simulate_avellaneda_stoikov(num_paths: int = 1000, seed: int = 0, symmetric: bool = False, price_paths: np.ndarray = None, record: bool = False, path_offset: int = 0, **params) -> dict:
+    _params = dict(default_simulation_params, **params)
+    _s = _params['s']
+    _T = _params['T']
+    _sigma = _params['sigma']
+    _dt = _params['dt']
+    _gamma = _params['gamma']
+    _k = _params['k']
+    _A = _params['A']
+
+    if price_paths is not None:
+        _price_mid = np.asarray(price_paths, dtype = float)
+        _num_paths, _num_steps = _price_mid.shape[0], _price_mid.shape[1] - 1
+        assert 'dt' not in params or _num_steps == int(round(_T / _dt)), f'仲値のパスのステップ数 ({_num_steps}) がT / dt ({_T / _dt:g}) と一致しません'
+        _dt = _T / _num_steps
+        _, _fill_uniforms = generate_path_uniforms(seed, _num_paths, _num_steps, path_offset)
+    else:
+        _num_paths = num_paths
+        _num_steps = int(round(_T / _dt))
+        _price_uniforms, _fill_uniforms = generate_path_uniforms(seed, _num_paths, _num_steps, path_offset)
+        _price_mid = generate_random_walk_paths(_price_uniforms, _s, _sigma, _dt)
+        del _price_uniforms
+
+    # 時刻と、時刻だけで決まる指値の幅の合計はパスによらないので先に求めておく
+    _time = np.arange(_num_steps + 1) * _dt
+    _half_spread = (_gamma * _sigma ** 2 * (_T - _time) + 2 / _gamma * np.log(1 + _gamma / _k)) / 2
+
+    _inventory = np.zeros(_num_paths)
+    _cash = np.zeros(_num_paths)
+    if record == True:
+        _inventory_path = np.zeros((_num_paths, _num_steps + 1))
+        _cash_path = np.zeros((_num_paths, _num_steps + 1))
+        _delta_ask_path = np.zeros((_num_paths, _num_steps + 1))
+        _delta_bid_path = np.zeros((_num_paths, _num_steps + 1))
+
+    def _quote(i):
+        if symmetric == True:
+            return (np.full(_num_paths, _half_spread[i]), np.full(_num_paths, -_half_spread[i]))
+        _price_indifference = _price_mid[:, i] - _inventory * _gamma * _sigma ** 2 * (_T - _time[i])
+        return (_price_indifference + _half_spread[i] - _price_mid[:, i], _price_indifference - _half_spread[i] - _price_mid[:, i])
+
+    _delta_ask, _delta_bid = _quote(0)
+    if record == True:
+        _delta_ask_path[:, 0] = _delta_ask
+        _delta_bid_path[:, 0] = _delta_bid
+
+    for _i in range(1, _num_steps + 1):
+        # 論文の通り、前のステップの指値の約定確率に基づいて指値の成立を判定する
+        _probability_ask = _A * np.exp(-1 * _k * np.abs(_delta_ask)) * _dt
+        _probability_bid = _A * np.exp(-1 * _k * np.abs(_delta_bid)) * _dt
+        _random_value = _fill_uniforms[:, _i - 1]
+        _bid_filled = _random_value <= _probability_bid
+        _ask_filled = (_bid_filled == False) & (_random_value < _probability_ask + _probability_bid)
+
+        _prev_price_mid = _price_mid[:, _i - 1]
+        _inventory = _inventory + _bid_filled - _ask_filled
+        _cash = _cash - np.where(_bid_filled, _prev_price_mid + _delta_bid, 0.0) + np.where(_ask_filled, _prev_price_mid + _delta_ask, 0.0)
+
+        _delta_ask, _delta_bid = _quote(_i)
+        if record == True:
+            _inventory_path[:, _i] = _inventory
+            _cash_path[:, _i] = _cash
+            _delta_ask_path[:, _i] = _delta_ask
+            _delta_bid_path[:, _i] = _delta_bid
+
+    _dict_result = {
+        'wealth': _cash + _inventory * _price_mid[:, -1],
+        'inventory': _inventory,
+        'cash': _cash,
+    }
+    if record == True:
+        _dict_result['time'] = _time
+        _dict_result['price_mid'] = _price_mid
+        _dict_result['inventory_path'] = _inventory_path
+        _dict_result['cash_path'] = _cash_path
+        _dict_result['delta_ask_path'] = _delta_ask_path
+        _dict_result['delta_bid_path'] = _delta_bid_path
+
+    return _dict_result
+
+# シミュレーション結果の最終資産と最終在庫の分布を1行の要約にする関数
+def summarize_simulation_result(dict_result: dict = None) -> dict:
+    assert dict_result is not None
+
+    _wealth = dict_result['wealth']
+    _inventory = dict_result['inventory']
+    return {
+        'wealth_mean': np.mean(_wealth),
+        'wealth_std': np.std(_wealth),
+        'wealth_q05': np.quantile(_wealth, 0.05),
+        'wealth_median': np.median(_wealth),
+        'wealth_q95': np.quantile(_wealth, 0.95),
+        'inventory_mean': np.mean(_inventory),
+        'inventory_std': np.std(_inventory),
+        'inventory_abs_mean': np.mean(np.abs(_inventory)),
+    }
+
+def run_simulation_grid_point(idx, num_paths, seed, symmetric, price_paths, params):
+    return (idx, summarize_simulation_result(simulate_avellaneda_stoikov(num_paths, seed, symmetric, price_paths, **params)))
+
+# パラメータの格子 (例: {'gamma': [0.01, 0.1, 0.5], 'k': [1.0, 1.5]}) の全ての組み合わせについて、全コア数-2個のコアで並列にシミュレーションを行う関数
+# strategiesには'inventory' (在庫を考慮した指値) と'symmetric' (対称な指値) を指定できる
+# 全ての組み合わせで同じseedの乱数列を使うので、パラメータによる違いを少ないパス数で比べられる
+# 戻り値はパラメータと戦略ごとに最終資産と最終在庫の分布を要約したデータフレーム
+def run_simulation_grid(param_grid: dict = None, num_paths: int = 1000, seed: int = 0, strategies: list = ('inventory', 'symmetric'), price_paths: np.ndarray = None) -> pd.DataFrame:
+    assert param_grid is not None
+    assert all([_ in ['inventory', 'symmetric'] for _ in strategies])
+
+    _keys = list(param_grid.keys())
+    _list_points = []
+    for _values in itertools.product(*[param_grid[_] for _ in _keys]):
+        for _strategy in strategies:
+            _list_points.append((_strategy, dict(zip(_keys, _values))))
+
+    with tqdm_joblib(total = len(_list_points)):
+        results = joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(run_simulation_grid_point)(_idx, num_paths, seed, _strategy == 'symmetric', price_paths, _params) for _idx, (_strategy, _params) in enumerate(_list_points)])
+
+    results.sort(key = lambda x: x[0])
+
+    _list_rows = []
+    for _idx, _summary in results:
+        _strategy, _params = _list_points[_idx]
+        _list_rows.append(dict(strategy = _strategy, **_params, **_summary))
+
+    return pd.DataFrame(_list_rows)
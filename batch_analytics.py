@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from task_scheduler import run_task_graph
+
+# 多数の系列 (銘柄 × ウィンドウ × 特徴量など) に対するADF検定と、x/yのペアの相関の統計量をまとめて計算する関数
+# archはimportに時間がかかるので、ADF検定を実行するワーカーの関数の中でimportする
+
+# 条件付き平均を求めるxのレンジの設定 (show_correlationと同じく、平均±std_range標準偏差を0.5標準偏差ずつに区切る)
+correlation_std_range = 3
+correlation_bucket_width = 0.5
+
+# 共有メモリに置いた系列を1つ取り出してADF検定を実施する関数 (ワーカーのプロセスで実行する)
+# 共有メモリは系列を連結した1つのfloat64の配列で、offsetとlengthで取り出す系列を指定する。NaNは取り除く
+def run_adf_on_shared_memory(shm_name: str = None, total_length: int = None, offset: int = None, length: int = None, trend: str = 'c', lags: int = None, max_lags: int = None) -> dict:
+    from arch.unitroot import ADF
+
+    _shm = shared_memory.SharedMemory(name = shm_name)
+    try:
+        _buffer = np.ndarray((total_length,), dtype = np.float64, buffer = _shm.buf)
+        _y = np.array(_buffer[offset:offset + length])
+        del _buffer
+    finally:
+        _shm.close()
+    _y = _y[~np.isnan(_y)]
+
+    try:
+        _r = ADF(_y, lags = lags, trend = trend, max_lags = max_lags, low_memory = len(_y) > 10_000)
+        return {'nobs': _r.nobs, 'lags': _r.lags, 'stat': _r.stat, 'pvalue': _r.pvalue, 'error': None}
+    except Exception as e:
+        return {'nobs': len(_y), 'lags': None, 'stat': np.nan, 'pvalue': np.nan, 'error': str(e)}
+
+# 多数の系列にADF検定を実施する関数
+# dict_seriesには {キー: 系列 (pd.Seriesかnp.ndarray)} を渡す。キーにはタプル (例: (銘柄, ウィンドウ, 特徴量)) も使える
+# 系列は1つの共有メモリに連結して置き、ワーカーには位置だけを渡すので、系列ごとにpickleしてプロセス間でコピーすることはない
+# 検定はrun_task_graphの1つのプロセスプールで、長い系列から順に (短い系列はまとめて) 実行する
+# trend, lags, max_lagsはarch.unitroot.ADFと同じ (lagsを指定しない場合は、AICでラグを選ぶ)
+# 戻り値はキーをインデックスにした、nobs, lags, stat, pvalue, error (検定できなかった場合の例外のメッセージ) のデータフレーム
+def batch_adf_test(dict_series: dict = None, trend: str = 'c', lags: int = None, max_lags: int = None, max_workers: int = None) -> pd.DataFrame:
+    assert dict_series is not None
+
+    _list_keys = list(dict_series.keys())
+    _list_arrays = [np.asarray(dict_series[_key], dtype = np.float64).reshape(-1) for _key in _list_keys]
+    _lengths = np.array([_.size for _ in _list_arrays], dtype = np.int64)
+    _offsets = np.r_[0, np.cumsum(_lengths)[:-1]].astype(np.int64) if len(_lengths) > 0 else _lengths
+    _total_length = int(_lengths.sum())
+
+    _shm = shared_memory.SharedMemory(create = True, size = max(_total_length, 1) * np.dtype(np.float64).itemsize)
+    try:
+        _buffer = np.ndarray((_total_length,), dtype = np.float64, buffer = _shm.buf)
+        for _array, _offset in zip(_list_arrays, _offsets):
+            _buffer[_offset:_offset + _array.size] = _array
+        del _buffer
+
+        _list_tasks = []
+        for _idx, (_offset, _length) in enumerate(zip(_offsets, _lengths)):
+            _args = (_shm.name, _total_length, int(_offset), int(_length), trend, lags, max_lags)
+            _list_tasks.append({'key': _idx, 'func': run_adf_on_shared_memory, 'args': _args, 'cost': int(_length)})
+
+        _dict_results = run_task_graph(_list_tasks, max_workers = max_workers, desc = 'adf')
+    finally:
+        _shm.close()
+        _shm.unlink()
+
+    _df = pd.DataFrame([_dict_results[_] for _ in range(len(_list_keys))], columns = ['nobs', 'lags', 'stat', 'pvalue', 'error'])
+    _df.index = pd.Index(_list_keys)
+    return _df
+
+# 多数のx/yのペアについて、IC (相関係数)、原点を通る回帰直線の傾き、xのレンジごとのyの平均 (条件付き平均) をまとめて計算する関数
+# dict_pairsには {キー: (x, y)} を渡す。x, yはpd.Series (インデックスで揃える) かnp.ndarrayで、どちらかがNaNの行は使わない
+# 全ペアの値をペアのインデックス付きで1つの配列に連結し、np.bincountで1回のパスで計算する (傾きはcurve_fitと同じ最小二乗解を閉じた式で求める)
+# レンジはペアごとにxの平均±correlation_std_range標準偏差をcorrelation_bucket_width標準偏差ずつに区切ったもの (show_correlationの階段状の平均と同じ)
+# 戻り値は (キーをインデックスにしたn, ic, slope, x_mean, x_std, y_mean, y_std のデータフレーム,
+#           (キー, レンジの番号) をインデックスにしたx_from, x_to, count, y_mean のデータフレーム)
+def batch_correlation(dict_pairs: dict = None) -> tuple:
+    assert dict_pairs is not None
+
+    _list_keys = list(dict_pairs.keys())
+    _num_pairs = len(_list_keys)
+    _num_buckets = int(round(2 * correlation_std_range / correlation_bucket_width)) + 1
+
+    _list_x = [np.empty(0)]
+    _list_y = [np.empty(0)]
+    _list_ids = [np.empty(0, dtype = np.int64)]
+    for _idx, _key in enumerate(_list_keys):
+        _x, _y = dict_pairs[_key]
+        _df = pd.DataFrame({'x': _x, 'y': _y}).dropna()
+        _list_x.append(_df['x'].values.astype(np.float64))
+        _list_y.append(_df['y'].values.astype(np.float64))
+        _list_ids.append(np.full(len(_df), _idx, dtype = np.int64))
+    _x = np.concatenate(_list_x)
+    _y = np.concatenate(_list_y)
+    _ids = np.concatenate(_list_ids)
+
+    # 数値誤差を抑えるため、先に平均を求めてから偏差で分散と共分散を計算する
+    _n = np.bincount(_ids, minlength = _num_pairs)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        _x_mean = np.bincount(_ids, weights = _x, minlength = _num_pairs) / _n
+        _y_mean = np.bincount(_ids, weights = _y, minlength = _num_pairs) / _n
+        _dx = _x - _x_mean[_ids]
+        _dy = _y - _y_mean[_ids]
+        _sxx = np.bincount(_ids, weights = _dx * _dx, minlength = _num_pairs)
+        _syy = np.bincount(_ids, weights = _dy * _dy, minlength = _num_pairs)
+        _sxy = np.bincount(_ids, weights = _dx * _dy, minlength = _num_pairs)
+        _x_std = np.sqrt(_sxx / (_n - 1))
+        _y_std = np.sqrt(_syy / (_n - 1))
+        _ic = _sxy / np.sqrt(_sxx * _syy)
+        _slope = np.bincount(_ids, weights = _x * _y, minlength = _num_pairs) / np.bincount(_ids, weights = _x * _x, minlength = _num_pairs)
+
+        # ペアごとのレンジの番号を求め、(ペア, レンジ) ごとのyの和と個数から条件付き平均を求める
+        _x_min = _x_mean - correlation_std_range * _x_std
+        _width = correlation_bucket_width * _x_std
+        _bucket = np.floor((_x - _x_min[_ids]) / _width[_ids])
+    _valid = np.isfinite(_bucket) & (_bucket >= 0) & (_bucket < _num_buckets)
+    _cells = _ids[_valid] * _num_buckets + _bucket[_valid].astype(np.int64)
+    _bucket_count = np.bincount(_cells, minlength = _num_pairs * _num_buckets)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        _bucket_mean = np.bincount(_cells, weights = _y[_valid], minlength = _num_pairs * _num_buckets) / _bucket_count
+    _x_from = (_x_min[:, np.newaxis] + _width[:, np.newaxis] * np.arange(_num_buckets)[np.newaxis, :]).reshape(-1)
+
+    _df_stats = pd.DataFrame({
+        'n': _n,
+        'ic': _ic,
+        'slope': _slope,
+        'x_mean': _x_mean,
+        'x_std': _x_std,
+        'y_mean': _y_mean,
+        'y_std': _y_std,
+    }, index = pd.Index(_list_keys))
+
+    _index = pd.MultiIndex.from_tuples([(*(_key if isinstance(_key, tuple) else (_key,)), _bucket) for _key in _list_keys for _bucket in range(_num_buckets)])
+    _df_buckets = pd.DataFrame({
+        'x_from': _x_from,
+        'x_to': _x_from + np.repeat(_width, _num_buckets),
+        'count': _bucket_count,
+        'y_mean': _bucket_mean,
+    }, index = _index)
+
+    return (_df_stats, _df_buckets)
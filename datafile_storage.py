@@ -0,0 +1,461 @@
+from pathlib import Path
+import re
+import gzip
+import contextlib
+import argparse
+import joblib
+import numpy as np
+import pandas as pd
+
+# データファイルの保存形式と拡張子 (同じ日のファイルが複数の形式で存在する場合は、この順番で優先する)
+# arrowとparquetはpyarrowが必要。compactは約定履歴専用の形式 (write_compact_datafileを参照)
+datafile_extensions = {
+    'compact': '.npz',
+    'arrow': '.arrow',
+    'parquet': '.parquet',
+    'pickle': '.pkl.gz',
+}
+
+# データの種類ごとに新しく書き込むファイルの保存形式
+dataset_formats = {
+    'trades': 'pickle',
+    'timebar': 'pickle',
+}
+
+# 列指向形式の圧縮方式
+datafile_compressions = {
+    'arrow': 'lz4',
+    'parquet': 'zstd',
+}
+
+# compact形式で保存できる約定履歴の列 (この順番で保存する)
+compact_trade_columns = ['id', 'price', 'qty', 'quote_qty', 'time', 'is_buyer_maker']
+
+# compact形式で、10進数の小数を整数にするときに試す小数点以下の最大の桁数
+compact_max_decimals = 15
+
+# ファイル名の末尾にマッチする拡張子の正規表現
+datafile_extension_pattern = '(?:' + '|'.join([re.escape(_) for _ in datafile_extensions.values()]) + ')'
+
+# データの種類に対して新しく書き込むファイルの保存形式を返す関数
+def get_dataset_format(datatype: str = None, fmt: str = None) -> str:
+    assert datatype is not None
+
+    if fmt is None:
+        fmt = dataset_formats.get(datatype, 'pickle')
+    assert fmt in datafile_extensions, f'未対応の保存形式です: {fmt}'
+    assert fmt != 'compact' or datatype == 'trades', 'compact形式は約定履歴専用です'
+
+    return fmt
+
+# ファイル名から保存形式を判定する関数
+def identify_datafile_format(filename) -> str:
+    _name = Path(filename).name
+    for _fmt, _ext in datafile_extensions.items():
+        if _name.endswith(_ext):
+            return _fmt
+    return None
+
+# ファイル名から保存形式の拡張子を取り除く関数
+def strip_datafile_extension(filename) -> str:
+    _filename = str(filename)
+    _fmt = identify_datafile_format(_filename)
+    if _fmt is None:
+        return _filename
+    return _filename[:-len(datafile_extensions[_fmt])]
+
+# 拡張子なしのファイル名に対して、いずれかの保存形式で存在するファイルを返す関数 (存在しなければNone)
+def find_datafile(filename_without_extension: str = None):
+    assert filename_without_extension is not None
+
+    for _ext in datafile_extensions.values():
+        _p = Path(f'{filename_without_extension}{_ext}')
+        if _p.exists() == True:
+            return _p
+    return None
+
+# 同じデータが複数の保存形式で存在する場合に、優先度の高い形式のファイルだけを残す関数
+def deduplicate_datafiles(list_filenames: list = None) -> list:
+    assert list_filenames is not None
+
+    _priority = list(datafile_extensions.keys())
+    _dict_files = {}
+    for _filename in list_filenames:
+        _stem = strip_datafile_extension(_filename)
+        _fmt = identify_datafile_format(_filename)
+        _rank = _priority.index(_fmt) if _fmt in _priority else len(_priority)
+        if _stem not in _dict_files or _rank < _dict_files[_stem][0]:
+            _dict_files[_stem] = (_rank, _filename)
+
+    return [_[1] for _ in _dict_files.values()]
+
+# データフレームをpkl.gzファイルに書き込む関数
+# gzipのヘッダにファイル名と書き込み時刻を入れないので、一時ファイルに書いてからリネームしても、同じデータからは同じファイルになる
+def write_pickle_datafile(df: pd.DataFrame = None, filename: str = None) -> None:
+    assert df is not None
+    assert filename is not None
+
+    with open(filename, 'wb') as _f:
+        with gzip.GzipFile(filename = '', mode = 'wb', fileobj = _f, mtime = 0) as _gz:
+            df.to_pickle(_gz, compression = None)
+
+# 整数の配列を、値が収まる最も小さい整数型に変換する関数
+def downcast_integer_array(values: np.ndarray = None) -> np.ndarray:
+    assert values is not None
+
+    if values.size == 0:
+        return values.astype(np.int8)
+    for _dtype in [np.int8, np.int16, np.int32]:
+        _info = np.iinfo(_dtype)
+        if values.min() >= _info.min and values.max() <= _info.max:
+            return values.astype(_dtype)
+    return values.astype(np.int64)
+
+# 10進数の文字列から変換した小数の配列を、10 ** decimals倍してstepで割った整数の配列にする関数
+# 戻り値は (整数の配列, decimals, step) で、整数 * stepを10 ** decimalsで割ると元と同じfloatに戻る (IEEE 754の割り算は正しく丸められるため)
+# compact_max_decimals桁までで元に戻せる整数にできない場合はNoneを返す
+def encode_decimal_array(values: np.ndarray = None):
+    assert values is not None
+
+    if values.size == 0:
+        return (np.zeros(0, dtype = np.int64), 0, 1)
+    if np.all(np.isfinite(values)) == False:
+        return None
+
+    for _decimals in range(compact_max_decimals + 1):
+        _scaled = np.round(values * 10.0 ** _decimals)
+        if np.abs(_scaled).max() >= 2 ** 53:
+            return None
+        if np.array_equal(_scaled / 10.0 ** _decimals, values):
+            _integers = _scaled.astype(np.int64)
+            _step = max(int(np.gcd.reduce(_integers)), 1)
+            return (_integers // _step, _decimals, _step)
+    return None
+
+# encode_decimal_arrayで整数にした配列を小数の配列に戻す関数
+def decode_decimal_array(integers: np.ndarray = None, decimals: int = None, step: int = None) -> np.ndarray:
+    assert integers is not None
+    assert decimals is not None
+    assert step is not None
+
+    return (integers.astype(np.int64) * step).astype(np.float64) / 10.0 ** decimals
+
+# 整数の配列を、先頭の値と隣との差分 (値が収まる最も小さい整数型) にして辞書に入れる関数
+def _put_delta_array(dict_arrays: dict, name: str, values: np.ndarray) -> None:
+    dict_arrays[f'{name}_first'] = np.array(values[0] if values.size > 0 else 0, dtype = np.int64)
+    dict_arrays[f'{name}_delta'] = downcast_integer_array(np.diff(values))
+
+def _get_delta_array(npz, name: str) -> np.ndarray:
+    return np.cumsum(np.r_[npz[f'{name}_first'], npz[f'{name}_delta']].astype(np.int64))[:int(npz['num_rows'])]
+
+# 約定履歴のデータフレームをcompact形式でファイルに書き込む関数
+# price, qtyは銘柄のティックサイズ・ステップサイズ (ファイル内の値の最大公約数) 単位の整数、time (ms単位) とidは先頭の値と差分、is_buyer_makerはビットに詰めて、
+# 値が収まる最も小さい整数型でnp.savez_compressedで保存する。整数にできない列はfloat64のまま保存する
+# quote_qtyは整数のprice * qtyから元のfloatと同じ値が求まる場合は保存せず、読み込み時に計算する
+def write_compact_datafile(df: pd.DataFrame = None, filename: str = None) -> None:
+    assert df is not None
+    assert filename is not None
+    assert all(_ in compact_trade_columns for _ in df.columns), f'compact形式で保存できない列があります: {list(df.columns)}'
+
+    _columns = [_ for _ in compact_trade_columns if _ in df.columns]
+    _dict_arrays = {
+        'columns': np.array(_columns),
+        'num_rows': np.array(len(df), dtype = np.int64),
+    }
+
+    if 'id' in _columns:
+        _put_delta_array(_dict_arrays, 'id', df['id'].values.astype(np.int64))
+
+    if 'time' in _columns:
+        _time = df['time'].values.astype('datetime64[ns]').astype(np.int64)
+        _time_unit = 1_000_000 if np.all(_time % 1_000_000 == 0) else 1
+        _dict_arrays['time_unit'] = np.array(_time_unit, dtype = np.int64)
+        _put_delta_array(_dict_arrays, 'time', _time // _time_unit)
+
+    if 'is_buyer_maker' in _columns:
+        _dict_arrays['is_buyer_maker_bits'] = np.packbits(df['is_buyer_maker'].values.astype(bool))
+
+    _dict_encoded = {}
+    for _column in ['price', 'qty', 'quote_qty']:
+        if _column not in _columns:
+            continue
+        _values = df[_column].values.astype(np.float64)
+
+        # quote_qtyはprice * qtyを整数で計算して、元の値と同じになるか確かめる
+        if _column == 'quote_qty' and 'price' in _dict_encoded and 'qty' in _dict_encoded:
+            (_price, _price_decimals, _price_step), (_qty, _qty_decimals, _qty_step) = _dict_encoded['price'], _dict_encoded['qty']
+            _decimals = _price_decimals + _qty_decimals
+            with np.errstate(over = 'ignore'):
+                _fits = _decimals <= 22 and np.all(np.abs(_price.astype(np.float64) * _price_step * _qty.astype(np.float64) * _qty_step) < 2 ** 53)
+            if _fits == True and np.array_equal(decode_decimal_array(_price * _qty, _decimals, _price_step * _qty_step), _values):
+                _dict_arrays['quote_qty_derived'] = np.array(True)
+                continue
+
+        _encoded = encode_decimal_array(_values)
+        if _encoded is None:
+            _dict_arrays[f'{_column}_float'] = _values
+            continue
+        _dict_encoded[_column] = _encoded
+        _dict_arrays[f'{_column}_decimals'] = np.array(_encoded[1], dtype = np.int64)
+        _dict_arrays[f'{_column}_step'] = np.array(_encoded[2], dtype = np.int64)
+        _put_delta_array(_dict_arrays, _column, _encoded[0])
+
+    with open(filename, 'wb') as _f:
+        np.savez_compressed(_f, **_dict_arrays)
+
+# compact形式のファイルを読み込んでデータフレームを返す関数 (引数はread_datafileと同じ)
+# 指定された列の復元に必要な配列だけを読み込む
+def read_compact_datafile(filename: str = None, columns: list = None, time_from = None, time_to = None) -> pd.DataFrame:
+    assert filename is not None
+
+    with np.load(filename) as _npz:
+        _stored_columns = [str(_) for _ in _npz['columns']]
+        _columns = _stored_columns if columns is None else list(columns)
+        assert all(_ in _stored_columns for _ in _columns), f'{filename}にない列です: {_columns}'
+        _num_rows = int(_npz['num_rows'])
+
+        _dict_cache = {}
+        def _decimal_column(name):
+            if name not in _dict_cache:
+                if f'{name}_float' in _npz.files:
+                    _dict_cache[name] = (_npz[f'{name}_float'], None, None)
+                else:
+                    _dict_cache[name] = (_get_delta_array(_npz, name), int(_npz[f'{name}_decimals']), int(_npz[f'{name}_step']))
+            return _dict_cache[name]
+
+        def _decode(name):
+            if name == 'id':
+                return _get_delta_array(_npz, 'id')
+            if name == 'time':
+                return (_get_delta_array(_npz, 'time') * int(_npz['time_unit'])).view('datetime64[ns]')
+            if name == 'is_buyer_maker':
+                return np.unpackbits(_npz['is_buyer_maker_bits'], count = _num_rows).astype(bool)
+            if name == 'quote_qty' and 'quote_qty_derived' in _npz.files:
+                _price, _price_decimals, _price_step = _decimal_column('price')
+                _qty, _qty_decimals, _qty_step = _decimal_column('qty')
+                return decode_decimal_array(_price * _qty, _price_decimals + _qty_decimals, _price_step * _qty_step)
+            _integers, _decimals, _step = _decimal_column(name)
+            return _integers if _decimals is None else decode_decimal_array(_integers, _decimals, _step)
+
+        _df = pd.DataFrame({_column: _decode(_column) for _column in _columns}, index = pd.RangeIndex(_num_rows))
+
+        if time_from is not None or time_to is not None:
+            _time = _decode('time')
+            _mask = np.ones(_num_rows, dtype = bool)
+            if time_from is not None:
+                _mask = _mask & (_time >= time_from.to_datetime64())
+            if time_to is not None:
+                _mask = _mask & (_time < time_to.to_datetime64())
+            _df = _df[_mask]
+
+    return _df
+
+# データフレームを指定された保存形式でファイルに書き込む関数
+def write_datafile(df: pd.DataFrame = None, filename: str = None, fmt: str = None) -> None:
+    assert df is not None
+    assert filename is not None
+
+    if fmt is None:
+        fmt = identify_datafile_format(filename)
+    assert fmt in datafile_extensions, f'未対応の保存形式です: {fmt}'
+
+    if fmt == 'pickle':
+        write_pickle_datafile(df, filename)
+        return
+    if fmt == 'compact':
+        write_compact_datafile(df, filename)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    _table = pa.Table.from_pandas(df, preserve_index = None)
+    if fmt == 'parquet':
+        pq.write_table(_table, filename, compression = datafile_compressions['parquet'])
+    else:
+        _options = pa.ipc.IpcWriteOptions(compression = datafile_compressions['arrow'])
+        with pa.OSFile(str(filename), 'wb') as _sink:
+            with pa.ipc.new_file(_sink, _table.schema, options = _options) as _writer:
+                _writer.write_table(_table)
+
+# データフレームを少しずつ追記して1つのファイルに書き込むためのコンテキストマネージャ
+# 列指向形式ではチャンクごとにファイルへ書き出すので、メモリ使用量はチャンクの大きさで抑えられる
+# pickleとcompactは追記できないので、チャンクを溜めておいて最後にまとめて書き込む (メモリ使用量は1日分のデータフレームの約2倍になる)
+# 例外で抜けた場合は書きかけのファイルを削除する
+@contextlib.contextmanager
+def datafile_appender(filename: str = None, fmt: str = None):
+    assert filename is not None
+
+    if fmt is None:
+        fmt = identify_datafile_format(filename)
+    assert fmt in datafile_extensions, f'未対応の保存形式です: {fmt}'
+
+    _list_chunks = []
+    _writers = []
+
+    def _append(df):
+        if fmt in ['pickle', 'compact']:
+            _list_chunks.append(df)
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        _table = pa.Table.from_pandas(df, preserve_index = False)
+        if len(_writers) == 0:
+            if fmt == 'parquet':
+                _writers.append(pq.ParquetWriter(str(filename), _table.schema, compression = datafile_compressions['parquet']))
+            else:
+                _options = pa.ipc.IpcWriteOptions(compression = datafile_compressions['arrow'])
+                _sink = pa.OSFile(str(filename), 'wb')
+                _writers.append(pa.ipc.new_file(_sink, _table.schema, options = _options))
+                _writers.append(_sink)
+        _writers[0].write_table(_table)
+
+    try:
+        yield _append
+    except BaseException:
+        for _writer in _writers:
+            _writer.close()
+        Path(filename).unlink(missing_ok = True)
+        raise
+
+    if fmt in ['pickle', 'compact']:
+        write_datafile(pd.concat(_list_chunks, axis = 0, ignore_index = True), filename, fmt)
+    else:
+        for _writer in _writers:
+            _writer.close()
+
+# ファイルを読み込んでデータフレームを返す関数
+# columnsで読み込む列を、time_from以上time_to未満で読み込む時刻の範囲を指定できる
+# 時刻の範囲はtime列があればその列、なければインデックスに対して適用する
+# 列指向形式の場合は、列の選択と時刻の範囲の絞り込みを読み込み時に行う
+def read_datafile(filename: str = None, columns: list = None, time_from = None, time_to = None) -> pd.DataFrame:
+    assert filename is not None
+
+    _fmt = identify_datafile_format(filename)
+    assert _fmt is not None, f'未対応の保存形式のファイルです: {filename}'
+
+    _time_from = pd.Timestamp(time_from) if time_from is not None else None
+    _time_to = pd.Timestamp(time_to) if time_to is not None else None
+
+    if _fmt == 'pickle':
+        _df = pd.read_pickle(filename)
+        if _time_from is not None or _time_to is not None:
+            _time = _df['time'] if 'time' in _df.columns else _df.index.to_series(index = _df.index)
+            _mask = pd.Series(True, index = _df.index)
+            if _time_from is not None:
+                _mask = _mask & (_time >= _time_from)
+            if _time_to is not None:
+                _mask = _mask & (_time < _time_to)
+            _df = _df[_mask.values]
+        if columns is not None:
+            _df = _df[list(columns)]
+        return _df
+
+    if _fmt == 'compact':
+        return read_compact_datafile(filename, columns, _time_from, _time_to)
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+
+    # どちらの形式もpyarrow.datasetのスキャンで、列の選択と時刻の範囲の絞り込みを読み込み時に行う (Arrow IPCファイルはメモリマップする)
+    _dataset = ds.dataset(str(Path(filename).resolve()), format = 'parquet' if _fmt == 'parquet' else 'ipc', filesystem = pafs.LocalFileSystem(use_mmap = _fmt == 'arrow'))
+    _schema = _dataset.schema
+
+    # インデックスとして保存されている列 (RangeIndexの場合はメタデータのみで列は存在しない)
+    _index_columns = [_ for _ in (_schema.pandas_metadata or {}).get('index_columns', []) if isinstance(_, str)]
+    if 'time' in _schema.names:
+        _time_column = 'time'
+    elif len(_index_columns) > 0:
+        _time_column = _index_columns[0]
+    else:
+        _time_column = None
+
+    _filter = None
+    if _time_from is not None:
+        assert _time_column is not None
+        _filter = ds.field(_time_column) >= pa.scalar(_time_from.to_pydatetime(), type = _schema.field(_time_column).type)
+    if _time_to is not None:
+        assert _time_column is not None
+        _expression = ds.field(_time_column) < pa.scalar(_time_to.to_pydatetime(), type = _schema.field(_time_column).type)
+        _filter = _expression if _filter is None else _filter & _expression
+
+    _columns = None if columns is None else list(columns) + [_ for _ in _index_columns if _ not in columns]
+    _table = _dataset.to_table(columns = _columns, filter = _filter)
+
+    _df = _table.to_pandas()
+    if columns is not None:
+        _df = _df[list(columns)]
+    return _df
+
+# タイムバーのすべてが0の行 (銘柄の最初の日の、最初の約定より前の前日Closeを0として埋めたバー) を判定する列
+timebar_key_columns = ['open', 'high', 'low', 'close']
+
+# タイムバーのすべてが0の行を取り除いてから、指定された列を選ぶ関数
+# 取り除く行はtimebar_key_columnsの列だけで決めるので、どの列を選んでも同じ行が返る
+def drop_empty_timebar_rows(df: pd.DataFrame = None, columns: list = None) -> pd.DataFrame:
+    assert df is not None
+
+    _df = df[(df[timebar_key_columns] != 0).any(axis = 1).values]
+    return _df if columns is None else _df[list(columns)]
+
+# タイムバーファイルを読み込み、すべてが0の行を取り除いたデータフレームを返す関数 (引数はread_datafileと同じ)
+# columnsを指定した場合も、行の判定に使う列を一緒に読み込む
+def read_timebar_datafile(filename: str = None, columns: list = None, time_from = None, time_to = None) -> pd.DataFrame:
+    assert filename is not None
+
+    _columns = None if columns is None else list(columns) + [_ for _ in timebar_key_columns if _ not in columns]
+    return drop_empty_timebar_rows(read_datafile(filename, _columns, time_from, time_to), columns)
+
+# 1つのファイルを別の保存形式に変換する関数
+def migrate_datafile(idx, filename, fmt, remove_source = False):
+    assert filename is not None
+    assert fmt in datafile_extensions
+
+    _src = Path(filename)
+    _stem = strip_datafile_extension(_src.name)
+    _dst = _src.parent / f'{_stem}{datafile_extensions[fmt]}'
+    if _dst == _src:
+        return idx
+
+    # 並列処理している他のプロセスが書き込み途中のファイルを読み込まないように、一時ファイルに保存する
+    _tempfile = _src.parent / f'temp-{_stem}{datafile_extensions[fmt]}'
+    write_datafile(read_datafile(str(_src)), str(_tempfile), fmt)
+    _tempfile.rename(_dst)
+
+    if remove_source == True:
+        _src.unlink()
+
+    return idx
+
+# データ保存ディレクトリの中のpkl.gzファイルを、指定された保存形式にまとめて変換する関数
+def migrate_datafiles(datadir: str = None, datatype: str = None, fmt: str = None, symbol: str = None, remove_source: bool = False) -> None:
+    assert datadir is not None
+    assert datatype is not None
+    assert fmt in datafile_extensions
+    assert fmt != 'compact' or datatype == 'trades', 'compact形式は約定履歴専用です'
+
+    from exercise_core import tqdm_joblib
+
+    _p = Path(f'{datadir}/{datatype}')
+    if symbol is not None:
+        _p = _p / symbol.upper()
+    _list_filenames = sorted([str(_) for _ in _p.glob(f'**/*{datafile_extensions["pickle"]}') if not _.name.startswith(('temp-', 'incomplete-'))])
+
+    print(f'{_p}の{len(_list_filenames)}個のファイルを{fmt}形式に変換します')
+    with tqdm_joblib(total = len(_list_filenames)):
+        joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(migrate_datafile)(_idx, _filename, fmt, remove_source) for _idx, _filename in enumerate(_list_filenames)])
+
+# 引数処理と変換関数の起動部分
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('datatype', choices = ['trades', 'timebar'], help = '変換するデータの種類')
+    parser.add_argument('--format', default = 'parquet', choices = [_ for _ in datafile_extensions.keys() if _ != 'pickle'], help = '変換後の保存形式')
+    parser.add_argument('--symbol', help = '変換する対象の銘柄 例:BTCUSDT (省略時は全銘柄)')
+    parser.add_argument('--datadir', default = 'data/binance', help = 'データ保存ディレクトリ')
+    parser.add_argument('--remove', action = 'store_true', help = '変換後に元のpkl.gzファイルを削除する')
+    args = parser.parse_args()
+
+    migrate_datafiles(args.datadir, args.datatype, args.format, args.symbol, args.remove)
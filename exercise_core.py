@@ -0,0 +1,330 @@
+from pathlib import Path
+import joblib
+import contextlib
+import collections
+import threading
+from tqdm.auto import tqdm
+import numpy as np
+import pandas as pd
+import datetime
+import re
+from datafile_storage import read_datafile, read_timebar_datafile, drop_empty_timebar_rows, deduplicate_datafiles
+from pipeline_metrics import task_metrics
+
+# データファイルの一覧や読み込みなど、ダウンロード・バー生成のスクリプトとjoblibのワーカーが使う関数
+# ワーカーの起動を速くするため、numpyとpandas以外の重いモジュール (matplotlib, arch, scipyなど) はここではimportしない
+# 分析・描画用の関数はexercise_utilにある
+
+target_symbols = {
+    'BTCUSDT': (2019, 9, 8),
+    'ETHUSDT': (2019, 11, 27),
+    'XRPUSDT': (2020, 1, 6),
+    'BNBUSDT': (2020, 2, 10),
+    'ADAUSDT': (2020, 1, 31),
+    'SOLUSDT': (2020, 9, 14),
+    'DOGEUSDT': (2020, 7, 10),
+    'MATICUSDT': (2020, 10, 22),
+    'AVAXUSDT': (2020, 9, 23),
+    '1000SHIBUSDT': (2021, 5, 10),
+    'ATOMUSDT': (2020, 2, 7),
+}
+
+# データ保存ディレクトリの中のデータファイル一覧を返すユーティリティ関数
+def identify_datafiles(datadir: str = None, datatype: str = None, symbol: str = None, interval: int = None, incomplete: bool = False):
+    assert datadir is not None
+    assert datatype is not None
+    assert symbol is not None
+    
+    if interval is None:
+        _p = Path(f'{datadir}/{datatype}/{symbol}')
+    else:
+        _p = Path(f'{datadir}/{datatype}/{symbol}/{interval}')
+    
+    if incomplete == True:
+        _target_pattern = f'incomplete-{symbol}-{datatype}-{interval}sec*'
+        _result_list = [_ for _ in _p.glob(_target_pattern)]
+        _target_pattern = f'temp-{symbol}-{datatype}-*'
+        _result_list = _result_list + [_ for _ in _p.glob(_target_pattern)]
+    else:
+        _target_pattern = f'{symbol}-{datatype}-*'
+        # 同じ日のファイルが複数の保存形式で存在する場合は、優先度の高い形式のものだけを返す
+        _result_list = deduplicate_datafiles([_ for _ in _p.glob(_target_pattern)])
+
+    return sorted(_result_list)
+
+# joblibの並列処理のプログレスバーを表示するためのユーティリティ関数
+# https://blog.ysk.im/x/joblib-with-progress-bar
+@contextlib.contextmanager
+def tqdm_joblib(total: int = None, **kwargs):
+
+    pbar = tqdm(total = total, miniters = 1, smoothing = 0, **kwargs)
+
+    class TqdmBatchCompletionCallback(joblib.parallel.BatchCompletionCallBack):
+        def __call__(self, *args, **kwargs):
+            pbar.update(n = self.batch_size)
+            return super().__call__(*args, **kwargs)
+
+    old_batch_callback = joblib.parallel.BatchCompletionCallBack
+    joblib.parallel.BatchCompletionCallBack = TqdmBatchCompletionCallback
+
+    try:
+        yield pbar
+    finally:
+        joblib.parallel.BatchCompletionCallBack = old_batch_callback
+        pbar.close()
+
+# get_barsで読み込んだ日ごとのタイムバーを保持するキャッシュの上限 [バイト] (デコード後のデータフレームの大きさで数える)
+bar_cache_max_bytes = 512 * 1024 * 1024
+
+# get_barsで、キャッシュにない日をこの日数以上読み込む場合はjoblibで並列に読み込む
+bar_query_parallel_min_days = 8
+
+# 銘柄・時間間隔ごとの日付ごとのタイムバーファイルの索引と、日ごとのタイムバーのLRUキャッシュ
+_partition_indexes = {}
+_bar_cache = collections.OrderedDict()
+_bar_cache_stats = {'bytes': 0, 'hits': 0, 'misses': 0}
+_bar_cache_lock = threading.Lock()
+
+# 銘柄・時間間隔の完成したタイムバーファイルの、日付ごとの索引を返す関数
+# 索引はディレクトリごとに1回だけ作り、ディレクトリの更新時刻が変わった (ファイルが追加・リネームされた) 場合だけ作り直す
+# 戻り値は'dates' (日付の文字列)、'day_starts' (日の始まりの時刻 [ns] のint64配列)、'files'、'mtimes' (ファイルの更新時刻 [ns]) の辞書
+# 同じ名前のファイルをその場で上書きしてもディレクトリの更新時刻は変わらないので、'mtimes'は索引を作った時点の値で、get_barsが読み込むときに確かめ直す
+def get_timebar_partition_index(symbol: str = None, interval: int = None, datadir: str = 'data/binance') -> dict:
+    assert symbol is not None
+    assert interval is not None
+
+    _dir = Path(f'{datadir}/timebar/{symbol}/{interval}')
+    _dir_mtime_ns = _dir.stat().st_mtime_ns if _dir.exists() == True else None
+    _key = (datadir, symbol, interval)
+    _index = _partition_indexes.get(_key)
+    if _index is not None and _index['dir_mtime_ns'] == _dir_mtime_ns:
+        return _index
+
+    _list_dates = []
+    _list_files = []
+    _list_mtimes = []
+    if _dir_mtime_ns is not None:
+        for _filename in identify_datafiles(datadir, 'timebar', symbol, interval):
+            _m = re.match('.*-(\\d{4}-\\d{2}-\\d{2})', _filename.name)
+            _list_dates.append(_m.group(1))
+            _list_files.append(str(_filename))
+            _list_mtimes.append(_filename.stat().st_mtime_ns)
+
+    _index = {
+        'dir_mtime_ns': _dir_mtime_ns,
+        'dates': _list_dates,
+        'day_starts': np.array([pd.Timestamp(_).value for _ in _list_dates], dtype = np.int64),
+        'files': _list_files,
+        'mtimes': _list_mtimes,
+    }
+    _partition_indexes[_key] = _index
+
+    # 書き換えられたり削除されたりしたファイルのキャッシュを捨てる
+    _set_current = set(zip(_list_files, _list_mtimes))
+    with _bar_cache_lock:
+        for _cache_key in [_ for _ in _bar_cache.keys() if Path(_[0]).parent == _dir and _ not in _set_current]:
+            _remove_bar_cache(_cache_key)
+
+    return _index
+
+def _remove_bar_cache(cache_key) -> None:
+    _df, _nbytes = _bar_cache.pop(cache_key)
+    _bar_cache_stats['bytes'] = _bar_cache_stats['bytes'] - _nbytes
+
+# 日ごとのタイムバーをキャッシュに追加し、上限を超えた分を使われていない順に捨てる関数 (_bar_cache_lockを取ってから呼ぶ)
+def _put_bar_cache(cache_key, df: pd.DataFrame) -> None:
+    _nbytes = int(df.memory_usage(index = True, deep = True).sum())
+    if _nbytes > bar_cache_max_bytes or cache_key in _bar_cache:
+        return
+
+    _bar_cache[cache_key] = (df, _nbytes)
+    _bar_cache_stats['bytes'] = _bar_cache_stats['bytes'] + _nbytes
+    while _bar_cache_stats['bytes'] > bar_cache_max_bytes:
+        _remove_bar_cache(next(iter(_bar_cache)))
+
+# get_barsのキャッシュの状態 (エントリ数、バイト数、上限、ヒット数、ミス数) を返す関数
+def get_bar_cache_info() -> dict:
+    with _bar_cache_lock:
+        return dict(entries = len(_bar_cache), max_bytes = bar_cache_max_bytes, **_bar_cache_stats)
+
+def clear_bar_cache() -> None:
+    with _bar_cache_lock:
+        _bar_cache.clear()
+        _bar_cache_stats.update(bytes = 0, hits = 0, misses = 0)
+
+# タイムバーの指定した期間を返す関数 (ノートブックやバックテストで、同じ期間や近い期間を何度も読み込む場合に使う)
+# start_ts, end_tsには時刻 (例:2022-01-01 12:00) かpd.Timestampを指定し、start_ts以上end_ts未満のバーを返す。end_tsに日付だけを指定した場合はその日の終わりまでを返す
+# 日ごとのタイムバーはデコードしたものをLRUキャッシュに保持するので、2回目以降はファイルを読み込まない
+# キャッシュのキーはファイル名と更新時刻なので、ファイルがその場で上書きされた場合は読み込み直す
+# concat_timebar_filesと同じく、すべてが0の行は列を選ぶ前に取り除く
+def get_bars(symbol: str = None, interval: int = None, start_ts = None, end_ts = None, columns: list = None, datadir: str = 'data/binance') -> pd.DataFrame:
+    assert symbol is not None
+    assert interval is not None
+
+    _symbol = symbol.upper()
+    _time_from = pd.Timestamp(start_ts) if start_ts is not None else None
+    _time_to = None
+    if end_ts is not None:
+        if isinstance(end_ts, str) and re.fullmatch('(\\d{4})-(\\d{2})-(\\d{2})', end_ts):
+            _time_to = pd.Timestamp(end_ts) + pd.Timedelta(days = 1)
+        else:
+            _time_to = pd.Timestamp(end_ts)
+
+    # 期間と重なる日を、日の始まりの時刻の二分探索で求める
+    _index = get_timebar_partition_index(_symbol, interval, datadir)
+    _first = 0 if _time_from is None else int(np.searchsorted(_index['day_starts'], (_time_from - pd.Timedelta(days = 1)).value, side = 'right'))
+    _last = len(_index['files']) if _time_to is None else int(np.searchsorted(_index['day_starts'], _time_to.value, side = 'left'))
+
+    # 期間と重なる日のファイルだけ更新時刻を確かめ、上書きされていた場合は索引を更新して古いキャッシュを捨てる
+    _list_keys = []
+    _list_stale_keys = []
+    for _ in range(_first, _last):
+        _mtime_ns = Path(_index['files'][_]).stat().st_mtime_ns
+        if _mtime_ns != _index['mtimes'][_]:
+            _list_stale_keys.append((_index['files'][_], _index['mtimes'][_]))
+            _index['mtimes'][_] = _mtime_ns
+        _list_keys.append((_index['files'][_], _mtime_ns))
+
+    _dict_partitions = {}
+    with _bar_cache_lock:
+        for _key in _list_stale_keys:
+            if _key in _bar_cache:
+                _remove_bar_cache(_key)
+        for _key in _list_keys:
+            if _key in _bar_cache:
+                _bar_cache.move_to_end(_key)
+                _dict_partitions[_key] = _bar_cache[_key][0]
+        _bar_cache_stats['hits'] = _bar_cache_stats['hits'] + len(_dict_partitions)
+        _bar_cache_stats['misses'] = _bar_cache_stats['misses'] + len(_list_keys) - len(_dict_partitions)
+
+    _list_missing = [_ for _ in _list_keys if _ not in _dict_partitions]
+    if len(_list_missing) >= bar_query_parallel_min_days:
+        with tqdm_joblib(total = len(_list_missing)):
+            _list_dfs = joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(read_datafile)(_key[0]) for _key in _list_missing])
+    else:
+        _list_dfs = [read_datafile(_key[0]) for _key in _list_missing]
+    with _bar_cache_lock:
+        for _key, _df in zip(_list_missing, _list_dfs):
+            _dict_partitions[_key] = _df
+            _put_bar_cache(_key, _df)
+
+    # 日ごとのタイムバーを時刻で切り出してから結合する
+    _list_pieces = []
+    for _key in _list_keys:
+        _df = _dict_partitions[_key]
+        _start = 0 if _time_from is None else int(_df.index.searchsorted(_time_from, side = 'left'))
+        _end = len(_df) if _time_to is None else int(_df.index.searchsorted(_time_to, side = 'left'))
+        _list_pieces.append(drop_empty_timebar_rows(_df.iloc[_start:_end], columns))
+
+    if len(_list_pieces) == 0:
+        return pd.DataFrame(columns = columns, index = pd.DatetimeIndex([]))
+
+    return pd.concat(_list_pieces, axis = 0)
+
+# タイムバーファイルをロードしてすべて結合する関数
+# columnsで読み込む列を指定できる。from_str, to_strには日付 (例:2022-01-01) か時刻 (例:2022-01-01 12:00) を指定する
+# to_strに日付だけを指定した場合はその日の終わりまでを読み込む
+def concat_timebar_files(symbol: str = None, interval: int = None, from_str:str = None, to_str:str = None, columns: list = None):
+    assert symbol is not None
+    assert interval is not None
+
+    _time_from = None
+    _time_to = None
+    if from_str is None and to_str is None:
+        _list_trades_file = [str(_) for _ in identify_datafiles('data/binance', 'timebar', symbol, interval)]
+    else:
+        if from_str is None:
+            _dt_cursor = datetime.date(target_symbols[symbol][0], target_symbols[symbol][1], target_symbols[symbol][2])
+        else:
+            _m = re.match('(\d{4})-(\d{2})-(\d{2})', from_str)
+            _year = int(_m.group(1))
+            _month = int(_m.group(2))
+            _day = int(_m.group(3))
+
+            _dt_cursor = datetime.date(year = _year, month = _month, day = _day)
+            _time_from = pd.Timestamp(from_str)
+        
+        if to_str is None:
+            _dt_lastdate = datetime.date.today()
+        else:
+            _m = re.match('(\d{4})-(\d{2})-(\d{2})', to_str)
+            _year = int(_m.group(1))
+            _month = int(_m.group(2))
+            _day = int(_m.group(3))
+
+            _dt_lastdate = datetime.date(year = _year, month = _month, day = _day)
+            if re.fullmatch('(\d{4})-(\d{2})-(\d{2})', to_str):
+                _time_to = pd.Timestamp(_dt_lastdate + datetime.timedelta(days = 1))
+            else:
+                _time_to = pd.Timestamp(to_str)
+    
+        # 期間に含まれる日のファイルを、日付ごとのファイルの索引から選ぶ
+        _index = get_timebar_partition_index(symbol, interval)
+        _list_trades_file = [_filename for _date, _filename in zip(_index['dates'], _index['files']) if _dt_cursor.isoformat() <= _date <= _dt_lastdate.isoformat()]
+    
+    def read_timebar(idx, filename):
+        _df = read_timebar_datafile(filename, columns = columns, time_from = _time_from, time_to = _time_to)
+        return (idx, _df)
+    
+    with task_metrics('concat_timebar_files', f'{symbol} {interval}') as _metrics:
+        with _metrics.phase('read'):
+            with tqdm_joblib(total = len(_list_trades_file)):
+                results = joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(read_timebar)(_idx, _filename) for _idx, _filename in enumerate(_list_trades_file)])
+        for _filename in _list_trades_file:
+            _metrics.add_file_in(_filename)
+
+        with _metrics.phase('compute'):
+            results.sort(key = lambda x: x[0])
+
+            _list_timebar_df = []
+            for _result in results:
+                _list_timebar_df.append(_result[1])
+
+            # すべてが0の行は、列を選ぶ前に読み込んだ日ごとに取り除いている
+            _df = pd.concat(_list_timebar_df, axis = 0)
+        _metrics.add_rows(len(_df))
+
+        return _df
+
+# 情報駆動バー (infobar_generate.pyで生成したティックバー、ボリュームバー、ダラーバー、インバランスバー) のファイルをロードしてすべて結合する関数
+# bar_typeには'tick', 'volume', 'dollar', 'imbalance'、thresholdには生成時のしきい値を指定する
+# バーはバーを閉じた約定の時刻でインデックスされている。from_str, to_strの指定方法はconcat_timebar_filesと同じ
+def concat_infobar_files(symbol: str = None, bar_type: str = None, threshold: float = None, from_str: str = None, to_str: str = None, columns: list = None):
+    assert symbol is not None
+    assert bar_type is not None
+    assert threshold is not None
+
+    _threshold_str = str(int(threshold)) if float(threshold).is_integer() else repr(float(threshold))
+
+    _time_from = pd.Timestamp(from_str) if from_str is not None else None
+    _time_to = None
+    if to_str is not None:
+        if re.fullmatch('(\d{4})-(\d{2})-(\d{2})', to_str):
+            _time_to = pd.Timestamp(to_str) + pd.Timedelta(days = 1)
+        else:
+            _time_to = pd.Timestamp(to_str)
+
+    # ファイルはバーを閉じた日ごとに分かれているので、期間に含まれる日のファイルだけを読み込む
+    _list_infobar_file = []
+    for _filename in identify_datafiles('data/binance', f'{bar_type}bar', symbol, _threshold_str):
+        _m = re.match('.*-(\d{4}-\d{2}-\d{2})', _filename.name)
+        _date = pd.Timestamp(_m.group(1))
+        if _time_from is not None and _date + pd.Timedelta(days = 1) <= _time_from:
+            continue
+        if _time_to is not None and _date >= _time_to:
+            continue
+        _list_infobar_file.append(str(_filename))
+
+    def read_infobar(idx, filename):
+        _df = read_datafile(filename, columns = columns, time_from = _time_from, time_to = _time_to)
+        return (idx, _df)
+
+    with tqdm_joblib(total = len(_list_infobar_file)):
+        results = joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(read_infobar)(_idx, _filename) for _idx, _filename in enumerate(_list_infobar_file)])
+
+    results.sort(key = lambda x: x[0])
+
+    return pd.concat([_result[1] for _result in results], axis = 0)
+
+def load_fng_file():
+    return pd.read_pickle('data/alternativeme/FNG-index-86400sec-0000-00-00.pkl.gz')
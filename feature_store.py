@@ -0,0 +1,339 @@
+import json
+import re
+import argparse
+from pathlib import Path
+import numba as nb
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+from exercise_core import concat_timebar_files, identify_datafiles, target_symbols
+from datafile_storage import read_datafile, write_datafile
+from timebar_generate import read_timebar_manifest
+from atr_backtest import calc_atr
+from trade_size_sketch import TradeSizeHistogram, size_sketch_count_columns, size_sketch_quote_columns
+from pipeline_metrics import task_metrics
+
+datadir = 'data/binance'
+
+# 特徴量ごとのパラメータの既定値 (キャッシュのキーには既定値も含める)
+feature_default_params = {
+    'log_return': {'periods': 1},
+    'ma_deviation': {'window': 24},
+    'rolling_mean': {'column': 'close', 'window': 24},
+    'rolling_std': {'column': 'close', 'window': 24},
+    'rolling_skew': {'column': 'close', 'window': 24},
+    'rolling_kurt': {'column': 'close', 'window': 24},
+    'atr': {'window': 14},
+    'lr_future': {'horizon': 24},
+    'trade_size_quantile': {'percentile': 50, 'window': 1},
+    'large_print_share': {'threshold': 100000, 'window': 1},
+}
+
+# 特徴量の名前とパラメータから、キャッシュのキー (ファイル名) を返す関数 例:rolling_std-column=close-window=168
+def get_feature_key(name: str = None, params: dict = None) -> str:
+    assert name in feature_default_params, f'未対応の特徴量です: {name}'
+
+    _params = get_feature_params(name, params)
+    return name + ''.join([f'-{_key}={_value}' for _key, _value in sorted(_params.items())])
+
+def get_feature_params(name: str = None, params: dict = None) -> dict:
+    _params = dict(feature_default_params[name])
+    for _key, _value in (params or {}).items():
+        assert _key in _params, f'{name}に未対応のパラメータです: {_key}'
+        _params[_key] = _value
+    return _params
+
+# calc_rolling_momentで計算するローリング統計量の番号
+rolling_moment_kinds = {
+    'sum': 0,
+    'mean': 1,
+    'std': 2,
+    'skew': 3,
+    'kurt': 4,
+}
+
+# 窓ごとに値を足し直して、ローリングの合計、平均、標準偏差 (不偏)、歪度、尖度 (超過) をpandasのrollingと同じ定義で計算する関数
+# pandasのrollingは窓をずらしながら値を足し引きするので、結果が計算を始めた行によって丸め誤差の分だけ変わり、延長した特徴量が全体から計算し直したものと一致しない
+# ここでは窓ごとに平均を求めてから偏差でモーメントを計算するので、各行の値はその窓の値だけで決まる (窓にNaNがある行はNaN)
+@nb.njit(cache = True)
+def calc_rolling_moment(values, window, kind):
+    _result = np.empty(values.size)
+    _result[:] = np.nan
+    _n = float(window)
+
+    for i in range(window - 1, values.size):
+        _sum = 0.0
+        _has_nan = False
+        for j in range(i - window + 1, i + 1):
+            if np.isnan(values[j]):
+                _has_nan = True
+                break
+            _sum += values[j]
+        if _has_nan:
+            continue
+        if kind == 0:
+            _result[i] = _sum
+            continue
+        _mean = _sum / _n
+        if kind == 1:
+            _result[i] = _mean
+            continue
+
+        _m2 = 0.0
+        _m3 = 0.0
+        _m4 = 0.0
+        for j in range(i - window + 1, i + 1):
+            _d = values[j] - _mean
+            _m2 += _d * _d
+            _m3 += _d * _d * _d
+            _m4 += _d * _d * _d * _d
+        if kind == 2:
+            if window > 1:
+                _result[i] = np.sqrt(_m2 / (_n - 1.0))
+        elif kind == 3:
+            if window > 2:
+                # 窓の値がすべて同じ場合は、pandasと同じく0にする
+                _result[i] = 0.0 if _m2 == 0.0 else np.sqrt(_n * (_n - 1.0)) * (_m3 / _n) / ((_n - 2.0) * (_m2 / _n) ** 1.5)
+        else:
+            if window > 3:
+                # 窓の値がすべて同じ場合は、pandasと同じく-3にする
+                _result[i] = -3.0 if _m2 == 0.0 else ((_n * _n - 1.0) * (_m4 / _n) / (_m2 / _n) ** 2 - 3.0 * (_n - 1.0) ** 2) / ((_n - 2.0) * (_n - 3.0))
+
+    return _result
+
+# 特徴量のある行を計算するのに必要な、前の行数 (lookback) と後の行数 (lookahead) を返す関数
+# ローリングの特徴量はcalc_rolling_momentで窓ごとに計算するので、lookbackの分だけ前から計算し直せば全体から計算したものと同じ値になる
+# lookbackがNoneの特徴量 (ATR) は前の行の値から漸化式で計算するので、前の行の特徴量の値を使って続きを計算する
+def get_feature_margins(name: str = None, params: dict = None) -> tuple:
+    if name == 'log_return':
+        return (params['periods'], 0)
+    if name == 'lr_future':
+        return (0, params['horizon'])
+    if name == 'atr':
+        return (None, 0)
+    return (params['window'] - 1, 0)
+
+# タイムバーから特徴量を計算する関数
+# df_timebarにはconcat_timebar_filesで読み込んだタイムバー (すべてが0の行を取り除いたもの) を渡す。ウィンドウはバーの本数で数える
+# すべてが0の行の判定が読み込む列によって変わらないように、タイムバーは常にすべての列を読み込む
+# previousには、続きを計算する場合のdf_timebarの最初の行 (漸化式の初期値) の特徴量の値を渡す
+# trade_size_quantile (約定金額の分位点) とlarge_print_share (threshold以上の約定が約定金額に占める割合) は、--size-sketchで生成したタイムバーの
+# 約定金額のヒストグラムをwindow本分足し合わせてから計算する
+def calc_feature(df_timebar: pd.DataFrame = None, name: str = None, params: dict = None, previous: float = None) -> np.ndarray:
+    assert df_timebar is not None
+    assert name is not None
+
+    _params = get_feature_params(name, params)
+
+    if name == 'log_return':
+        return np.log(df_timebar['close']).diff(_params['periods']).values
+    if name == 'lr_future':
+        return (np.log(df_timebar['close'].shift(-_params['horizon'])) - np.log(df_timebar['close'])).values
+    if name == 'ma_deviation':
+        _close = df_timebar['close'].values.astype(np.float64)
+        _ma = calc_rolling_moment(_close, _params['window'], rolling_moment_kinds['mean'])
+        return (_close - _ma) / _ma
+    if name == 'atr':
+        _high = df_timebar['high'].values
+        _low = df_timebar['low'].values
+        _close = df_timebar['close'].values
+        if previous is None:
+            return calc_atr(_high, _low, _close, _params['window'])
+
+        # 前の行のATRを初期値にして、calc_atrと同じWilderの平滑化を続ける
+        _window_size = _params['window']
+        _atr = np.empty(_close.size)
+        _atr[0] = previous
+        if _close.size > 1:
+            _true_range = np.maximum.reduce([_high[1:] - _low[1:], np.abs(_high[1:] - _close[:-1]), np.abs(_low[1:] - _close[:-1])])
+            _atr[1:], _ = lfilter([1.0 / _window_size], [1.0, -(_window_size - 1.0) / _window_size], _true_range, zi = [previous * (_window_size - 1.0) / _window_size])
+        return _atr
+    if name in ('trade_size_quantile', 'large_print_share'):
+        _df_sketch = df_timebar[size_sketch_count_columns + size_sketch_quote_columns]
+        if _params['window'] > 1:
+            _df_sketch = pd.DataFrame({_column: calc_rolling_moment(_df_sketch[_column].values.astype(np.float64), _params['window'], rolling_moment_kinds['sum']) for _column in _df_sketch.columns}, index = _df_sketch.index)
+        _histogram = TradeSizeHistogram.from_dataframe(_df_sketch)
+        if name == 'trade_size_quantile':
+            return _histogram.quantile(_params['percentile'] / 100)
+        return _histogram.large_share(_params['threshold'])
+
+    return calc_rolling_moment(df_timebar[_params['column']].values.astype(np.float64), _params['window'], rolling_moment_kinds[name[len('rolling_'):]])
+
+# 銘柄・時間間隔ごとの特徴量キャッシュのディレクトリを返す関数 (タイムバーと同じくdatadirの下に置く)
+# 特徴量ごとに値のファイル (<キー>.pkl.gz) と、計算に使ったタイムバーの日付ごとの指紋を記録した<キー>.jsonを保存する
+def get_feature_store_dir(symbol: str = None, interval: int = None) -> Path:
+    assert symbol is not None
+    assert interval is not None
+
+    return Path(f'{datadir}/feature/{symbol.upper()}/{interval}')
+
+# 完成したタイムバーファイルの日付ごとの指紋を返す関数
+# タイムバー生成のマニフェストにある日は元の約定履歴ファイルのサイズと更新時刻に最初のOpenと最後のCloseを加えたもの、ない日はタイムバーファイル自体のサイズと更新時刻を使う
+# (前日のタイムバーが作り直されると、約定履歴ファイルは同じでも一日の始まりのOpenが埋め直されるので、最初のOpenも指紋に含める)
+def get_timebar_fingerprints(symbol: str = None, interval: int = None) -> dict:
+    _manifest = read_timebar_manifest(datadir, symbol, interval)
+    _dict_manifest_days = {} if _manifest is None else _manifest['days']
+
+    _dict_fingerprints = {}
+    for _filename in identify_datafiles(datadir, 'timebar', symbol.upper(), interval):
+        _m = re.match('.*-(\\d{4}-\\d{2}-\\d{2})', _filename.name)
+        _date = _m.group(1)
+        _entry = _dict_manifest_days.get(_date)
+        if _entry is not None and _entry['complete'] == True and Path(_entry['timebar_file']).name == _filename.name:
+            _dict_fingerprints[_date] = [_filename.name, _entry['trades_size'], _entry['trades_mtime_ns'], _entry['first_open'], _entry['last_close']]
+        else:
+            _stat = _filename.stat()
+            _dict_fingerprints[_date] = [_filename.name, _stat.st_size, _stat.st_mtime_ns]
+
+    return _dict_fingerprints
+
+def read_feature_meta(store_dir: Path = None, key: str = None) -> dict:
+    _meta_file = Path(store_dir) / f'{key}.json'
+    if _meta_file.exists() == False:
+        return None
+    with open(_meta_file, 'r') as _f:
+        return json.load(_f)
+
+# 特徴量の値とメタデータを保存する関数
+# メタデータの書き換えがキャッシュ更新の確定になるので、値のファイルを書いてからメタデータを一時ファイル経由で書き換える
+def write_feature(store_dir: Path = None, key: str = None, series: pd.Series = None, meta: dict = None) -> None:
+    Path(store_dir).mkdir(parents = True, exist_ok = True)
+
+    _meta_file = Path(store_dir) / f'{key}.json'
+    _meta_file.unlink(missing_ok = True)
+
+    _tempfile = Path(store_dir) / f'temp-{key}.pkl.gz'
+    write_datafile(series.to_frame('value'), str(_tempfile), 'pickle')
+    _tempfile.rename(Path(store_dir) / f'{key}.pkl.gz')
+
+    _tempfile = Path(store_dir) / f'temp-{key}.json'
+    with open(_tempfile, 'w') as _f:
+        json.dump(meta, _f, indent = 1, sort_keys = True)
+    _tempfile.rename(_meta_file)
+
+# 保存済みの特徴量を、新しい日の分だけ延長できるかどうかを判定する関数
+# 保存済みのすべての日の指紋が変わっておらず、増えた日がすべて保存済みの最後の日より後の場合だけ延長する
+def is_feature_extendable(meta: dict = None, dict_fingerprints: dict = None) -> bool:
+    if meta is None:
+        return False
+
+    _dict_stored = meta['days']
+    if len(_dict_stored) == 0:
+        return False
+    for _date, _fingerprint in _dict_stored.items():
+        if dict_fingerprints.get(_date) != _fingerprint:
+            return False
+    _last_stored_date = max(_dict_stored.keys())
+    return all([_ > _last_stored_date for _ in dict_fingerprints.keys() if _ not in _dict_stored])
+
+# 保存済みの特徴量に、増えた日の分を計算して継ぎ足す関数
+# lookbackとlookaheadの分だけ前の行からタイムバーを読み込み、値が変わりうる末尾の行から後だけを計算し直す
+# 延長できない場合 (前の行が足りない、漸化式の初期値がない、タイムバーが保存済みの値と揃わない) はNoneを返す
+def extend_feature(series: pd.Series = None, name: str = None, params: dict = None, symbol: str = None, interval: int = None, dict_timebars: dict = None) -> pd.Series:
+    _lookback, _lookahead = get_feature_margins(name, params)
+    _length = len(series)
+
+    _recalc_start = _length - _lookahead
+    _read_start = _recalc_start - (1 if _lookback is None else _lookback)
+    if _read_start <= 0:
+        return None
+    _previous = None
+    if _lookback is None:
+        _previous = series.values[_read_start]
+        if np.isnan(_previous) == True:
+            return None
+
+    # 同じ開始時刻のタイムバーは特徴量の間で使い回す
+    _time_from = series.index[_read_start]
+    _df_timebar = dict_timebars.get(_time_from)
+    if _df_timebar is None:
+        _df_timebar = concat_timebar_files(symbol, interval, str(_time_from))
+        dict_timebars[_time_from] = _df_timebar
+    if _df_timebar.index[:_length - _read_start].equals(series.index[_read_start:]) == False:
+        return None
+
+    _values = calc_feature(_df_timebar, name, params, _previous)
+    return pd.concat([series.iloc[:_recalc_start], pd.Series(_values[_recalc_start - _read_start:], index = _df_timebar.index[_recalc_start - _read_start:])])
+
+# 銘柄・時間間隔のタイムバーから複数の特徴量を読み込む関数 (キャッシュがなければ計算して保存する)
+# featuresには特徴量の名前か、(名前, パラメータの辞書) のリストを渡す 例:['log_return', ('rolling_std', {'window': 168}), ('lr_future', {'horizon': 24})]
+# キャッシュはタイムバー生成のマニフェストで検証し、過去の日のタイムバーが作り直されていたら計算し直し、新しい日が増えただけなら末尾だけを計算して延長する
+# 戻り値は特徴量のキーを列名にしたデータフレーム (インデックスはconcat_timebar_filesと同じ)
+def load_features(symbol: str = None, interval: int = None, features: list = None) -> pd.DataFrame:
+    assert symbol is not None
+    assert interval is not None
+    assert features is not None
+
+    _symbol = symbol.upper()
+    _store_dir = get_feature_store_dir(_symbol, interval)
+    _dict_fingerprints = get_timebar_fingerprints(_symbol, interval)
+
+    _list_series = []
+    _df_timebar = None
+    _dict_timebars = {}
+    with task_metrics('load_features', f'{_symbol} {interval}') as _metrics:
+        for _feature in features:
+            _name, _params = (_feature, {}) if isinstance(_feature, str) else _feature
+            _params = get_feature_params(_name, _params)
+            _key = get_feature_key(_name, _params)
+
+            _meta = read_feature_meta(_store_dir, _key)
+            _series = None
+            if is_feature_extendable(_meta, _dict_fingerprints) == True:
+                with _metrics.phase('read'):
+                    _series = read_datafile(str(_store_dir / f'{_key}.pkl.gz'))['value']
+                if len(_meta['days']) < len(_dict_fingerprints):
+                    with _metrics.phase('compute'):
+                        _series = extend_feature(_series, _name, _params, _symbol, interval, _dict_timebars)
+                    if _series is not None:
+                        print(f'{_symbol}の{interval}秒タイムバーの特徴量{_key}を{len(_dict_fingerprints) - len(_meta["days"])}日分延長します')
+                        with _metrics.phase('serialize'):
+                            write_feature(_store_dir, _key, _series, {'days': _dict_fingerprints})
+
+            if _series is None:
+                # すべての日のタイムバーから計算し直す (タイムバーは特徴量の間で1回だけ読み込む)
+                print(f'{_symbol}の{interval}秒タイムバーの特徴量{_key}を計算します')
+                if _df_timebar is None:
+                    with _metrics.phase('read'):
+                        _df_timebar = concat_timebar_files(_symbol, interval)
+                with _metrics.phase('compute'):
+                    _series = pd.Series(calc_feature(_df_timebar, _name, _params), index = _df_timebar.index)
+                with _metrics.phase('serialize'):
+                    write_feature(_store_dir, _key, _series, {'days': _dict_fingerprints})
+
+            _list_series.append(_series.rename(_key))
+            _metrics.add_rows(len(_series))
+
+    return pd.concat(_list_series, axis = 1)
+
+# 1つの特徴量を読み込む関数 例:load_feature('BTCUSDT', 3600, 'rolling_std', window = 168)
+def load_feature(symbol: str = None, interval: int = None, name: str = None, **params) -> pd.Series:
+    assert name is not None
+
+    return load_features(symbol, interval, [(name, params)]).iloc[:, 0]
+
+# コマンドラインの特徴量の指定 (名前:パラメータ=値,パラメータ=値) を (名前, パラメータの辞書) にする関数 例:rolling_std:window=168
+def parse_feature_argument(argument: str = None) -> tuple:
+    _name, _, _params_str = argument.partition(':')
+    _params = {}
+    for _item in [_ for _ in _params_str.split(',') if _ != '']:
+        _key, _value = _item.split('=')
+        _params[_key] = int(_value) if re.fullmatch('-?\\d+', _value) else _value
+    return (_name, _params)
+
+# 引数処理と特徴量の計算の起動部分
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--symbol', help = '特徴量を計算する対象の銘柄 例:BTCUSDT')
+    parser.add_argument('interval', type = int, help = '特徴量を計算するタイムバーの時間間隔 [秒] 例:3600')
+    parser.add_argument('feature', nargs = '+', help = f'計算する特徴量 (名前:パラメータ=値,...) 例:log_return rolling_std:window=168 lr_future:horizon=24 ({", ".join(feature_default_params.keys())})')
+    args = parser.parse_args()
+
+    if args.symbol:
+        _list_symbols = [args.symbol]
+    else:
+        _list_symbols = list(target_symbols.keys())
+
+    _list_features = [parse_feature_argument(_) for _ in args.feature]
+    for _symbol in _list_symbols:
+        load_features(_symbol, args.interval, _list_features)
@@ -0,0 +1,227 @@
+import pandas as pd
+import numpy as np
+import json
+import shutil
+from pathlib import Path
+import joblib
+import numba as nb
+import re
+from exercise_core import tqdm_joblib, identify_datafiles
+from datafile_storage import datafile_extensions, get_dataset_format, read_datafile, write_datafile
+from timebar_generate import calc_group_statistics, rollup_bin_statistics, build_timebar_dataframe, nan_to_none
+
+# 情報駆動バーの種類と、しきい値と比較する約定ごとの量
+# tick: 約定回数、volume: 約定数量 (qty)、dollar: 約定金額 (quote_qty)、imbalance: 買いなら+1、売りなら-1の符号の累積の絶対値
+infobar_types = ['tick', 'volume', 'dollar', 'imbalance']
+
+# 1回の並列読み込みでまとめて処理する日数
+infobar_chunk_days = 8
+
+# 約定ごとの量の累積がしきい値を超えた約定でバーを閉じる関数
+# carryには前日から持ち越した、まだ閉じていないバーの累積量を渡す
+# 戻り値は (約定ごとにその約定でバーが閉じたかどうかの配列, 翌日に持ち越す累積量)
+def calc_infobar_closes(amounts: np.ndarray = None, threshold: float = None, carry: float = 0.0, bar_type: str = None):
+    assert amounts is not None
+    assert threshold is not None and threshold > 0
+    assert bar_type in infobar_types
+
+    if amounts.size == 0:
+        return (np.zeros(0, dtype = bool), carry)
+
+    if bar_type != 'imbalance':
+        # 累積量がしきい値の倍数をまたいだ約定でバーを閉じる (超過分は次のバーに繰り越す) ので、累積和だけでベクトル化できる
+        _cumsum = carry + np.cumsum(amounts, dtype = float)
+        _level = np.floor(_cumsum / threshold)
+        _closes = _level > np.r_[np.floor(carry / threshold), _level[:-1]]
+        return (_closes, float(_cumsum[-1] - _level[-1] * threshold))
+
+    # インバランスバーはバーを閉じるたびに累積を0に戻すので、累積和ではベクトル化できず、約定ごとのループをnumbaでコンパイルして実行する
+    _closes, _carry = calc_imbalance_closes(amounts.astype(np.float64), float(threshold), float(carry))
+    return (_closes, float(_carry))
+
+# インバランスバーの符号の累積がしきい値に届いた約定でバーを閉じ、累積を0に戻す関数
+# 戻り値は (約定ごとにその約定でバーが閉じたかどうかの配列, 翌日に持ち越す累積)
+@nb.njit(cache = True)
+def calc_imbalance_closes(amounts, threshold, carry):
+    _closes = np.zeros(amounts.size, dtype = np.bool_)
+    _imbalance = carry
+    for _i in range(amounts.size):
+        _imbalance = _imbalance + amounts[_i]
+        if abs(_imbalance) >= threshold:
+            _closes[_i] = True
+            _imbalance = 0.0
+    return (_closes, _imbalance)
+
+# バーの種類に応じて、約定ごとにしきい値と比較する量を返す関数
+def calc_infobar_amounts(dict_trades: dict = None, bar_type: str = None) -> np.ndarray:
+    assert dict_trades is not None
+    assert bar_type in infobar_types
+
+    if bar_type == 'tick':
+        return np.ones(dict_trades['price'].size)
+    elif bar_type == 'volume':
+        return dict_trades['qty']
+    elif bar_type == 'dollar':
+        return dict_trades['quote_qty']
+    else:
+        return np.where(dict_trades['is_buy'], 1, -1)
+
+# 約定履歴ファイルを1日分読み込み、時刻順に並べた配列の辞書を返す関数
+def read_trades_for_infobar(idx, filename):
+    _df = read_datafile(filename, columns = ['price', 'qty', 'quote_qty', 'time', 'is_buyer_maker'])
+
+    _dict_trades = {
+        'time': _df['time'].values.astype('datetime64[ns]').astype(np.int64),
+        'price': _df['price'].values.astype(float),
+        'qty': _df['qty'].values.astype(float),
+        'quote_qty': _df['quote_qty'].values.astype(float),
+        'is_buy': (_df['is_buyer_maker'].values == False),
+    }
+    del _df
+
+    # 時刻順に並んでいない場合は、OHLCのために安定ソートしておく
+    _time = _dict_trades['time']
+    if _time.size > 1 and np.any(_time[1:] < _time[:-1]):
+        _order = np.argsort(_time, kind = 'stable')
+        _dict_trades = {_key: _array[_order] for _key, _array in _dict_trades.items()}
+
+    return (idx, _dict_trades)
+
+# 1日分の約定から、その日に閉じたバーのデータフレームと、閉じていないバーの統計量と累積量を返す関数
+# partial_statisticsには前日から持ち越した閉じていないバーの統計量 (1本分) を渡すと、その日の最初のバーにまとめる
+# バーのインデックスはバーを閉じた約定の時刻
+def calc_infobar_from_trades(dict_trades: dict = None, bar_type: str = None, threshold: float = None, carry: float = 0.0, partial_statistics: dict = None):
+    assert dict_trades is not None
+
+    _closes, _carry = calc_infobar_closes(calc_infobar_amounts(dict_trades, bar_type), threshold, carry, bar_type)
+
+    # 約定ごとのバーのインデックスは、その約定より前に閉じたバーの数
+    _num_closed = int(_closes.sum())
+    _group = np.cumsum(_closes) - _closes
+    _dict_statistics = calc_group_statistics(_group, dict_trades['price'], dict_trades['quote_qty'], dict_trades['is_buy'], _num_closed + 1)
+
+    # 前日から持ち越したバーの統計量を最初のバーに合成する (2本を1本に集約するのと同じ計算になる)
+    if partial_statistics is not None:
+        _dict_pair = {_key: np.r_[partial_statistics[_key], _array[:1]] for _key, _array in _dict_statistics.items()}
+        _dict_merged = rollup_bin_statistics(_dict_pair, 2)
+        for _key in _dict_statistics.keys():
+            _dict_statistics[_key] = np.r_[_dict_merged[_key], _dict_statistics[_key][1:]].astype(_dict_statistics[_key].dtype)
+
+    _dict_closed = {_key: _array[:_num_closed] for _key, _array in _dict_statistics.items()}
+    _dict_partial = {_key: _array[_num_closed:] for _key, _array in _dict_statistics.items()}
+
+    _index = pd.DatetimeIndex(dict_trades['time'][_closes].view('datetime64[ns]'))
+    _df_infobar = build_timebar_dataframe(_dict_closed, _index)
+
+    return (_df_infobar, _dict_partial, _carry)
+
+# しきい値をディレクトリ名とファイル名に使う文字列に変換する関数 (整数なら小数点をつけない)
+def format_infobar_threshold(threshold: float = None) -> str:
+    assert threshold is not None
+
+    if float(threshold).is_integer():
+        return str(int(threshold))
+    return repr(float(threshold))
+
+# 銘柄・バーの種類・しきい値ごとの情報駆動バーのディレクトリを返す関数
+def get_infobar_dir(datadir: str = None, symbol: str = None, bar_type: str = None, threshold: float = None) -> Path:
+    assert datadir is not None
+    assert symbol is not None
+    assert bar_type in infobar_types
+
+    return Path(f'{datadir}/{bar_type}bar/{symbol.upper()}/{format_infobar_threshold(threshold)}')
+
+# 生成の状態ファイルを読み込む関数
+# 状態ファイルには処理済みの日ごとの約定履歴ファイルのサイズと更新時刻と、最後に処理した日の時点で閉じていないバーの統計量と累積量を記録する
+def read_infobar_state(infobar_dir: Path = None) -> dict:
+    assert infobar_dir is not None
+
+    _state_file = Path(infobar_dir) / 'state.json'
+    if _state_file.exists() == False:
+        return None
+    with open(_state_file, 'r') as _f:
+        return json.load(_f)
+
+def write_infobar_state(infobar_dir: Path = None, state: dict = None) -> None:
+    assert infobar_dir is not None
+    assert state is not None
+
+    # 書き込み途中の状態ファイルが残らないように、一時ファイルに書いてからリネームする
+    _tempfile = Path(infobar_dir) / 'temp-state.json'
+    with open(_tempfile, 'w') as _f:
+        json.dump(state, _f, indent = 1, sort_keys = True)
+    _tempfile.rename(Path(infobar_dir) / 'state.json')
+
+# 約定履歴ファイルから情報駆動バー (ティックバー、ボリュームバー、ダラーバー、インバランスバー) のファイルを生成する関数
+# バーは日をまたいで続くので、閉じていないバーの統計量と累積量を翌日に持ち越し、バーを閉じた日のファイルに保存する
+# 状態ファイルで処理済みの日を管理し、最後に処理した日より後の日だけを追加で生成する
+# 処理済みの日の約定履歴ファイルが変更されていたり、最後に処理した日より前の日が増えていたら最初から生成し直す
+def generate_infobar_files(datadir: str = None, symbol: str = None, bar_type: str = None, threshold: float = None, fmt: str = None):
+    assert datadir is not None
+    assert symbol is not None
+    assert bar_type in infobar_types
+    assert threshold is not None and threshold > 0
+
+    _symbol = symbol.upper()
+    _fmt = get_dataset_format('timebar', fmt)
+    _ext = datafile_extensions[_fmt]
+    _threshold_str = format_infobar_threshold(threshold)
+    _infobar_dir = get_infobar_dir(datadir, _symbol, bar_type, threshold)
+
+    # 約定履歴ファイルの一覧を日付ごとに作り、サイズと更新時刻を記録する
+    _dict_trades_files = {}
+    for _trades_file in identify_datafiles(datadir, 'trades', _symbol):
+        _m = re.match('.*-(\\d{4}-\\d{2}-\\d{2})', _trades_file.name)
+        _stat = _trades_file.stat()
+        _dict_trades_files[_m.group(1)] = (str(_trades_file), _stat.st_size, _stat.st_mtime_ns)
+    _list_dates = sorted(_dict_trades_files.keys())
+
+    _state = read_infobar_state(_infobar_dir)
+    if _state is not None:
+        _dict_done = _state['days']
+        for _date, _entry in _dict_done.items():
+            if _date not in _dict_trades_files or tuple(_dict_trades_files[_date][1:]) != (_entry['trades_size'], _entry['trades_mtime_ns']):
+                _state = None
+                break
+        if _state is not None and any([_ < _state['last_date'] and _ not in _dict_done for _ in _list_dates]):
+            _state = None
+
+    if _state is None:
+        shutil.rmtree(_infobar_dir, ignore_errors = True)
+        _state = {'days': {}, 'last_date': '', 'carry': 0.0, 'partial': None}
+    _infobar_dir.mkdir(parents = True, exist_ok = True)
+
+    _carry = _state['carry']
+    _dict_partial = None
+    if _state['partial'] is not None:
+        _dict_partial = {_key: np.array([np.nan if _value is None else _value]) for _key, _value in _state['partial'].items()}
+        for _key in ['buy_trade_count', 'sell_trade_count']:
+            _dict_partial[_key] = _dict_partial[_key].astype(np.int64)
+
+    _list_new_dates = [_ for _ in _list_dates if _ > _state['last_date']]
+    print(f'{_symbol}の{bar_type}バー (しきい値 {_threshold_str}) を{len(_list_new_dates)}日分の約定履歴から生成します')
+
+    # 約定履歴ファイルの読み込みは並列に行い、バーの区切りは日付順に1日ずつ求める
+    with tqdm_joblib(total = len(_list_new_dates)):
+        for _chunk_start in range(0, len(_list_new_dates), infobar_chunk_days):
+            _list_chunk_dates = _list_new_dates[_chunk_start:_chunk_start + infobar_chunk_days]
+            results = joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(read_trades_for_infobar)(_idx, _dict_trades_files[_date][0]) for _idx, _date in enumerate(_list_chunk_dates)])
+            results.sort(key = lambda x: x[0])
+
+            for (_idx, _dict_trades), _date in zip(results, _list_chunk_dates):
+                _df_infobar, _dict_partial, _carry = calc_infobar_from_trades(_dict_trades, bar_type, threshold, _carry, _dict_partial)
+
+                # 並列処理している他のプロセスが書き込み途中のファイルを読み込まないように、一時ファイルに保存する
+                _filename = _infobar_dir / f'{_symbol}-{bar_type}bar-{_threshold_str}-{_date}{_ext}'
+                _tempfile = _infobar_dir / f'temp-{_filename.name}'
+                write_datafile(_df_infobar, str(_tempfile), _fmt)
+                _tempfile.rename(_filename)
+
+                _trades_file, _trades_size, _trades_mtime_ns = _dict_trades_files[_date]
+                _state['days'][_date] = {'trades_size': _trades_size, 'trades_mtime_ns': _trades_mtime_ns}
+                _state['last_date'] = _date
+
+            _state['carry'] = _carry
+            _state['partial'] = None if _dict_partial is None else {_key: nan_to_none(_array[0].item()) for _key, _array in _dict_partial.items()}
+            write_infobar_state(_infobar_dir, _state)
+
@@ -0,0 +1,224 @@
+import json
+import re
+import shutil
+import datetime
+import argparse
+from pathlib import Path
+import joblib
+import numpy as np
+import pandas as pd
+from exercise_core import tqdm_joblib, identify_datafiles, target_symbols
+from datafile_storage import read_datafile
+
+datadir = 'data/binance'
+
+# 約定プロファイルの価格方向の解像度。最低価格0.1USDTから最大価格1M USDTまで、logspaceでこの数だけ分割する
+profile_num_columns = 4096
+profile_price_min = 0.1
+profile_price_max = 1_000_000.0
+
+# 価格を分割したbinの境界値を返す関数 (orderflow_profile_exercise.ipynbのbin_edgesと同じ)
+def get_profile_bin_edges(num_columns: int = profile_num_columns) -> np.ndarray:
+    return np.logspace(np.log10(profile_price_min), np.log10(profile_price_max), num_columns)
+
+# 価格が属する価格帯のインデックスを返す関数
+# 境界値はlogspaceで等間隔なので、np.digitizeで二分探索する代わりに対数から直接インデックスを求める
+# 価格帯cはbin_edges[c]以上bin_edges[c+1]未満の価格で、範囲外の価格は両端の価格帯に入れる
+def calc_profile_column(price: np.ndarray = None, num_columns: int = profile_num_columns) -> np.ndarray:
+    assert price is not None
+
+    _log_min = np.log10(profile_price_min)
+    _log_step = (np.log10(profile_price_max) - _log_min) / (num_columns - 1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        _column = np.floor((np.log10(price) - _log_min) / _log_step)
+    _column = np.clip(np.nan_to_num(_column, nan = 0.0, neginf = 0.0), 0, num_columns - 1).astype(np.int64)
+
+    # 境界値ちょうどの価格で丸め誤差により隣の価格帯に入るのを防ぐため、境界値と比べて1つだけ補正する
+    _bin_edges = get_profile_bin_edges(num_columns)
+    _column = _column - ((price < _bin_edges[_column]) & (_column > 0))
+    _column = _column + ((_column < num_columns - 1) & (price >= _bin_edges[np.minimum(_column + 1, num_columns - 1)]))
+
+    return _column
+
+# 銘柄・一日あたりの行数ごとの約定プロファイルのディレクトリを返す関数
+# プロファイルは (日数 x 一日あたりの行数) 行 x 価格帯の列のfloat64の行列 (profile.bin) と、
+# 最初の日付、行数、取り込み済みの日ごとの約定履歴ファイルのサイズと更新時刻を記録したmeta.jsonからなる
+# 行は最初の日付からの暦日順に並べ、約定履歴ファイルのない日の行は0のままにする
+def get_trades_profile_dir(datadir: str = None, symbol: str = None, rows_per_day: int = 1) -> Path:
+    assert datadir is not None
+    assert symbol is not None
+
+    return Path(f'{datadir}/trades_profile/{symbol.upper()}/{rows_per_day}')
+
+def read_trades_profile_meta(profile_dir: Path = None) -> dict:
+    assert profile_dir is not None
+
+    _meta_file = Path(profile_dir) / 'meta.json'
+    if _meta_file.exists() == False:
+        return None
+    with open(_meta_file, 'r') as _f:
+        return json.load(_f)
+
+def write_trades_profile_meta(profile_dir: Path = None, meta: dict = None) -> None:
+    assert profile_dir is not None
+    assert meta is not None
+
+    # meta.jsonの書き換えがプロファイル更新の確定になるので、一時ファイルに書いてからリネームする
+    _tempfile = Path(profile_dir) / 'temp-meta.json'
+    with open(_tempfile, 'w') as _f:
+        json.dump(meta, _f, indent = 1, sort_keys = True)
+    _tempfile.rename(Path(profile_dir) / 'meta.json')
+
+# 一日分の約定履歴ファイルを入力として、一日をrows_per_day個の時間帯に分け、それぞれの時間帯で価格帯ごとに何USDTの約定があったかを求め、
+# プロファイルの行列ファイルの該当する行に直接書き込む関数
+def calc_trades_profile_rows(idx, filename, profile_file, row_offset, num_rows, rows_per_day, num_columns):
+    _df = read_datafile(filename, columns = ['price', 'quote_qty', 'time'])
+
+    _time = _df['time'].values.astype('datetime64[ns]').astype(np.int64)
+    _day_start = pd.Timestamp(re.match('.*-(\\d{4}-\\d{2}-\\d{2})', Path(filename).name).group(1)).value
+    _row = np.clip((_time - _day_start) // (86400 * 1_000_000_000 // rows_per_day), 0, rows_per_day - 1)
+    _column = calc_profile_column(_df['price'].values.astype(float), num_columns)
+
+    # (時間帯, 価格帯) の組を1次元のインデックスにして、1回のbincountで集計する
+    _rows = np.bincount(_row * num_columns + _column, weights = _df['quote_qty'].values.astype(float), minlength = rows_per_day * num_columns)
+    del _df
+
+    _profile = np.memmap(profile_file, dtype = np.float64, mode = 'r+', shape = (num_rows, num_columns))
+    _profile[row_offset:row_offset + rows_per_day, :] = _rows.reshape(rows_per_day, num_columns)
+    _profile.flush()
+    del _profile
+
+    return idx
+
+# 全コア数-2個のコアで並列処理を行い、約定履歴ファイルから約定プロファイルの行列ファイルを作成・更新する関数
+# 取り込み済みの日はmeta.jsonで管理し、新しい日と約定履歴ファイルが変更された日の行だけを計算する
+# 取り込み済みの最初の日より前の日が増えていた場合と、価格帯の数が変わった場合は作り直す
+def generate_trades_profile(datadir: str = None, symbol: str = None, rows_per_day: int = 1, num_columns: int = profile_num_columns) -> None:
+    assert datadir is not None
+    assert symbol is not None
+    assert rows_per_day > 0 and 86400 % rows_per_day == 0
+
+    _symbol = symbol.upper()
+    _profile_dir = get_trades_profile_dir(datadir, _symbol, rows_per_day)
+    _profile_file = _profile_dir / 'profile.bin'
+
+    _dict_trades_files = {}
+    for _trades_file in identify_datafiles(datadir, 'trades', _symbol):
+        _m = re.match('.*-(\\d{4}-\\d{2}-\\d{2})', _trades_file.name)
+        _stat = _trades_file.stat()
+        _dict_trades_files[_m.group(1)] = (str(_trades_file), _stat.st_size, _stat.st_mtime_ns)
+    _list_dates = sorted(_dict_trades_files.keys())
+    if len(_list_dates) == 0:
+        return
+
+    _meta = read_trades_profile_meta(_profile_dir)
+    if _meta is not None and (_meta['num_columns'] != num_columns or _list_dates[0] < _meta['first_date']):
+        _meta = None
+    if _meta is None:
+        shutil.rmtree(_profile_dir, ignore_errors = True)
+        _meta = {'first_date': _list_dates[0], 'num_rows': 0, 'num_columns': num_columns, 'rows_per_day': rows_per_day, 'days': {}}
+    _profile_dir.mkdir(parents = True, exist_ok = True)
+
+    # 最後の日までの行数に行列ファイルを広げる (増えた行は0で埋められる)
+    _first_date = datetime.date.fromisoformat(_meta['first_date'])
+    _num_rows = ((datetime.date.fromisoformat(_list_dates[-1]) - _first_date).days + 1) * rows_per_day
+    _num_rows = max(_num_rows, _meta['num_rows'])
+    with open(_profile_file, 'ab') as _f:
+        _f.truncate(_num_rows * num_columns * np.dtype(np.float64).itemsize)
+
+    # 削除された約定履歴ファイルの日の行は0に戻す
+    _profile = np.memmap(_profile_file, dtype = np.float64, mode = 'r+', shape = (_num_rows, num_columns))
+    for _date in [_ for _ in _meta['days'].keys() if _ not in _dict_trades_files]:
+        _row_offset = (datetime.date.fromisoformat(_date) - _first_date).days * rows_per_day
+        _profile[_row_offset:_row_offset + rows_per_day, :] = 0.0
+        del _meta['days'][_date]
+    _profile.flush()
+    del _profile
+
+    _list_targets = []
+    for _date in _list_dates:
+        _trades_file, _trades_size, _trades_mtime_ns = _dict_trades_files[_date]
+        if _meta['days'].get(_date) == [_trades_size, _trades_mtime_ns]:
+            continue
+        _row_offset = (datetime.date.fromisoformat(_date) - _first_date).days * rows_per_day
+        _list_targets.append((_date, _trades_file, _row_offset))
+
+    print(f'{_symbol}の約定プロファイル (一日{rows_per_day}行) を{len(_list_targets)}日分の約定履歴から計算します')
+    with tqdm_joblib(total = len(_list_targets)):
+        joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(calc_trades_profile_rows)(_idx, _trades_file, str(_profile_file), _row_offset, _num_rows, rows_per_day, num_columns) for _idx, (_date, _trades_file, _row_offset) in enumerate(_list_targets)])
+
+    for _date, _trades_file, _row_offset in _list_targets:
+        _meta['days'][_date] = list(_dict_trades_files[_date][1:])
+    _meta['num_rows'] = _num_rows
+    write_trades_profile_meta(_profile_dir, _meta)
+
+# 約定プロファイルの行列ファイルをメモリマップで開き、指定された期間の行と各行の開始時刻を返す関数
+# from_str, to_strには日付 (例:2022-01-01) か時刻 (例:2022-01-01 12:00) を指定する。to_strに日付だけを指定した場合はその日の終わりまでを返す
+# normalize = Trueの場合は、ノートブックと同じく各行をその行の約定金額の合計で割った割合を返す (この場合はコピーになる)
+# 返される行列は読み込み専用のメモリマップなので、書き換える場合はコピーすること
+def load_trades_profile(symbol: str = None, rows_per_day: int = 1, from_str: str = None, to_str: str = None, normalize: bool = False, datadir: str = 'data/binance'):
+    assert symbol is not None
+
+    _profile_dir = get_trades_profile_dir(datadir, symbol, rows_per_day)
+    _meta = read_trades_profile_meta(_profile_dir)
+    assert _meta is not None, f'{_profile_dir}に約定プロファイルがありません。先にgenerate_trades_profileを実行してください'
+
+    _num_rows = _meta['num_rows']
+    _index = pd.date_range(_meta['first_date'], periods = _num_rows, freq = f'{86400 // rows_per_day}S')
+    _profile = np.memmap(_profile_dir / 'profile.bin', dtype = np.float64, mode = 'r', shape = (_num_rows, _meta['num_columns']))
+
+    _start = 0
+    _end = _num_rows
+    if from_str is not None:
+        _start = int(_index.searchsorted(pd.Timestamp(from_str), side = 'left'))
+    if to_str is not None:
+        if re.fullmatch('(\\d{4})-(\\d{2})-(\\d{2})', to_str):
+            _time_to = pd.Timestamp(to_str) + pd.Timedelta(days = 1)
+        else:
+            _time_to = pd.Timestamp(to_str)
+        _end = int(_index.searchsorted(_time_to, side = 'left'))
+
+    _profile = _profile[_start:_end]
+    if normalize == True:
+        _sum = _profile.sum(axis = 1, keepdims = True)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            _profile = np.where(_sum > 0, _profile / _sum, 0.0)
+
+    return (_profile, _index[_start:_end])
+
+# 約定プロファイルの直近window行の和を、行方向の累積和の差から求める関数
+# sliding_window_viewで (行数 x window x 価格帯) のビューを作って足す代わりに、行数 x 価格帯の計算量で求める
+# ノートブックと同じく、最初のwindow - 1行は0にして元の行列と同じ行数の行列を返す
+def calc_rolling_profile(profile: np.ndarray = None, window: int = None) -> np.ndarray:
+    assert profile is not None
+    assert window is not None and window > 0
+
+    _cumsum = np.zeros((profile.shape[0] + 1, profile.shape[1]))
+    np.cumsum(profile, axis = 0, out = _cumsum[1:])
+
+    _rolling = np.zeros(profile.shape)
+    if profile.shape[0] >= window:
+        _rolling[window - 1:] = _cumsum[window:] - _cumsum[:-window]
+        # 累積和の差による丸め誤差で、約定がなかった価格帯がわずかに負やゼロでない値にならないようにする
+        _rolling[window - 1:] = np.where(_rolling[window - 1:] < np.abs(_cumsum[window:]) * 1e-12, 0.0, _rolling[window - 1:])
+
+    return _rolling
+
+# 引数処理と約定プロファイル作成関数の起動部分
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--symbol', help = '約定プロファイルを作成する対象の銘柄 例:BTCUSDT')
+    parser.add_argument('--rows-per-day', type = int, default = 1, help = '一日あたりの行数 (時間方向の解像度) 例:24 (1時間ごと)')
+    args = parser.parse_args()
+
+    if 86400 % args.rows_per_day != 0:
+        print('rows-per-day は 86400 の約数を指定してください')
+        exit(0)
+
+    if args.symbol:
+        _list_symbols = [args.symbol]
+    else:
+        _list_symbols = list(target_symbols.keys())
+
+    for _symbol in _list_symbols:
+        generate_trades_profile(datadir, _symbol, args.rows_per_day)
@@ -0,0 +1,439 @@
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import datetime
+import platform
+import resource
+import argparse
+import subprocess
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import pandas as pd
+from datafile_storage import datafile_extensions, get_dataset_format, write_datafile, read_datafile
+
+# ベンチマークで生成する合成データの銘柄名 (実データと混ざらないように、実在しない銘柄名にする)
+benchmark_symbol = 'BENCHUSDT'
+
+# 合成データの最初の日 (1日目の前日のタイムバーがないので、1日目は前日Closeが0で埋まる)
+benchmark_first_date = datetime.date(year = 2021, month = 1, day = 1)
+
+# 合成約定履歴の価格と数量の刻み (小数点以下の桁数)
+benchmark_price_decimals = 1
+benchmark_qty_decimals = 3
+
+# 約定の到着率を一定とみなす区間の長さ [秒]
+benchmark_segment_seconds = 60
+
+# ベースラインと比べるときに、悪化とみなす指標と悪化の向き (1: 大きいほど良い、-1: 小さいほど良い)
+benchmark_metrics = {
+    'trades_per_sec': 1,
+    'bars_per_sec': 1,
+    'peak_rss_mb': -1,
+    'import_seconds': -1,
+}
+
+# 起動時間を計測するモジュール (cronでの実行やjoblibのワーカーの起動のたびに読み込まれる)
+benchmark_import_modules = ['exercise_core', 'trades_download', 'timebar_generate']
+
+# 上のモジュールを読み込んだときに、一緒に読み込まれてはいけない分析・描画用の重いモジュール
+benchmark_forbidden_imports = ['matplotlib', 'japanize_matplotlib', 'arch', 'scipy.optimize', 'statsmodels']
+
+# モジュールの読み込み時間の上限 [秒] の既定値
+benchmark_import_budget = 1.0
+
+# 日付と乱数の種から、1日分の合成約定履歴をBinanceの約定履歴CSVと同じ列のデータフレームで返す関数
+# 約定の到着は区間ごとに到着率が変わるポアソン過程で、ときどき到着率が数十倍になるバーストと、約定が全くない時間帯を入れる
+# 一日の始まりの1秒間は約定がない (1秒足の1行目のOpenがNaNになり、incompleteなファイルができる)
+# 価格はティック単位のランダムウォークで、quote_qtyはBinanceと同じくprice * qtyを丸めずに10進数で計算した値
+# 同じ日付と種からは常に同じデータになる
+def generate_synthetic_trades(date_str: str = None, num_trades: int = 1_000_000, seed: int = 0, start_price: float = 30000.0, first_id: int = 0) -> pd.DataFrame:
+    assert date_str is not None
+
+    _date = datetime.date.fromisoformat(date_str)
+    _rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key = (_date.toordinal(),)))
+
+    # 区間ごとの到着率 (平均でnum_trades件になるように基準の到着率を決め、対数正規の揺らぎ、バースト、空白の時間帯を掛ける)
+    _num_segments = 86400 // benchmark_segment_seconds
+    _factor = np.exp(_rng.normal(0.0, 0.5, _num_segments))
+    _bursts = _rng.random(_num_segments) < 0.02
+    _factor[_bursts] = _factor[_bursts] * _rng.uniform(10.0, 50.0, _bursts.sum())
+    for _ in range(3):
+        _gap_start = _rng.integers(0, _num_segments)
+        _factor[_gap_start:_gap_start + _rng.integers(1, 30)] = 0.0
+    _rate = _factor / _factor.sum() * num_trades
+
+    # 区間ごとの約定件数をポアソン分布から決め、区間の中で一様に時刻を割り当てる
+    _counts = _rng.poisson(_rate)
+    _segment_start_ms = np.repeat(np.arange(_num_segments) * benchmark_segment_seconds * 1000, _counts)
+    _time_ms = np.sort(_segment_start_ms + _rng.integers(0, benchmark_segment_seconds * 1000, _counts.sum()))
+    _time_ms = _time_ms[_time_ms >= 1000]
+    _num_rows = _time_ms.size
+    _time_ms = _time_ms + int(pd.Timestamp(_date).value // 1_000_000)
+
+    # 価格はティック単位のランダムウォーク、売買の向きは直前の価格変化の向きに寄せる
+    _price_scale = 10 ** benchmark_price_decimals
+    _qty_scale = 10 ** benchmark_qty_decimals
+    _price_steps = _rng.choice([-2, -1, 0, 0, 0, 0, 1, 2], _num_rows)
+    _price_ticks = int(round(start_price * _price_scale)) + np.cumsum(_price_steps)
+    _price_ticks = np.maximum(_price_ticks, 1)
+    _is_buyer_maker = np.where(_price_steps != 0, _price_steps < 0, _rng.random(_num_rows) < 0.5)
+    _qty_steps = np.maximum(np.round(_rng.lognormal(np.log(0.02 * _qty_scale), 1.2, _num_rows)), 1).astype(np.int64)
+
+    return pd.DataFrame({
+        'id': np.arange(first_id, first_id + _num_rows, dtype = np.int64),
+        'price': _price_ticks / _price_scale,
+        'qty': _qty_steps / _qty_scale,
+        'quote_qty': (_price_ticks * _qty_steps) / (_price_scale * _qty_scale),
+        'time': _time_ms,
+        'is_buyer_maker': _is_buyer_maker,
+    })
+
+# 合成約定履歴を、data.binance.visionと同じ形式の.zip (ヘッダーライン付きのCSVを1つ含む) に書き込む関数
+def write_synthetic_trade_zip(df_trades: pd.DataFrame = None, filename: str = None) -> None:
+    assert df_trades is not None
+    assert filename is not None
+
+    _stem = Path(filename).stem
+    _df = df_trades.copy()
+    _df['is_buyer_maker'] = np.where(_df['is_buyer_maker'].values, 'true', 'false')
+    with zipfile.ZipFile(filename, 'w', compression = zipfile.ZIP_DEFLATED) as _zip:
+        with _zip.open(f'{_stem}.csv', 'w') as _csvfile:
+            _csvfile.write(_df.to_csv(index = False).encode('ascii'))
+
+# 作業ディレクトリにnum_days日分の合成約定履歴の.zipを作り、ファイル名のリストを返す関数 (既にあるものは作り直さない)
+def prepare_benchmark_zips(workdir: str = None, num_days: int = 3, num_trades: int = 1_000_000, seed: int = 0) -> list:
+    assert workdir is not None
+
+    _zipdir = Path(f'{workdir}/zip')
+    _zipdir.mkdir(parents = True, exist_ok = True)
+
+    _list_zips = []
+    _first_id = 0
+    _start_price = 30000.0
+    for _i in range(num_days):
+        _date = benchmark_first_date + datetime.timedelta(days = _i)
+        _zipfile = _zipdir / f'{benchmark_symbol}-trades-{_date.isoformat()}.zip'
+        if _zipfile.exists() == False:
+            _df = generate_synthetic_trades(_date.isoformat(), num_trades, seed, _start_price, _first_id)
+            write_synthetic_trade_zip(_df, str(_zipfile))
+            _first_id = int(_df['id'].values[-1]) + 1
+            _start_price = float(_df['price'].values[-1])
+        _list_zips.append(str(_zipfile))
+
+    return _list_zips
+
+# 1日分のタイムバーファイルを日付を変えて並べ、num_days日分のタイムバーファイルを作る関数 (複数年の結合のベンチマーク用)
+def prepare_concat_fixture(workdir: str = None, interval: int = None, num_days: int = None, fmt: str = None) -> tuple:
+    assert workdir is not None
+    assert interval is not None
+    assert num_days is not None
+
+    _fmt = get_dataset_format('timebar', fmt)
+    _ext = datafile_extensions[_fmt]
+    _timebar_dir = Path(f'{workdir}/data/binance/timebar/{benchmark_symbol}/{interval}')
+    _timebar_dir.mkdir(parents = True, exist_ok = True)
+
+    _template = None
+    _date_to = None
+    for _i in range(num_days):
+        _date = benchmark_first_date + datetime.timedelta(days = _i)
+        _date_to = _date
+        _filename = _timebar_dir / f'{benchmark_symbol}-timebar-{interval}sec-{_date.isoformat()}{_ext}'
+        if _filename.exists() == True:
+            continue
+        if _template is None:
+            _template = build_template_timebar(interval)
+        _df = _template.copy()
+        _df.index = _df.index + pd.Timedelta(days = (_date - benchmark_first_date).days)
+        write_datafile(_df, str(_filename), _fmt)
+
+    return (benchmark_first_date.isoformat(), _date_to.isoformat())
+
+# 合成約定履歴から1日分のタイムバーを作る関数 (prepare_concat_fixtureのひな形)
+def build_template_timebar(interval: int = None) -> pd.DataFrame:
+    from timebar_generate import calc_bin_statistics, build_timebar_dataframe, fill_first_open
+
+    _df_trades = generate_synthetic_trades(benchmark_first_date.isoformat(), 100_000)
+    _df_trades['time'] = pd.to_datetime(_df_trades['time'], unit = 'ms')
+    _datetime_from = datetime.datetime.combine(benchmark_first_date, datetime.time())
+    _index = pd.date_range(_datetime_from, _datetime_from + datetime.timedelta(days = 1), freq = f'{interval}S', inclusive = 'left')
+    _df = build_timebar_dataframe(calc_bin_statistics(_df_trades, interval, _datetime_from), _index)
+
+    return fill_first_open(_df, _df_trades['price'].values[0])
+
+# プロセスの最大RSS [MB] を返す関数 (ru_maxrssはLinuxではKB、macOSではバイト)
+def get_peak_rss_mb() -> float:
+    _maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return _maxrss / 1024 / 1024
+    return _maxrss / 1024
+
+# 約定履歴の.zipを、download_trade_zipと同じ関数で解析して約定履歴ファイルに保存するステージ
+def run_parse_stage(list_zips: list = None, fmt: str = None) -> dict:
+    from trades_download import convert_trade_zip
+
+    Path(f'data/binance/trades/{benchmark_symbol}').mkdir(parents = True, exist_ok = True)
+    for _zipfile in list_zips:
+        convert_trade_zip(_zipfile, Path(_zipfile).name, 'data/binance', fmt)
+
+    return {'files': len(list_zips)}
+
+# 約定履歴ファイルから、指定された時間間隔のタイムバーファイルを生成するステージ (前日Closeは渡さないので、一日の始まりに約定がない時間間隔はincompleteなファイルになる)
+def run_timebar_stage(intervals: list = None, fmt: str = None, trades_fmt: str = None) -> dict:
+    from timebar_generate import calc_timebar_from_trades
+
+    _list_files = list_trades_files(trades_fmt)
+    for _idx, _filename in enumerate(_list_files):
+        calc_timebar_from_trades(_idx, _filename, intervals, fmt)
+
+    return {'files': len(_list_files), 'bars': len(_list_files) * sum([86400 // _ for _ in intervals])}
+
+# incompleteなタイムバーファイルを、前日のタイムバーファイルを読み込んで完成させるステージ
+def run_fixup_stage(interval: int = None) -> dict:
+    from timebar_generate import finish_incomplete_timebar_files
+    from exercise_core import identify_datafiles
+
+    _list_files = sorted([str(_) for _ in identify_datafiles('data/binance', 'timebar', benchmark_symbol, interval, incomplete = True) if _.name.startswith('incomplete-')])
+    for _idx, _filename in enumerate(_list_files):
+        finish_incomplete_timebar_files(_idx, _filename, interval)
+
+    return {'files': len(_list_files), 'bars': len(_list_files) * (86400 // interval)}
+
+# 複数年分のタイムバーファイルをconcat_timebar_filesで結合するステージ
+def run_concat_stage(interval: int = None, from_str: str = None, to_str: str = None) -> dict:
+    from exercise_core import concat_timebar_files
+
+    _df = concat_timebar_files(benchmark_symbol, interval, from_str, to_str)
+
+    return {'bars': len(_df)}
+
+# 新しいPythonのプロセスでモジュールを読み込み、かかった時間と一緒に読み込まれた重いモジュールを返す関数
+# 読み込み時間はrepeat回のうち最も速かった回のもの (Python自体の起動時間は含まない)
+def measure_import_time(module: str = None, repeat: int = 3) -> dict:
+    assert module is not None
+
+    _code = '\n'.join([
+        'import sys, time, json',
+        '_start = time.perf_counter()',
+        f'import {module}',
+        '_seconds = time.perf_counter() - _start',
+        f'print(json.dumps({{"seconds": _seconds, "forbidden": [_ for _ in {benchmark_forbidden_imports!r} if _ in sys.modules]}}))',
+    ])
+
+    _list_results = []
+    for _ in range(repeat):
+        _completed = subprocess.run([sys.executable, '-c', _code], cwd = Path(__file__).resolve().parent, capture_output = True, text = True, check = True)
+        _list_results.append(json.loads(_completed.stdout.strip().splitlines()[-1]))
+
+    return {
+        'import_seconds': min([_['seconds'] for _ in _list_results]),
+        'forbidden_imports': sorted(set(sum([_['forbidden'] for _ in _list_results], []))),
+    }
+
+# 起動時間の計測結果が上限を超えていないか、重いモジュールを読み込んでいないかを調べ、違反の説明のリストを返す関数
+def check_import_budget(result: dict = None, budget: float = benchmark_import_budget) -> list:
+    assert result is not None
+
+    _list_violations = []
+    for _stage, _dict_values in result['stages'].items():
+        if 'import_seconds' not in _dict_values:
+            continue
+        if _dict_values['import_seconds'] > budget:
+            _list_violations.append(f'{_stage}の読み込みに{_dict_values["import_seconds"]:.2f}秒かかりました (上限{budget:.2f}秒)')
+        if len(_dict_values['forbidden_imports']) > 0:
+            _list_violations.append(f'{_stage}で{", ".join(_dict_values["forbidden_imports"])}が読み込まれました')
+
+    return _list_violations
+
+# 作業ディレクトリの約定履歴ファイルの一覧を返す関数
+def list_trades_files(fmt: str = None, workdir: str = '.') -> list:
+    _ext = datafile_extensions[get_dataset_format('trades', fmt)]
+    return sorted([str(_) for _ in Path(f'{workdir}/data/binance/trades/{benchmark_symbol}').glob(f'{benchmark_symbol}-trades-*{_ext}')])
+
+# 作業ディレクトリに移動してステージを1回実行し、かかった時間と最大RSSを返す関数 (ステージごとに新しいプロセスで呼ばれる)
+def run_stage_process(workdir: str = None, stage_func = None, args: tuple = ()) -> dict:
+    import warnings
+    warnings.filterwarnings('ignore')
+
+    os.chdir(workdir)
+    _base_rss_mb = get_peak_rss_mb()
+    _start = time.perf_counter()
+    _dict_result = stage_func(*args)
+    _seconds = time.perf_counter() - _start
+
+    return dict(seconds = _seconds, base_rss_mb = _base_rss_mb, peak_rss_mb = get_peak_rss_mb(), **_dict_result)
+
+# ステージを新しいプロセスでrepeat回実行し、最も速かった回の結果に処理件数あたりのスループットを加えて返す関数
+# setup_funcを指定すると、毎回その前に別のプロセスで実行する (計測には含めない)。num_tradesにはステージが処理する約定件数を渡す
+# プロセスを分けるので、最大RSSはそのステージだけのもの (joblibのワーカーのメモリは含まない)
+def measure_stage(workdir: str = None, stage_func = None, args: tuple = (), repeat: int = 1, setup_func = None, setup_args: tuple = (), num_trades: int = None) -> dict:
+    assert workdir is not None
+    assert stage_func is not None
+
+    _list_results = []
+    for _ in range(repeat):
+        if setup_func is not None:
+            with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as _executor:
+                _executor.submit(run_stage_process, workdir, setup_func, setup_args).result()
+        with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as _executor:
+            _list_results.append(_executor.submit(run_stage_process, workdir, stage_func, args).result())
+
+    _result = min(_list_results, key = lambda x: x['seconds'])
+    _result['peak_rss_mb'] = max([_['peak_rss_mb'] for _ in _list_results])
+    if num_trades is not None:
+        _result['trades'] = num_trades
+        _result['trades_per_sec'] = num_trades / _result['seconds']
+    if 'bars' in _result:
+        _result['bars_per_sec'] = _result['bars'] / _result['seconds']
+
+    return _result
+
+# 合成データを作り、.zipの解析、時間間隔ごとのタイムバー生成、incompleteなファイルの完成、複数年の結合の各ステージを計測する関数
+# 最初にCLIのモジュールの読み込み時間を計測する (imports_only = Trueの場合はそれだけを計測する)
+# 戻り値は実行環境、設定、ステージごとの結果の辞書 (JSONにそのまま保存できる)
+def run_pipeline_benchmark(workdir: str = 'benchmark_work', num_days: int = 3, num_trades: int = 1_000_000, intervals: list = (1, 60, 3600), concat_years: int = 2, concat_intervals: list = (60, 3600), trades_fmt: str = None, timebar_fmt: str = None, seed: int = 0, repeat: int = 1, imports_only: bool = False) -> dict:
+    _workdir = str(Path(workdir).resolve())
+    _intervals = sorted(set(int(_) for _ in intervals))
+    assert all(86400 % _ == 0 for _ in _intervals)
+
+    _dict_stages = {}
+
+    def _measure(name, stage_func, args, setup_func = None, setup_args = (), num_trades = None):
+        print(f'{name}を計測しています')
+        _dict_stages[name] = measure_stage(_workdir, stage_func, args, repeat, setup_func, setup_args, num_trades)
+
+    # CLIのモジュールの読み込み時間は、新しいプロセスで3回以上計測する
+    for _module in benchmark_import_modules:
+        print(f'{_module}の読み込み時間を計測しています')
+        _dict_stages[f'import_{_module}'] = measure_import_time(_module, max(repeat, 3))
+
+    if imports_only == False:
+        print(f'{num_days}日分の合成約定履歴 (1日あたり約{num_trades}件) を{_workdir}に作成します')
+        _list_zips = prepare_benchmark_zips(_workdir, num_days, num_trades, seed)
+
+        # 約定件数は解析した約定履歴ファイルから数える (計測には含めない)
+        _measure('parse_zip', run_parse_stage, (_list_zips, trades_fmt))
+        _num_trades = sum([len(read_datafile(_, columns = ['id'])) for _ in list_trades_files(trades_fmt, _workdir)])
+        _dict_stages['parse_zip']['trades'] = _num_trades
+        _dict_stages['parse_zip']['trades_per_sec'] = _num_trades / _dict_stages['parse_zip']['seconds']
+
+        for _interval in _intervals:
+            _measure(f'timebar_{_interval}', run_timebar_stage, ([_interval], timebar_fmt, trades_fmt), num_trades = _num_trades)
+        if len(_intervals) > 1:
+            _measure('timebar_all', run_timebar_stage, (_intervals, timebar_fmt, trades_fmt), num_trades = _num_trades)
+
+        # incompleteなファイルができるのは一日の始まりに約定がない時間間隔だけなので、ファイルがなかった時間間隔の結果は残さない
+        for _interval in _intervals:
+            _measure(f'fixup_{_interval}', run_fixup_stage, (_interval,), run_timebar_stage, ([_interval], timebar_fmt, trades_fmt))
+            if _dict_stages[f'fixup_{_interval}']['files'] == 0:
+                del _dict_stages[f'fixup_{_interval}']
+
+        for _interval in concat_intervals:
+            print(f'{concat_years}年分の{_interval}秒タイムバーファイルを作成します')
+            _from_str, _to_str = prepare_concat_fixture(_workdir, _interval, concat_years * 365, timebar_fmt)
+            _measure(f'concat_{_interval}', run_concat_stage, (_interval, _from_str, _to_str))
+
+    return {
+        'created_at': datetime.datetime.now().isoformat(timespec = 'seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'config': {
+            'num_days': num_days,
+            'num_trades': num_trades,
+            'intervals': _intervals,
+            'concat_years': concat_years,
+            'concat_intervals': list(concat_intervals),
+            'trades_format': get_dataset_format('trades', trades_fmt),
+            'timebar_format': get_dataset_format('timebar', timebar_fmt),
+            'seed': seed,
+            'repeat': repeat,
+            'imports_only': imports_only,
+        },
+        'stages': _dict_stages,
+    }
+
+# ベンチマーク結果をベースラインと比べ、threshold (0.2なら20%) を超えて悪化した指標の説明のリストを返す関数
+# ベースラインにないステージや指標は比べない
+def compare_benchmark_results(result: dict = None, baseline: dict = None, threshold: float = 0.2) -> list:
+    assert result is not None
+    assert baseline is not None
+
+    _list_regressions = []
+    for _stage, _dict_values in result['stages'].items():
+        _dict_baseline_values = baseline['stages'].get(_stage)
+        if _dict_baseline_values is None:
+            continue
+        for _metric, _direction in benchmark_metrics.items():
+            if _metric not in _dict_values or _metric not in _dict_baseline_values or _dict_baseline_values[_metric] <= 0:
+                continue
+            _ratio = _dict_values[_metric] / _dict_baseline_values[_metric]
+            if (_direction > 0 and _ratio < 1 - threshold) or (_direction < 0 and _ratio > 1 + threshold):
+                _list_regressions.append(f'{_stage}の{_metric}が悪化しました: {_dict_baseline_values[_metric]:.1f} -> {_dict_values[_metric]:.1f} ({(_ratio - 1) * 100:+.1f}%)')
+
+    return _list_regressions
+
+# ベンチマーク結果を表にして表示する関数
+def print_benchmark_result(result: dict = None) -> None:
+    assert result is not None
+
+    _df = pd.DataFrame(result['stages']).T
+    _columns = [_ for _ in ['seconds', 'trades_per_sec', 'bars_per_sec', 'peak_rss_mb', 'import_seconds'] if _ in _df.columns]
+    print(_df[_columns].to_string(float_format = lambda x: f'{x:,.1f}'))
+
+# 引数処理とベンチマーク関数の起動部分
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workdir', default = 'benchmark_work', help = '合成データとベンチマーク中に生成するファイルを置くディレクトリ')
+    parser.add_argument('--days', type = int, default = 3, help = '合成約定履歴の日数')
+    parser.add_argument('--trades-per-day', type = int, default = 1_000_000, help = '合成約定履歴の1日あたりの平均約定件数')
+    parser.add_argument('--intervals', type = int, nargs = '+', default = [1, 60, 3600], help = '計測するタイムバーの時間間隔 [秒]')
+    parser.add_argument('--concat-years', type = int, default = 2, help = '結合を計測するタイムバーファイルの年数')
+    parser.add_argument('--concat-intervals', type = int, nargs = '+', default = [60, 3600], help = '結合を計測するタイムバーの時間間隔 [秒]')
+    parser.add_argument('--trades-format', default = None, choices = list(datafile_extensions.keys()), help = '約定履歴ファイルの保存形式 (省略時はpickle)')
+    parser.add_argument('--timebar-format', default = None, choices = [_ for _ in datafile_extensions.keys() if _ != 'compact'], help = 'タイムバーファイルの保存形式 (省略時はpickle)')
+    parser.add_argument('--seed', type = int, default = 0, help = '合成データの乱数の種')
+    parser.add_argument('--repeat', type = int, default = 1, help = '各ステージを計測する回数 (最も速かった回の結果を使う)')
+    parser.add_argument('--output', default = 'benchmark_result.json', help = '結果を保存するJSONファイル')
+    parser.add_argument('--baseline', help = '比較するベースラインの結果のJSONファイル')
+    parser.add_argument('--threshold', type = float, default = 0.2, help = 'ベースラインより悪化したとみなす割合 (0.2なら20%%)')
+    parser.add_argument('--clean', action = 'store_true', help = '終了後に作業ディレクトリを削除する')
+    parser.add_argument('--import-budget', type = float, default = benchmark_import_budget, help = 'CLIのモジュールの読み込み時間の上限 [秒] (超えるか、matplotlibなどの重いモジュールを読み込んだ場合は終了コード1で終了する)')
+    parser.add_argument('--imports-only', action = 'store_true', help = 'CLIのモジュールの読み込み時間だけを計測する')
+    args = parser.parse_args()
+
+    _result = run_pipeline_benchmark(args.workdir, args.days, args.trades_per_day, args.intervals, args.concat_years, args.concat_intervals, args.trades_format, args.timebar_format, args.seed, args.repeat, args.imports_only)
+    print_benchmark_result(_result)
+
+    with open(args.output, 'w') as _f:
+        json.dump(_result, _f, indent = 1)
+    print(f'結果を{args.output}に保存しました')
+
+    if args.clean == True:
+        shutil.rmtree(args.workdir, ignore_errors = True)
+
+    _list_violations = check_import_budget(_result, args.import_budget)
+    for _violation in _list_violations:
+        print(_violation)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as _f:
+            _baseline = json.load(_f)
+        _list_regressions = compare_benchmark_results(_result, _baseline, args.threshold)
+        for _regression in _list_regressions:
+            print(_regression)
+        if len(_list_regressions) == 0:
+            print(f'ベースライン{args.baseline}から{args.threshold * 100:.0f}%を超えて悪化した指標はありません')
+        _list_violations = _list_violations + _list_regressions
+
+    if len(_list_violations) > 0:
+        exit(1)
@@ -0,0 +1,378 @@
+import os
+import io
+import re
+import sys
+import json
+import time
+import socket
+import datetime
+import resource
+import itertools
+import contextlib
+from pathlib import Path
+
+# 計測結果を書き込むディレクトリと、プロファイラの種類を並列処理のワーカーに伝える環境変数
+# joblibのワーカーは最初の並列処理のときに親プロセスの環境変数を引き継いで起動されるので、enable_task_metricsはその前に呼ぶ
+metrics_dir_env = 'BINANCE_EXERCISE_METRICS_DIR'
+metrics_profiler_env = 'BINANCE_EXERCISE_METRICS_PROFILER'
+
+# 対応しているプロファイラ (pyinstrumentはインストールされている場合のみ使える)
+metrics_profilers = ['cprofile', 'pyinstrument']
+
+# タスクの処理時間を分ける区間 (read: ファイルの読み込みと展開と解析、compute: 計算、serialize: 書き込み、download: ダウンロード)
+metrics_phases = ['download', 'read', 'compute', 'serialize']
+
+# Prometheusのテキスト形式で出力するときの指標名の接頭辞
+metrics_prefix = 'binance_exercise'
+
+# このプロセスで実行中のタスクの計測 (入れ子になったタスクは外側のタスクにまとめる)
+_active_recorders = []
+
+# プロファイルのファイル名が重ならないように付ける、プロセス内の通し番号
+_profile_counter = itertools.count()
+
+# 1つのタスクの処理時間の内訳、読み書きしたバイト数、処理した行数を記録するクラス
+class TaskMetricsRecorder:
+    def __init__(self, stage: str = None, task: str = None):
+        self.stage = stage
+        self.task = task
+        self.phases = {}
+        self.rows = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._phase_stack = []
+
+    # withで囲んだ区間の時間をphaseの処理時間に加える
+    # 区間は入れ子にでき、内側の区間の時間は外側の区間に含めない
+    @contextlib.contextmanager
+    def phase(self, name: str = None):
+        self._switch_phase()
+        self._phase_stack.append([name, time.perf_counter()])
+        try:
+            yield
+        finally:
+            self._switch_phase()
+            self._phase_stack.pop()
+            if len(self._phase_stack) > 0:
+                self._phase_stack[-1][1] = time.perf_counter()
+
+    # 実行中の区間のここまでの時間を加える関数
+    def _switch_phase(self) -> None:
+        if len(self._phase_stack) == 0:
+            return
+        _name, _start = self._phase_stack[-1]
+        _now = time.perf_counter()
+        self.phases[_name] = self.phases.get(_name, 0.0) + _now - _start
+        self._phase_stack[-1][1] = _now
+
+    def add_rows(self, rows: int = 0) -> None:
+        self.rows = self.rows + int(rows)
+
+    def add_bytes_in(self, num_bytes: int = 0) -> None:
+        self.bytes_in = self.bytes_in + int(num_bytes)
+
+    def add_file_in(self, filename = None) -> None:
+        self.bytes_in = self.bytes_in + _get_file_size(filename)
+
+    def add_file_out(self, filename = None) -> None:
+        self.bytes_out = self.bytes_out + _get_file_size(filename)
+
+# 計測が無効な場合に使う、何も記録しないクラス
+class NullTaskMetricsRecorder:
+    def phase(self, name: str = None):
+        return contextlib.nullcontext()
+
+    def add_rows(self, rows: int = 0) -> None:
+        pass
+
+    def add_bytes_in(self, num_bytes: int = 0) -> None:
+        pass
+
+    def add_file_in(self, filename = None) -> None:
+        pass
+
+    def add_file_out(self, filename = None) -> None:
+        pass
+
+_null_recorder = NullTaskMetricsRecorder()
+
+def _get_file_size(filename) -> int:
+    try:
+        return os.stat(filename).st_size
+    except (OSError, TypeError):
+        return 0
+
+# プロセスが起動してからの最大RSS [バイト] を返す関数 (ru_maxrssはLinuxではKB、macOSではバイト)
+def _get_peak_rss_bytes() -> int:
+    _maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return _maxrss if sys.platform == 'darwin' else _maxrss * 1024
+
+# プロセスの最大RSS (/proc/self/statusのVmHWM) を今のRSSに戻す関数 (Linuxのみ。戻せなかった場合はFalseを返す)
+# ワーカーは複数のタスクを続けて実行するので、タスクの開始時に戻しておくと、タスクの終了時のVmHWMがそのタスクの間の最大RSSになる
+def _reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as _f:
+            _f.write('5')
+        return True
+    except OSError:
+        return False
+
+# /proc/self/statusのVmHWM [バイト] を返す関数 (読めない場合はNone)
+def _get_vm_hwm_bytes():
+    try:
+        with open('/proc/self/status', 'r') as _f:
+            for _line in _f:
+                if _line.startswith('VmHWM:'):
+                    return int(_line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+# タスクの記録の最大RSSを返す関数
+# タスクの間の最大RSSを測れた場合はpeak_rss_bytes、測れなかった場合はワーカーが起動してからの最大RSSのworker_peak_rss_bytesに記録している
+def get_record_peak_rss_bytes(record: dict = None) -> int:
+    assert record is not None
+
+    return record.get('peak_rss_bytes', record.get('worker_peak_rss_bytes', 0))
+
+# タスクの記録をワーカーごとのJSON linesファイルに1行追記する関数
+def _write_task_record(metrics_dir: str = None, record: dict = None) -> None:
+    with open(f'{metrics_dir}/tasks/{socket.gethostname()}-{os.getpid()}.jsonl', 'a') as _f:
+        _f.write(json.dumps(record) + '\n')
+
+# タスクの計測を有効にする関数 (親プロセスで、並列処理を始める前に呼ぶ)
+# profilerに'cprofile'か'pyinstrument'を指定すると、全てのタスクのプロファイルを保存する (export_task_metricsで遅いものだけを残す)
+# metrics_dirにある前回の計測結果は削除する
+def enable_task_metrics(metrics_dir: str = None, profiler: str = None) -> None:
+    assert metrics_dir is not None
+    assert profiler is None or profiler in metrics_profilers, f'未対応のプロファイラです: {profiler}'
+
+    Path(f'{metrics_dir}/tasks').mkdir(parents = True, exist_ok = True)
+    for _filename in list(Path(f'{metrics_dir}/tasks').glob('*.jsonl')) + list(Path(f'{metrics_dir}/profiles').glob('*')):
+        _filename.unlink()
+    os.environ[metrics_dir_env] = str(Path(metrics_dir).resolve())
+    if profiler is not None:
+        Path(f'{metrics_dir}/profiles').mkdir(parents = True, exist_ok = True)
+        os.environ[metrics_profiler_env] = profiler
+    else:
+        os.environ.pop(metrics_profiler_env, None)
+
+# 実行中のタスクの計測を返す関数 (計測が無効な場合やタスクの外では何も記録しない)
+def current_task_metrics():
+    return _active_recorders[-1] if len(_active_recorders) > 0 else _null_recorder
+
+# withで囲んだ処理を1つのタスクとして計測し、終了時にワーカーごとのJSON linesファイルに1行追記するコンテキストマネージャ
+# 計測が無効な場合は何もしない。既にタスクの中にいる場合は外側のタスクの計測をそのまま使う
+# 例外で抜けた場合も、例外の種類を付けて記録する
+# 最大RSSは、Linuxではタスクの開始時にVmHWMを戻してタスクの間の最大RSSをpeak_rss_bytesに記録し、
+# それ以外ではワーカーが起動してからの最大RSS (それまでのタスクの最大RSSを含む) をworker_peak_rss_bytesに記録する
+@contextlib.contextmanager
+def task_metrics(stage: str = None, task: str = None):
+    assert stage is not None
+
+    _metrics_dir = os.environ.get(metrics_dir_env)
+    if _metrics_dir is None:
+        yield _null_recorder
+        return
+    if len(_active_recorders) > 0:
+        yield _active_recorders[-1]
+        return
+
+    _recorder = TaskMetricsRecorder(stage, task)
+    _peak_rss_resetted = _reset_peak_rss()
+    _profiler = start_task_profiler(os.environ.get(metrics_profiler_env))
+    _active_recorders.append(_recorder)
+    _started_at = datetime.datetime.now().isoformat(timespec = 'milliseconds')
+    _start = time.perf_counter()
+    _error = None
+    try:
+        yield _recorder
+    except BaseException as e:
+        _error = type(e).__name__
+        raise
+    finally:
+        _seconds = time.perf_counter() - _start
+        _active_recorders.pop()
+
+        _record = {
+            'stage': stage,
+            'task': task,
+            'hostname': socket.gethostname(),
+            'pid': os.getpid(),
+            'started_at': _started_at,
+            'seconds': _seconds,
+            'phases': _recorder.phases,
+            'rows': _recorder.rows,
+            'bytes_in': _recorder.bytes_in,
+            'bytes_out': _recorder.bytes_out,
+            'error': _error,
+        }
+        _vm_hwm_bytes = _get_vm_hwm_bytes() if _peak_rss_resetted == True else None
+        if _vm_hwm_bytes is not None:
+            _record['peak_rss_bytes'] = _vm_hwm_bytes
+        else:
+            _record['worker_peak_rss_bytes'] = _get_peak_rss_bytes()
+        if _profiler is not None:
+            _record['profile'] = stop_task_profiler(_profiler, _metrics_dir, stage, _started_at)
+
+        _write_task_record(_metrics_dir, _record)
+
+# withを使わずに、他の処理と並行して進んだ処理 (asyncioのダウンロードなど) の結果を1つのタスクとして記録する関数
+# 同じプロセスで他のタスクと重なって実行されるので、最大RSSはプロセスが起動してからの値をworker_peak_rss_bytesに記録する
+def record_task_metrics(stage: str = None, task: str = None, started_at: str = None, seconds: float = None, phases: dict = None, rows: int = 0, bytes_in: int = 0, bytes_out: int = 0, error: str = None) -> None:
+    assert stage is not None
+    assert seconds is not None
+
+    _metrics_dir = os.environ.get(metrics_dir_env)
+    if _metrics_dir is None:
+        return
+
+    _write_task_record(_metrics_dir, {
+        'stage': stage,
+        'task': task,
+        'hostname': socket.gethostname(),
+        'pid': os.getpid(),
+        'started_at': started_at if started_at is not None else datetime.datetime.now().isoformat(timespec = 'milliseconds'),
+        'seconds': seconds,
+        'phases': phases if phases is not None else {},
+        'rows': rows,
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'error': error,
+        'worker_peak_rss_bytes': _get_peak_rss_bytes(),
+    })
+
+def start_task_profiler(profiler: str = None):
+    if profiler is None:
+        return None
+    if profiler == 'pyinstrument':
+        import pyinstrument
+        _profiler = pyinstrument.Profiler()
+        _profiler.start()
+    else:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    return (profiler, _profiler)
+
+# プロファイルを止めてファイルに保存し、ファイル名を返す関数 (cProfileは.prof、pyinstrumentは.html)
+def stop_task_profiler(profiler: tuple = None, metrics_dir: str = None, stage: str = None, started_at: str = None) -> str:
+    _kind, _profiler = profiler
+    _stem = f'{metrics_dir}/profiles/{stage}-{socket.gethostname()}-{os.getpid()}-{re.sub("[^0-9]", "", started_at)}-{next(_profile_counter)}'
+    if _kind == 'pyinstrument':
+        _profiler.stop()
+        _filename = f'{_stem}.html'
+        with open(_filename, 'w') as _f:
+            _f.write(_profiler.output_html())
+    else:
+        _profiler.disable()
+        _filename = f'{_stem}.prof'
+        _profiler.dump_stats(_filename)
+    return _filename
+
+# ワーカーごとのJSON linesファイルから、全てのタスクの記録を読み込む関数
+def read_task_metrics(metrics_dir: str = None) -> list:
+    assert metrics_dir is not None
+
+    _list_records = []
+    for _filename in sorted(Path(f'{metrics_dir}/tasks').glob('*.jsonl')):
+        with open(_filename, 'r') as _f:
+            _list_records.extend([json.loads(_line) for _line in _f if _line.strip() != ''])
+
+    return sorted(_list_records, key = lambda x: x['started_at'])
+
+# タスクの記録をステージごとに集計する関数
+# 戻り値はステージごとのタスク数、失敗したタスク数、合計と最大の処理時間、区間ごとの合計時間、行数、バイト数、タスクの最大RSS (get_record_peak_rss_bytes) の辞書
+def aggregate_task_metrics(list_records: list = None) -> dict:
+    assert list_records is not None
+
+    _dict_stages = {}
+    for _record in list_records:
+        _stage = _dict_stages.setdefault(_record['stage'], {
+            'tasks': 0,
+            'errors': 0,
+            'seconds': 0.0,
+            'max_seconds': 0.0,
+            'phases': {},
+            'rows': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'workers': set(),
+            'peak_rss_bytes': 0,
+        })
+        _stage['tasks'] = _stage['tasks'] + 1
+        _stage['errors'] = _stage['errors'] + (1 if _record['error'] is not None else 0)
+        _stage['seconds'] = _stage['seconds'] + _record['seconds']
+        _stage['max_seconds'] = max(_stage['max_seconds'], _record['seconds'])
+        for _phase, _seconds in _record['phases'].items():
+            _stage['phases'][_phase] = _stage['phases'].get(_phase, 0.0) + _seconds
+        _stage['rows'] = _stage['rows'] + _record['rows']
+        _stage['bytes_in'] = _stage['bytes_in'] + _record['bytes_in']
+        _stage['bytes_out'] = _stage['bytes_out'] + _record['bytes_out']
+        _stage['workers'].add((_record['hostname'], _record['pid']))
+        _stage['peak_rss_bytes'] = max(_stage['peak_rss_bytes'], get_record_peak_rss_bytes(_record))
+
+    for _stage in _dict_stages.values():
+        _stage['workers'] = len(_stage['workers'])
+
+    return _dict_stages
+
+# ステージごとの集計をPrometheusのテキスト形式 (node_exporterのtextfile collectorで読み込める形式) にする関数
+def format_prometheus_metrics(dict_stages: dict = None) -> str:
+    assert dict_stages is not None
+
+    _list_metrics = [
+        ('tasks_total', 'counter', 'Number of tasks', 'tasks'),
+        ('task_errors_total', 'counter', 'Number of failed tasks', 'errors'),
+        ('task_seconds_total', 'counter', 'Total wall time of tasks', 'seconds'),
+        ('task_seconds_max', 'gauge', 'Wall time of the slowest task', 'max_seconds'),
+        ('rows_total', 'counter', 'Rows processed', 'rows'),
+        ('bytes_in_total', 'counter', 'Bytes read from input files', 'bytes_in'),
+        ('bytes_out_total', 'counter', 'Bytes written to output files', 'bytes_out'),
+        ('workers', 'gauge', 'Number of worker processes that ran tasks', 'workers'),
+        ('peak_rss_bytes', 'gauge', 'Peak resident set size of a task (worker lifetime peak where it cannot be reset)', 'peak_rss_bytes'),
+    ]
+
+    _buffer = io.StringIO()
+    for _name, _type, _help, _key in _list_metrics:
+        _buffer.write(f'# HELP {metrics_prefix}_{_name} {_help}\n')
+        _buffer.write(f'# TYPE {metrics_prefix}_{_name} {_type}\n')
+        for _stage, _values in sorted(dict_stages.items()):
+            _buffer.write(f'{metrics_prefix}_{_name}{{stage="{_stage}"}} {_values[_key]}\n')
+
+    _buffer.write(f'# HELP {metrics_prefix}_phase_seconds_total Total wall time of tasks by phase\n')
+    _buffer.write(f'# TYPE {metrics_prefix}_phase_seconds_total counter\n')
+    for _stage, _values in sorted(dict_stages.items()):
+        for _phase, _seconds in sorted(_values['phases'].items()):
+            _buffer.write(f'{metrics_prefix}_phase_seconds_total{{stage="{_stage}",phase="{_phase}"}} {_seconds}\n')
+
+    return _buffer.getvalue()
+
+# 計測結果を集計して、全てのタスクの記録をtasks.jsonl、ステージごとの集計をmetrics.promに書き出し、集計を表示する関数
+# プロファイルは処理時間が長かったtop_n個のタスクの分だけを残して、それ以外は削除する
+def export_task_metrics(metrics_dir: str = None, top_n: int = 10) -> dict:
+    assert metrics_dir is not None
+
+    _list_records = read_task_metrics(metrics_dir)
+    _dict_stages = aggregate_task_metrics(_list_records)
+
+    with open(f'{metrics_dir}/tasks.jsonl', 'w') as _f:
+        for _record in _list_records:
+            _f.write(json.dumps(_record) + '\n')
+    with open(f'{metrics_dir}/metrics.prom', 'w') as _f:
+        _f.write(format_prometheus_metrics(_dict_stages))
+
+    _list_slowest = sorted(_list_records, key = lambda x: x['seconds'], reverse = True)[:top_n]
+    _set_keep = set([_['profile'] for _ in _list_slowest if 'profile' in _])
+    for _record in _list_records:
+        if 'profile' in _record and _record['profile'] not in _set_keep:
+            Path(_record['profile']).unlink(missing_ok = True)
+
+    for _stage, _values in sorted(_dict_stages.items()):
+        _phases_str = ', '.join([f'{_phase} {_values["phases"][_phase]:.1f}秒' for _phase in metrics_phases if _phase in _values['phases']])
+        print(f'{_stage}: {_values["tasks"]}タスク (失敗{_values["errors"]}) 合計{_values["seconds"]:.1f}秒 最大{_values["max_seconds"]:.1f}秒 [{_phases_str}] {_values["rows"]}行 読込{_values["bytes_in"] / 1024 / 1024:.1f}MB 書込{_values["bytes_out"] / 1024 / 1024:.1f}MB 最大RSS{_values["peak_rss_bytes"] / 1024 / 1024:.0f}MB')
+    print('処理時間が長かったタスク:')
+    for _record in _list_slowest:
+        print(f'  {_record["seconds"]:.2f}秒 {_record["stage"]} {_record["task"]}' + (f' ({_record["profile"]})' if 'profile' in _record else ''))
+
+    return _dict_stages
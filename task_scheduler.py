@@ -0,0 +1,76 @@
+import os
+import heapq
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tqdm.auto import tqdm
+
+# 1つのプロセスプールに一度に投入しておくバッチの数 (ワーカー数に対する倍率)
+# ワーカーが次のバッチを待たないように少し多めに投入し、残りは優先度順に並べておく
+scheduler_queue_factor = 2
+
+# 小さいタスクをまとめるときの、1つのバッチの処理量の目安 (全タスクの処理量をワーカー数 * この値で割ったもの)
+scheduler_batches_per_worker = 16
+
+# ワーカーのプロセスで、バッチにまとめられたタスクを順に実行する関数
+def run_task_batch(list_calls: list = None) -> list:
+    assert list_calls is not None
+
+    return [(_key, _func(*_args)) for _key, _func, _args in list_calls]
+
+# タスクのグラフを、1つの長寿命のプロセスプールで実行する関数
+# tasksにはタスクの辞書 {'key': 結果の辞書のキー, 'func': 関数, 'args': 引数のタプル, 'cost': 処理量の見積もり (ファイルサイズなど)} のリストを渡す
+# 実行できるタスクは処理量の大きい順に投入し、処理量がbatch_costより小さいタスクは合計がbatch_costになるまでまとめて1回で投入する
+# on_complete(key, result)はタスクが終わるたびに親プロセスで呼ばれ、そのタスクの結果を待っていた後続のタスクのリストを返すとグラフに追加される
+# 戻り値はキーごとのタスクの結果の辞書。タスクで例外が発生した場合は、実行中のバッチが終わるのを待ってから例外をそのまま投げる
+def run_task_graph(tasks: list = None, on_complete = None, max_workers: int = None, batch_cost: float = None, desc: str = None) -> dict:
+    assert tasks is not None
+
+    # joblibのn_jobs = -2と同じく、全コア数-1個のワーカーを使う
+    _max_workers = max_workers if max_workers is not None else max((os.cpu_count() or 1) - 1, 1)
+    if batch_cost is None:
+        batch_cost = sum([_['cost'] for _ in tasks]) / (_max_workers * scheduler_batches_per_worker)
+
+    _counter = itertools.count()
+    _heap = []
+
+    def _push(list_tasks):
+        for _task in list_tasks:
+            heapq.heappush(_heap, (-_task['cost'], next(_counter), _task))
+
+    def _pop_batch():
+        _list_calls = []
+        _cost = 0.0
+        while len(_heap) > 0:
+            _task = _heap[0][2]
+            if len(_list_calls) > 0 and (_task['cost'] >= batch_cost or _cost + _task['cost'] > batch_cost):
+                break
+            heapq.heappop(_heap)
+            _list_calls.append((_task['key'], _task['func'], _task['args']))
+            _cost = _cost + _task['cost']
+            if _task['cost'] >= batch_cost:
+                break
+        return _list_calls
+
+    _push(tasks)
+    _dict_results = {}
+    with ProcessPoolExecutor(max_workers = _max_workers) as _executor, tqdm(total = len(tasks), desc = desc, miniters = 1, smoothing = 0) as _pbar:
+        _dict_running = {}
+        while len(_heap) > 0 or len(_dict_running) > 0:
+            while len(_heap) > 0 and len(_dict_running) < _max_workers * scheduler_queue_factor:
+                _list_calls = _pop_batch()
+                _dict_running[_executor.submit(run_task_batch, _list_calls)] = _list_calls
+
+            _set_done, _ = wait(_dict_running.keys(), return_when = FIRST_COMPLETED)
+            for _future in _set_done:
+                del _dict_running[_future]
+                for _key, _result in _future.result():
+                    _dict_results[_key] = _result
+                    _pbar.update(1)
+                    if on_complete is not None:
+                        _list_new_tasks = on_complete(_key, _result) or []
+                        if len(_list_new_tasks) > 0:
+                            _pbar.total = _pbar.total + len(_list_new_tasks)
+                            _pbar.refresh()
+                            _push(_list_new_tasks)
+
+    return _dict_results
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+from avellaneda_stoikov_simulation import default_simulation_params, make_price_paths_from_timebar, simulate_avellaneda_stoikov
+
+def make_timebar(num_bars: int) -> pd.DataFrame:
+    _rng = np.random.default_rng(0)
+    _close = 30000.0 + np.cumsum(_rng.normal(0, 5, num_bars))
+    return pd.DataFrame({'close': _close}, index = pd.date_range('2022-01-01', periods = num_bars, freq = '60S'))
+
+# T / dtより長いタイムバーのパスを再生しても、残り時間が負にならず、指値が交差しないこと
+def test_replay_path_longer_than_horizon():
+    _num_steps = 1000
+    assert _num_steps > round(default_simulation_params['T'] / default_simulation_params['dt'])
+    _paths = make_price_paths_from_timebar(make_timebar(4 * (_num_steps + 1)), _num_steps, normalize_to_s = 100)
+
+    _result = simulate_avellaneda_stoikov(price_paths = _paths, record = True)
+
+    assert _result['time'][-1] == pytest.approx(default_simulation_params['T'])
+    assert np.all(_result['delta_ask_path'] - _result['delta_bid_path'] > 0)
+    assert np.all(np.isfinite(_result['wealth']))
+
+# パスのステップ数と一致しないdtを指定した場合は、エラーにすること
+def test_replay_rejects_inconsistent_dt():
+    _paths = make_price_paths_from_timebar(make_timebar(1001), 1000, normalize_to_s = 100)
+
+    with pytest.raises(AssertionError):
+        simulate_avellaneda_stoikov(price_paths = _paths, dt = 0.005)
+    simulate_avellaneda_stoikov(price_paths = _paths, dt = 0.001)
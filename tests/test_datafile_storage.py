@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datafile_storage import datafile_extensions, write_datafile, read_datafile, read_timebar_datafile
+
+# 最初の10本はOHLCが0で埋められ (前日Closeが0の日の最初の約定より前)、買いの約定がないバーも含む1日分の60秒タイムバー
+def make_timebar() -> pd.DataFrame:
+    _rng = np.random.default_rng(0)
+    _index = pd.date_range('2022-01-01', periods = 1440, freq = '60S')
+    _close = 30000.0 + np.cumsum(_rng.normal(0, 1, len(_index)))
+    _close[:10] = 0.0
+    _buy_trade_count = _rng.integers(0, 3, len(_index))
+    _buy_trade_count[:10] = 0
+
+    return pd.DataFrame({
+        'open': _close,
+        'high': _close,
+        'low': _close,
+        'close': _close,
+        'buy_trade_count': _buy_trade_count,
+        'sell_trade_count': np.where(np.arange(len(_index)) < 10, 0, 1),
+    }, index = _index)
+
+def get_formats() -> list:
+    _list_formats = ['pickle']
+    try:
+        import pyarrow
+        _list_formats = _list_formats + ['parquet', 'arrow']
+    except ImportError:
+        pass
+    return _list_formats
+
+@pytest.mark.parametrize('fmt', get_formats())
+def test_read_datafile_filters_time_range(tmp_path, fmt):
+    _df = make_timebar()
+    _filename = str(tmp_path / f'timebar{datafile_extensions[fmt]}')
+    write_datafile(_df, _filename, fmt)
+
+    _df_read = read_datafile(_filename, columns = ['close'], time_from = '2022-01-01 01:00', time_to = '2022-01-01 02:00')
+
+    assert list(_df_read.columns) == ['close']
+    assert _df_read.index.equals(_df.index[60:120])
+    np.testing.assert_array_equal(_df_read['close'].values, _df['close'].values[60:120])
+
+# 列を選んでも、すべてが0の行として取り除かれる行は変わらないこと
+@pytest.mark.parametrize('fmt', get_formats())
+def test_read_timebar_datafile_projection_keeps_index(tmp_path, fmt):
+    _df = make_timebar()
+    _filename = str(tmp_path / f'timebar{datafile_extensions[fmt]}')
+    write_datafile(_df, _filename, fmt)
+
+    _df_full = read_timebar_datafile(_filename)
+    assert _df_full.index.equals(_df.index[10:])
+
+    for _columns in [['buy_trade_count'], ['sell_trade_count'], ['close', 'buy_trade_count']]:
+        _df_projected = read_timebar_datafile(_filename, columns = _columns)
+        assert list(_df_projected.columns) == _columns
+        assert _df_projected.index.equals(_df_full.index)
@@ -0,0 +1,38 @@
+import os
+import numpy as np
+import pandas as pd
+from datafile_storage import write_datafile
+from exercise_core import get_bars, clear_bar_cache, concat_timebar_files
+
+# 最初の日の最初の10本はOHLCが0で埋められ、買いの約定がないバーも含む3日分の60秒タイムバーファイルを書き込む
+def write_timebar_files(datadir: str) -> pd.DatetimeIndex:
+    _rng = np.random.default_rng(0)
+    _list_index = []
+    for _day, _date in enumerate(['2022-01-01', '2022-01-02', '2022-01-03']):
+        _index = pd.date_range(_date, periods = 1440, freq = '60S')
+        _close = 30000.0 + np.cumsum(_rng.normal(0, 1, len(_index)))
+        _buy_trade_count = _rng.integers(0, 3, len(_index))
+        if _day == 0:
+            _close[:10] = 0.0
+            _buy_trade_count[:10] = 0
+        _df = pd.DataFrame({'open': _close, 'high': _close, 'low': _close, 'close': _close, 'buy_trade_count': _buy_trade_count}, index = _index)
+        _dir = f'{datadir}/timebar/BTCUSDT/60'
+        os.makedirs(_dir, exist_ok = True)
+        write_datafile(_df, f'{_dir}/BTCUSDT-timebar-60sec-{_date}.pkl.gz', 'pickle')
+        _list_index.append(_index)
+    return _list_index[0][10:].append(_list_index[1]).append(_list_index[2])
+
+# 列を選んでも、get_barsとconcat_timebar_filesが返す行は変わらないこと
+def test_projection_keeps_index(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _expected_index = write_timebar_files('data/binance')
+    clear_bar_cache()
+
+    for _columns in [None, ['buy_trade_count'], ['close', 'buy_trade_count']]:
+        _df = get_bars('BTCUSDT', 60, '2022-01-01', '2022-01-03', columns = _columns)
+        assert _df.index.equals(_expected_index)
+        if _columns is not None:
+            assert list(_df.columns) == _columns
+
+        _df = concat_timebar_files('BTCUSDT', 60, columns = _columns)
+        assert _df.index.equals(_expected_index)
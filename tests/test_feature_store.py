@@ -0,0 +1,62 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from datafile_storage import write_datafile
+from exercise_core import concat_timebar_files
+from feature_store import calc_rolling_moment, rolling_moment_kinds, calc_feature, load_features
+
+# 1日分の60秒タイムバーファイルを書き込む関数
+def write_timebar_file(datadir: str, date: str, seed: int) -> None:
+    _rng = np.random.default_rng(seed)
+    _index = pd.date_range(date, periods = 1440, freq = '60S')
+    _close = 30000.0 + np.cumsum(_rng.normal(0, 5, len(_index)))
+    _df = pd.DataFrame({'open': _close, 'high': _close + 1, 'low': _close - 1, 'close': _close, 'buy_trade_count': _rng.integers(1, 5, len(_index))}, index = _index)
+    _dir = f'{datadir}/timebar/BTCUSDT/60'
+    os.makedirs(_dir, exist_ok = True)
+    write_datafile(_df, f'{_dir}/BTCUSDT-timebar-60sec-{date}.pkl.gz', 'pickle')
+
+# pandasのrollingと同じ定義の値になること (NaNを含む窓と、値がすべて同じ窓も含む)
+# pandasのrollingの値自体に窓をずらしながら足し引きした丸め誤差が入るので、窓ごとにSeriesのメソッドで計算した値と比べる
+# (値がすべて同じ窓の歪度と尖度は、Seriesのメソッドでは0になるので、pandasのrollingの値と比べる)
+@pytest.mark.parametrize('kind', list(rolling_moment_kinds.keys()))
+@pytest.mark.parametrize('window', [1, 2, 3, 4, 20])
+def test_calc_rolling_moment_matches_pandas(kind, window):
+    _rng = np.random.default_rng(0)
+    _values = 30000.0 + np.cumsum(_rng.normal(0, 5, 500))
+    _values[100:130] = 30000.0
+    _values[200] = np.nan
+
+    _rolling = pd.Series(_values).rolling(window)
+    _expected = _rolling.apply(lambda x: getattr(pd.Series(x), kind)(), raw = True).values
+    _constant = (_rolling.max() == _rolling.min()).values
+    _expected[_constant] = getattr(_rolling, kind)().values[_constant]
+    np.testing.assert_allclose(calc_rolling_moment(_values, window, rolling_moment_kinds[kind]), _expected, rtol = 1e-9, atol = 1e-9)
+
+# 各行の値はその窓の値だけで決まり、計算を始めた行によって変わらないこと
+@pytest.mark.parametrize('kind', list(rolling_moment_kinds.keys()))
+def test_calc_rolling_moment_independent_of_start(kind):
+    _rng = np.random.default_rng(1)
+    _values = 30000.0 + np.cumsum(_rng.normal(0, 5, 5000))
+
+    _full = calc_rolling_moment(_values, 20, rolling_moment_kinds[kind])
+    for _start in [1, 777, 4000]:
+        np.testing.assert_array_equal(calc_rolling_moment(_values[_start:], 20, rolling_moment_kinds[kind])[19:], _full[_start + 19:])
+
+# 1日分を延長したキャッシュの特徴量が、すべての日から計算し直したものと一致すること
+def test_extended_feature_equals_fresh(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    _features = [('rolling_mean', {'window': 20}), ('rolling_std', {'window': 20}), ('rolling_skew', {'window': 20}), ('rolling_kurt', {'window': 20}), ('ma_deviation', {'window': 20})]
+    write_timebar_file('data/binance', '2022-01-01', 0)
+    write_timebar_file('data/binance', '2022-01-02', 1)
+    load_features('BTCUSDT', 60, _features)
+
+    write_timebar_file('data/binance', '2022-01-03', 2)
+    capsys.readouterr()
+    _df_extended = load_features('BTCUSDT', 60, _features)
+    assert capsys.readouterr().out.count('1日分延長します') == len(_features)
+
+    _df_timebar = concat_timebar_files('BTCUSDT', 60)
+    assert _df_extended.index.equals(_df_timebar.index)
+    for _column, (_name, _params) in zip(_df_extended.columns, _features):
+        np.testing.assert_array_equal(_df_extended[_column].values, calc_feature(_df_timebar, _name, _params))
@@ -0,0 +1,11 @@
+import pytest
+from pipeline_benchmark import benchmark_import_budget, measure_import_time
+
+# CLIから読み込まれるモジュールが、重いモジュールを読み込まず、読み込み時間の上限に収まること
+# 読み込み時間は新しいPythonのプロセスで計測する (pytestのプロセスでは読み込み済みのモジュールがあるため)
+@pytest.mark.parametrize('module', ['exercise_core', 'trades_download', 'timebar_generate'])
+def test_import_budget(module):
+    _result = measure_import_time(module)
+
+    assert _result['forbidden_imports'] == [], f'{module}で{", ".join(_result["forbidden_imports"])}が読み込まれました'
+    assert _result['import_seconds'] <= benchmark_import_budget, f'{module}の読み込みに{_result["import_seconds"]:.2f}秒かかりました'
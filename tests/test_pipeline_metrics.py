@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import pipeline_metrics
+from pipeline_metrics import task_metrics, record_task_metrics, read_task_metrics, aggregate_task_metrics
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    (tmp_path / 'tasks').mkdir()
+    monkeypatch.setenv(pipeline_metrics.metrics_dir_env, str(tmp_path))
+    return str(tmp_path)
+
+# 前のタスクで大きなメモリを使っても、後のタスクの最大RSSには含まれないこと (VmHWMを戻せる環境のみ)
+def test_task_metrics_peak_rss_is_per_task(metrics_dir):
+    if pipeline_metrics._reset_peak_rss() == False or pipeline_metrics._get_vm_hwm_bytes() is None:
+        pytest.skip('/proc/self/clear_refsでVmHWMを戻せない環境です')
+
+    _large_bytes = 256 * 1024 * 1024
+    with task_metrics('large', 'a'):
+        _array = np.ones(_large_bytes // 8)
+        del _array
+    with task_metrics('small', 'b'):
+        pass
+
+    _list_records = read_task_metrics(metrics_dir)
+    _dict_records = {_['stage']: _ for _ in _list_records}
+    assert _dict_records['large']['peak_rss_bytes'] - _dict_records['small']['peak_rss_bytes'] > _large_bytes // 2
+
+# withを使わずに記録したタスクは、ワーカーが起動してからの最大RSSとして記録され、集計にも含まれること
+def test_record_task_metrics_phase(metrics_dir):
+    record_task_metrics('download_trade_zip', 'BTCUSDT-trades-2022-01-01.zip', seconds = 1.5, phases = {'download': 1.5}, bytes_in = 100)
+
+    _list_records = read_task_metrics(metrics_dir)
+    assert len(_list_records) == 1
+    assert 'peak_rss_bytes' not in _list_records[0]
+    assert _list_records[0]['worker_peak_rss_bytes'] > 0
+
+    _dict_stages = aggregate_task_metrics(_list_records)
+    assert _dict_stages['download_trade_zip']['phases']['download'] == pytest.approx(1.5)
+    assert _dict_stages['download_trade_zip']['bytes_in'] == 100
+    assert _dict_stages['download_trade_zip']['peak_rss_bytes'] == _list_records[0]['worker_peak_rss_bytes']
@@ -0,0 +1,124 @@
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from datafile_storage import read_datafile
+from timebar_generate import calc_bin_statistics, build_timebar_dataframe, write_timebar_files_from_trades
+
+# ベクトル化する前のgroupby().apply()によるタイムバーの計算 (比較用の参照実装として、変更せずに残しておく)
+def reference_weighted_moment(values, weights, n, sum_weights = None, weighted_mean = None, weighted_var = None):
+    if sum_weights is not None:
+        _sum_weights = sum_weights
+    else:
+        _sum_weights = np.sum(weights)
+
+    if _sum_weights == 0:
+        return np.nan
+
+    if n == 1:
+        return np.sum(weights * values) / _sum_weights
+
+    if weighted_mean is not None:
+        _weighted_mean = weighted_mean
+    else:
+        _weighted_mean = np.sum(weights * values) / _sum_weights
+
+    if n == 2:
+        return np.sum(weights * (values - _weighted_mean) ** 2) / _sum_weights
+
+    if weighted_var is not None:
+        _weighted_var = weighted_var
+    else:
+        _weighted_var = np.sum(weights * (values - _weighted_mean) ** 2) / _sum_weights
+    _weighted_std = np.sqrt(_weighted_var)
+
+    if n == 4:
+        return np.sum(weights * ((values - _weighted_mean) / _weighted_std) ** n) / _sum_weights - 3
+    return np.sum(weights * ((values - _weighted_mean) / _weighted_std) ** n) / _sum_weights
+
+def reference_timebar(df_trades: pd.DataFrame, interval: int, datetime_from: datetime.datetime) -> pd.DataFrame:
+    _interval_str = f'{interval}S'
+    _datetime_to = datetime_from + datetime.timedelta(days = 1) - datetime.timedelta(microseconds = 1)
+
+    _df = df_trades.set_index('time', drop = True)
+
+    _df_timebar = _df['price'].resample(_interval_str, closed = 'left').ohlc()
+    _df_timebar = _df_timebar.reindex(pd.date_range(datetime_from, _datetime_to, freq = _interval_str, inclusive = 'both'))
+    _df_timebar['close'] = _df_timebar['close'].ffill()
+    _df_timebar['open'] = _df_timebar['open'].fillna(_df_timebar['close'])
+    _df_timebar['high'] = _df_timebar['high'].fillna(_df_timebar['close'])
+    _df_timebar['low'] = _df_timebar['low'].fillna(_df_timebar['close'])
+
+    def custom_resampler(x):
+        _total_quote_qty = x['quote_qty'].sum()
+        _buy_trade_count = len(x[x['is_buyer_maker'] == False].index)
+        _sell_trade_count = len(x) - _buy_trade_count
+        _buy_quote_qty = x.loc[x['is_buyer_maker'] == False, 'quote_qty'].sum().astype(float)
+        _sell_quote_qty = _total_quote_qty - _buy_quote_qty
+
+        _weighted_price_mean = reference_weighted_moment(x['price'], x['quote_qty'], 1, sum_weights = _total_quote_qty)
+        _weighted_price_var = reference_weighted_moment(x['price'], x['quote_qty'], 2, sum_weights = _total_quote_qty, weighted_mean = _weighted_price_mean)
+        _weighted_price_std = np.sqrt(_weighted_price_var)
+        _weighted_price_skew = reference_weighted_moment(x['price'], x['quote_qty'], 3, sum_weights = _total_quote_qty, weighted_mean = _weighted_price_mean, weighted_var = _weighted_price_var)
+        _weighted_price_kurt = reference_weighted_moment(x['price'], x['quote_qty'], 4, sum_weights = _total_quote_qty, weighted_mean = _weighted_price_mean, weighted_var = _weighted_price_var)
+
+        return pd.Series([_buy_trade_count, _sell_trade_count, _buy_quote_qty, _sell_quote_qty, _weighted_price_mean, _weighted_price_var, _weighted_price_skew, _weighted_price_kurt, _weighted_price_std], ['buy_trade_count', 'sell_trade_count', 'buy_quote_qty', 'sell_quote_qty', 'vw_price_mean', 'vw_price_var', 'vw_price_skew', 'vw_price_kurt', 'vw_price_std'])
+
+    _df_statistics = _df.groupby(pd.Grouper(freq = _interval_str)).apply(custom_resampler)
+    _df_timebar = pd.concat([_df_timebar, _df_statistics], axis = 1)
+    _df_timebar['buy_trade_count'] = _df_timebar['buy_trade_count'].fillna(0).astype(int)
+    _df_timebar['sell_trade_count'] = _df_timebar['sell_trade_count'].fillna(0).astype(int)
+
+    return _df_timebar
+
+# 最初の1秒に約定がなく、途中に約定のない時間帯があり、同じ価格だけの (分散が0の) バーを含む1日分の約定
+# 参照実装は約定のあるビンごとにPythonの関数を呼ぶので、約定は1日の最初の1時間半だけにする
+def make_trades(date: datetime.datetime) -> pd.DataFrame:
+    _rng = np.random.default_rng(0)
+    _num_trades = 20000
+    _offset_ms = np.sort(_rng.integers(1000, 90 * 60 * 1000, _num_trades))
+    _quiet = ((_offset_ms >= 10 * 60 * 1000) & (_offset_ms < 25 * 60 * 1000)) | ((_offset_ms >= 61 * 60 * 1000) & (_offset_ms < 63 * 60 * 1000))
+    _offset_ms = _offset_ms[~_quiet]
+    _price = 30000.0 + np.cumsum(_rng.choice([-0.5, 0.0, 0.0, 0.5], _offset_ms.size))
+    _qty = np.round(_rng.exponential(0.05, _offset_ms.size), 5) + 0.00001
+
+    # 1本のバーだけ同じ価格の約定にする
+    _flat = (_offset_ms >= 40 * 60 * 1000) & (_offset_ms < 40 * 60 * 1000 + 3000)
+    _price[_flat] = _price[_flat][0]
+
+    return pd.DataFrame({
+        'price': _price,
+        'quote_qty': _price * _qty,
+        'time': pd.Timestamp(date) + pd.to_timedelta(_offset_ms, unit = 'ms'),
+        'is_buyer_maker': _rng.random(_offset_ms.size) < 0.5,
+    })
+
+def assert_timebar_equal(df_actual: pd.DataFrame, df_expected: pd.DataFrame) -> None:
+    assert list(df_actual.columns) == list(df_expected.columns)
+    assert df_actual.index.equals(df_expected.index)
+    for _column in df_expected.columns:
+        assert df_actual[_column].dtype == df_expected[_column].dtype, _column
+        np.testing.assert_array_equal(df_actual[_column].isna().values, df_expected[_column].isna().values, err_msg = _column)
+        np.testing.assert_allclose(df_actual[_column].values, df_expected[_column].values, rtol = 1e-9, atol = 1e-9, equal_nan = True, err_msg = _column)
+
+@pytest.mark.parametrize('interval', [1, 60, 3600])
+def test_calc_bin_statistics_matches_reference(interval):
+    _date = datetime.datetime(2022, 1, 1)
+    _df_trades = make_trades(_date)
+
+    _index = pd.date_range(_date, _date + datetime.timedelta(days = 1), freq = f'{interval}S', inclusive = 'left')
+    _df_actual = build_timebar_dataframe(calc_bin_statistics(_df_trades, interval, _date), _index)
+
+    assert_timebar_equal(_df_actual, reference_timebar(_df_trades, interval, _date))
+
+# 複数の時間間隔をまとめて生成する場合は、1秒のビンから集約した結果が参照実装と一致すること
+def test_write_timebar_files_rollup_matches_reference(tmp_path):
+    _date = datetime.datetime(2022, 1, 1)
+    _df_trades = make_trades(_date)
+
+    _dict_results = write_timebar_files_from_trades(_df_trades, str(tmp_path), 'BTCUSDT', '2022-01-01', [1, 60, 3600], 'pickle')
+
+    for _interval in [1, 60, 3600]:
+        # 最初の1秒に約定がないので、1秒足だけは前日Closeで埋めるまではincompleteなファイルになる
+        assert _dict_results[_interval]['complete'] == (_interval != 1)
+        assert_timebar_equal(read_datafile(_dict_results[_interval]['timebar_file']), reference_timebar(_df_trades, _interval, _date))
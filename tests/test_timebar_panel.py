@@ -0,0 +1,39 @@
+import os
+import numpy as np
+import pandas as pd
+from datafile_storage import write_datafile
+from timebar_panel import load_timebar_panel
+
+# 銘柄ごとに2日分の60秒タイムバーファイルを書き込む (1銘柄目の最初の日の最初の10本はOHLCが0で埋められ、買いの約定がないバーも含む)
+def write_timebar_files(datadir: str, symbols: list) -> dict:
+    _rng = np.random.default_rng(0)
+    _dict_frames = {}
+    for _symbol_idx, _symbol in enumerate(symbols):
+        _list_df = []
+        for _day, _date in enumerate(['2022-01-01', '2022-01-02']):
+            _index = pd.date_range(_date, periods = 1440, freq = '60S')
+            _close = 100.0 * (_symbol_idx + 1) + np.cumsum(_rng.normal(0, 0.1, len(_index)))
+            _buy_quote_qty = _rng.exponential(100.0, len(_index)) * (_rng.random(len(_index)) < 0.7)
+            if _symbol_idx == 0 and _day == 0:
+                _close[:10] = 0.0
+                _buy_quote_qty[:10] = 0.0
+            _df = pd.DataFrame({'open': _close, 'high': _close, 'low': _close, 'close': _close, 'buy_quote_qty': _buy_quote_qty}, index = _index)
+            os.makedirs(f'{datadir}/timebar/{_symbol}/60', exist_ok = True)
+            write_datafile(_df, f'{datadir}/timebar/{_symbol}/60/{_symbol}-timebar-60sec-{_date}.pkl.gz', 'pickle')
+            _list_df.append(_df)
+        _dict_frames[_symbol] = pd.concat(_list_df, axis = 0)
+    return _dict_frames
+
+# 列を選んでも、約定のあったバーはNaNにならず、すべてが0の行だけがNaNになること
+def test_load_timebar_panel_projection(tmp_path):
+    _datadir = str(tmp_path / 'data')
+    _dict_frames = write_timebar_files(_datadir, ['AAAUSDT', 'BBBUSDT'])
+
+    _panel = load_timebar_panel(['AAAUSDT', 'BBBUSDT'], 60, ['buy_quote_qty'], datadir = _datadir)['buy_quote_qty']
+
+    assert _panel.shape == (2 * 1440, 2)
+    for _symbol, _df in _dict_frames.items():
+        _expected = _df['buy_quote_qty'].where((_df[['open', 'high', 'low', 'close']] != 0).any(axis = 1))
+        np.testing.assert_array_equal(_panel[_symbol].values, _expected.values)
+    assert _panel['AAAUSDT'].isna().sum() == 10
+    assert (_panel['AAAUSDT'] == 0).sum() > 0
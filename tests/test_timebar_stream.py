@@ -0,0 +1,177 @@
+import asyncio
+import datetime
+import shutil
+from decimal import Decimal
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+from datafile_storage import read_datafile, write_datafile
+from timebar_generate import calc_timebar_from_trades, write_timebar_files_from_trades, read_timebar_manifest
+from timebar_stream import TimebarStream, parse_trade_message, make_trade_messages, run_timebar_stream, serve_trades_replay
+
+intervals = [60, 300]
+
+# 1日分の約定履歴を作る関数
+# 最初の約定は0時0分に置き (前日Closeによらず1本目のバーが埋まるように)、aggTradeでまとめられるように同じ時刻・価格・売買方向の約定の連続も含める
+def make_trades(date_str: str, num_trades: int, first_id: int, seed: int) -> pd.DataFrame:
+    _rng = np.random.default_rng(seed)
+    _start_ms = pd.Timestamp(date_str).value // 1_000_000
+    _time_ms = np.sort(_start_ms + _rng.integers(0, 86_400_000, num_trades))
+    _time_ms[0] = _start_ms + 5
+    _price = np.round(30000.0 + np.cumsum(_rng.choice([-1, 0, 1], num_trades)) * 0.1, 1)
+    _is_buyer_maker = _rng.random(num_trades) < 0.5
+    _burst = np.flatnonzero(_rng.random(num_trades) < 0.3)
+    _burst = _burst[_burst > 0]
+    for _i in _burst:
+        _time_ms[_i] = _time_ms[_i - 1]
+        _price[_i] = _price[_i - 1]
+        _is_buyer_maker[_i] = _is_buyer_maker[_i - 1]
+    _qty = np.round(_rng.integers(1, 2000, num_trades) * 0.001, 3)
+
+    return pd.DataFrame({
+        'id': np.arange(first_id, first_id + num_trades, dtype = np.int64),
+        'price': _price,
+        'qty': _qty,
+        'quote_qty': [float(Decimal(repr(float(_p))) * Decimal(repr(float(_q)))) for _p, _q in zip(_price, _qty)],
+        'time': pd.to_datetime(_time_ms, unit = 'ms'),
+        'is_buyer_maker': _is_buyer_maker,
+    })
+
+# 約定履歴ファイルを作り、日付から約定履歴ファイル名への辞書を返す関数
+def make_trades_files(datadir: Path, dates: list) -> dict:
+    Path(f'{datadir}/trades/BTCUSDT').mkdir(parents = True, exist_ok = True)
+    _dict_files = {}
+    _first_id = 1
+    for _i, _date in enumerate(dates):
+        _df = make_trades(_date, 3000, _first_id, _i)
+        _first_id = _first_id + len(_df)
+        _dict_files[_date] = f'{datadir}/trades/BTCUSDT/BTCUSDT-trades-{_date}.pkl.gz'
+        write_datafile(_df, _dict_files[_date], 'pickle')
+    return _dict_files
+
+def get_timebar_filename(datadir: Path, interval: int, date_str: str) -> Path:
+    return Path(f'{datadir}/timebar/BTCUSDT/{interval}/BTCUSDT-timebar-{interval}sec-{date_str}.pkl.gz')
+
+# リプレイサーバーに接続し、サーバーが切断するまで受信する関数
+def run_replay(stream: TimebarStream, list_filenames: list, stream_type: str) -> None:
+    async def _main():
+        _runner = await serve_trades_replay(list_filenames, port = 0, stream_type = stream_type)
+        try:
+            _port = _runner.addresses[0][1]
+            await run_timebar_stream(stream, f'ws://127.0.0.1:{_port}/ws', stream_type, use_wall_clock = False)
+        finally:
+            await _runner.cleanup()
+
+    asyncio.run(_main())
+
+# tradeストリームから書き込んだタイムバーファイルは、calc_timebar_from_tradesで約定履歴ファイルから生成したものとバイト単位で同じになること
+def test_trade_stream_matches_calc_timebar_from_trades(tmp_path):
+    _dates = ['2022-01-01', '2022-01-02', '2022-01-03']
+    _dict_files = make_trades_files(tmp_path / 'reference', _dates)
+
+    _stream = TimebarStream('BTCUSDT', intervals, str(tmp_path / 'stream'), 'pickle', from_day_start = True)
+    run_replay(_stream, list(_dict_files.values()), 'trade')
+
+    for _date in _dates[:2]:
+        calc_timebar_from_trades(0, _dict_files[_date], intervals, 'pickle')
+        for _interval in intervals:
+            assert get_timebar_filename(tmp_path / 'stream', _interval, _date).read_bytes() == get_timebar_filename(tmp_path / 'reference', _interval, _date).read_bytes()
+    # 次の日の約定を受信する前に切断された最後の日は書き込まない
+    assert get_timebar_filename(tmp_path / 'stream', 60, _dates[2]).exists() == False
+
+# aggTradeストリームでは約定回数をl - f + 1で数えるので、約定回数とOHLCは約定履歴ファイルから生成したものと同じになり、
+# タイムバーファイルは同じaggTradeから生成したものとバイト単位で同じになること
+def test_agg_trade_stream_counts_trades(tmp_path):
+    _dates = ['2022-01-01', '2022-01-02']
+    _dict_files = make_trades_files(tmp_path / 'reference', _dates)
+
+    _stream = TimebarStream('BTCUSDT', intervals, str(tmp_path / 'stream'), 'pickle', from_day_start = True)
+    run_replay(_stream, list(_dict_files.values()), 'aggTrade')
+
+    _date = _dates[0]
+    _df_trades = read_datafile(_dict_files[_date])
+    _list_messages = make_trade_messages(_df_trades, 'BTCUSDT', 'aggTrade')
+    assert len(_list_messages) < len(_df_trades)
+    _list_trades = [parse_trade_message(_) for _ in _list_messages]
+    assert sum([_[5] for _ in _list_trades]) == len(_df_trades)
+
+    _df_agg_trades = pd.DataFrame({
+        'price': [_[0] for _ in _list_trades],
+        'quote_qty': [_[2] for _ in _list_trades],
+        'time': pd.to_datetime([_[3] for _ in _list_trades], unit = 'ms'),
+        'is_buyer_maker': [_[4] for _ in _list_trades],
+        'trade_count': [_[5] for _ in _list_trades],
+    })
+    write_timebar_files_from_trades(_df_agg_trades, str(tmp_path / 'aggregated'), 'BTCUSDT', _date, intervals, 'pickle')
+    calc_timebar_from_trades(0, _dict_files[_date], intervals, 'pickle')
+
+    for _interval in intervals:
+        assert get_timebar_filename(tmp_path / 'stream', _interval, _date).read_bytes() == get_timebar_filename(tmp_path / 'aggregated', _interval, _date).read_bytes()
+
+        _df_stream = read_datafile(str(get_timebar_filename(tmp_path / 'stream', _interval, _date)))
+        _df_reference = read_datafile(str(get_timebar_filename(tmp_path / 'reference', _interval, _date)))
+        _exact_columns = ['open', 'high', 'low', 'close', 'buy_trade_count', 'sell_trade_count']
+        pd.testing.assert_frame_equal(_df_stream[_exact_columns], _df_reference[_exact_columns])
+        np.testing.assert_allclose(_df_stream['buy_quote_qty'].values, _df_reference['buy_quote_qty'].values, rtol = 1e-12)
+        np.testing.assert_allclose(_df_stream['vw_price_mean'].values, _df_reference['vw_price_mean'].values, rtol = 1e-12)
+
+# 途中で切断された日と、再接続してから最初の約定までに日が変わった日はタイムバーファイルもマニフェストも書き込まず、
+# 切断をはさまずに受信した日は約定履歴ファイルから生成したものと同じになること
+def test_disconnect_marks_days_incomplete(tmp_path):
+    _dates = ['2022-01-01', '2022-01-02', '2022-01-03', '2022-01-04', '2022-01-05']
+    _dict_files = make_trades_files(tmp_path / 'reference', _dates)
+
+    # 1回目の接続は2日目の途中で切断される
+    Path(f'{tmp_path}/partial').mkdir()
+    _partial_file = f'{tmp_path}/partial/BTCUSDT-trades-2022-01-02.pkl.gz'
+    _df_day2 = read_datafile(_dict_files['2022-01-02'])
+    write_datafile(_df_day2.iloc[:len(_df_day2) // 2], _partial_file, 'pickle')
+
+    _stream = TimebarStream('BTCUSDT', intervals, str(tmp_path / 'stream'), 'pickle', from_day_start = True)
+    run_replay(_stream, [_dict_files['2022-01-01'], _partial_file], 'trade')
+    run_replay(_stream, [_dict_files[_] for _ in _dates[2:]], 'trade')
+
+    for _date in ['2022-01-01', '2022-01-04']:
+        calc_timebar_from_trades(0, _dict_files[_date], intervals, 'pickle')
+        for _interval in intervals:
+            assert get_timebar_filename(tmp_path / 'stream', _interval, _date).read_bytes() == get_timebar_filename(tmp_path / 'reference', _interval, _date).read_bytes()
+    for _date in ['2022-01-02', '2022-01-03', '2022-01-05']:
+        assert len(list(Path(f'{tmp_path}/stream/timebar/BTCUSDT/60').glob(f'*{_date}*'))) == 0
+
+    for _interval in intervals:
+        _manifest = read_timebar_manifest(str(tmp_path / 'stream'), 'BTCUSDT', _interval)
+        assert sorted(_manifest['days'].keys()) == ['2022-01-01', '2022-01-04']
+        assert all(_['complete'] == True for _ in _manifest['days'].values())
+
+# 壁時計で閉じたバーの後に届いた約定は配信済みのバーを変えずに数え、その日のタイムバーファイルには時刻に従って含めること
+# 書き込み済みの前日の約定は捨てて数えること
+def test_late_trades(tmp_path):
+    _stream = TimebarStream('BTCUSDT', [60], str(tmp_path), 'pickle', from_day_start = True)
+    _list_emitted = []
+    _stream.add_subscriber(lambda symbol, interval, time, row: _list_emitted.append((time, row)))
+
+    _start_ms = pd.Timestamp('2022-01-01').value // 1_000_000
+    _stream.process_trade(100.0, 1.0, 100.0, _start_ms + 1_000, False, 1)
+    _stream.process_trade(101.0, 1.0, 101.0, _start_ms + 30_000, True, 1)
+    _stream.advance_time((_start_ms + 90_000) * 1_000_000)
+    assert len(_list_emitted) == 1
+    _emitted_row = dict(_list_emitted[0][1])
+
+    # 0時0分のバーは閉じているので、配信済みのバーには加えない
+    _stream.process_trade(99.0, 1.0, 99.0, _start_ms + 50_000, False, 3)
+    assert _stream.late_trade_count == 3
+    assert _list_emitted[0][1] == _emitted_row
+    _stream.process_trade(102.0, 1.0, 102.0, _start_ms + 100_000, False, 1)
+
+    # 次の日の約定で前日のファイルが書き込まれ、その後に届いた前日の約定は捨てる
+    _stream.process_trade(103.0, 1.0, 103.0, _start_ms + 86_400_000, False, 1)
+    _stream.process_trade(98.0, 1.0, 98.0, _start_ms + 86_399_000, False, 2)
+    assert _stream.dropped_trade_count == 2
+
+    _df_timebar = read_datafile(str(tmp_path / 'timebar/BTCUSDT/60/BTCUSDT-timebar-60sec-2022-01-01.pkl.gz'))
+    assert _df_timebar['buy_trade_count'].iloc[0] == 4
+    assert _df_timebar['sell_trade_count'].iloc[0] == 1
+    assert _df_timebar['low'].iloc[0] == 99.0
+    assert _df_timebar['close'].iloc[0] == 99.0
+    assert _df_timebar['buy_trade_count'].sum() == 5
@@ -0,0 +1,137 @@
+import asyncio
+import io
+import threading
+import time
+import zipfile
+from pathlib import Path
+import pandas as pd
+import pytest
+import trades_download
+from trades_download import estimate_download_worker_memory_bytes, estimate_download_n_jobs, download_trade_files_async
+from datafile_storage import read_datafile
+
+# 1日分を溜めてから書き込むpickleとcompactは、チャンクごとに書き出す列指向形式より多くのメモリを見積もること
+def test_estimate_download_worker_memory_bytes_by_format():
+    _columnar_bytes = estimate_download_worker_memory_bytes('parquet')
+    assert estimate_download_worker_memory_bytes('arrow') == _columnar_bytes
+    for _fmt in ['pickle', 'compact']:
+        assert estimate_download_worker_memory_bytes(_fmt) >= _columnar_bytes + 2 * trades_download.trade_day_max_rows * trades_download.trade_frame_row_bytes
+
+def test_estimate_download_n_jobs_uses_format_budget(monkeypatch):
+    monkeypatch.setattr(trades_download.os, 'cpu_count', lambda: 64)
+    monkeypatch.setattr(trades_download, 'get_available_memory_bytes', lambda: 8 * 1024 ** 3)
+
+    assert estimate_download_n_jobs('parquet') == 8 * 1024 ** 3 // estimate_download_worker_memory_bytes('parquet')
+    assert estimate_download_n_jobs('pickle') == 8 * 1024 ** 3 // estimate_download_worker_memory_bytes('pickle')
+    assert estimate_download_n_jobs('pickle') < estimate_download_n_jobs('parquet')
+
+# テスト用の約定履歴の.zipのバイト列を作る関数 (with_csv = Falseの場合はCSVを含まない壊れたzip)
+def make_trade_zip_bytes(target_file_name: str, with_csv: bool = True) -> bytes:
+    _stem = Path(target_file_name).stem
+    _buffer = io.BytesIO()
+    with zipfile.ZipFile(_buffer, 'w') as _zip:
+        if with_csv == True:
+            _lines = ['id,price,qty,quote_qty,time,is_buyer_maker'] + [f'{_i},{30000 + _i}.5,0.01{_i},{(30000 + _i + 0.5) * 0.01:.4f},{1640995200000 + _i * 1000},{"true" if _i % 2 == 0 else "false"}' for _i in range(10)]
+            _zip.writestr(f'{_stem}.csv', '\n'.join(_lines) + '\n')
+        else:
+            _zip.writestr('README.txt', 'no trades')
+    return _buffer.getvalue()
+
+# パスごとに、.zipを返す前に返すレスポンス (ステータスコード, ヘッダー) の列を指定できるaiohttpのテスト用サーバー
+# 別スレッドのイベントループで動かし、リクエストを受けた時刻をパスごとに記録する
+@pytest.fixture
+def trade_zip_server():
+    from aiohttp import web
+
+    _dict_files = {}
+    _dict_responses = {}
+    _dict_requests = {}
+
+    async def _handler(request):
+        _path = request.match_info['path']
+        _dict_requests.setdefault(_path, []).append(time.monotonic())
+        _list_responses = _dict_responses.get(_path, [])
+        if len(_list_responses) > 0:
+            _status, _headers = _list_responses.pop(0)
+            return web.Response(status = _status, headers = _headers)
+        if _path not in _dict_files:
+            return web.Response(status = 404)
+        return web.Response(body = _dict_files[_path])
+
+    _app = web.Application()
+    _app.router.add_get('/trades/{path:.+}', _handler)
+    _runner = web.AppRunner(_app)
+    _loop = asyncio.new_event_loop()
+    _thread = threading.Thread(target = _loop.run_forever, daemon = True)
+    _thread.start()
+    asyncio.run_coroutine_threadsafe(_runner.setup(), _loop).result()
+    _site = web.TCPSite(_runner, '127.0.0.1', 0)
+    asyncio.run_coroutine_threadsafe(_site.start(), _loop).result()
+    _port = _runner.addresses[0][1]
+
+    yield {'base_url': f'http://127.0.0.1:{_port}/trades', 'files': _dict_files, 'responses': _dict_responses, 'requests': _dict_requests}
+
+    asyncio.run_coroutine_threadsafe(_runner.cleanup(), _loop).result()
+    _loop.call_soon_threadsafe(_loop.stop)
+    _thread.join()
+
+def download_from_server(server: dict, target_file_names: list, datadir: str) -> list:
+    return asyncio.run(download_trade_files_async(target_file_names, datadir, 'pickle', concurrency = 2, n_workers = 1, base_url = server['base_url']))
+
+@pytest.fixture
+def fast_retry(monkeypatch):
+    monkeypatch.setattr(trades_download, 'async_retry_base_wait', 0.01)
+
+def test_download_async_200(tmp_path, trade_zip_server):
+    _name = 'BTCUSDT-trades-2022-01-01.zip'
+    trade_zip_server['files'][f'BTCUSDT/{_name}'] = make_trade_zip_bytes(_name)
+    (tmp_path / 'trades' / 'BTCUSDT').mkdir(parents = True)
+
+    assert download_from_server(trade_zip_server, [_name], str(tmp_path)) == [True]
+
+    _df = read_datafile(str(tmp_path / 'trades' / 'BTCUSDT' / 'BTCUSDT-trades-2022-01-01.pkl.gz'))
+    assert len(_df) == 10
+    assert _df['time'].iloc[0] == pd.Timestamp('2022-01-01')
+    assert sorted(_.name for _ in (tmp_path / 'trades' / 'BTCUSDT').iterdir()) == ['BTCUSDT-trades-2022-01-01.pkl.gz']
+
+# 429の場合はRetry-Afterの秒数だけ待ってからリトライすること
+def test_download_async_429_retry_after(tmp_path, trade_zip_server, fast_retry):
+    _name = 'BTCUSDT-trades-2022-01-01.zip'
+    trade_zip_server['files'][f'BTCUSDT/{_name}'] = make_trade_zip_bytes(_name)
+    trade_zip_server['responses'][f'BTCUSDT/{_name}'] = [(429, {'Retry-After': '0.5'})]
+    (tmp_path / 'trades' / 'BTCUSDT').mkdir(parents = True)
+
+    assert download_from_server(trade_zip_server, [_name], str(tmp_path)) == [True]
+
+    _list_requests = trade_zip_server['requests'][f'BTCUSDT/{_name}']
+    assert len(_list_requests) == 2
+    assert _list_requests[1] - _list_requests[0] >= 0.45
+
+# 5xxの場合はバックオフしながらリトライし、リトライ回数を使い切ったファイルだけが失敗になること
+def test_download_async_5xx_retry(tmp_path, trade_zip_server, fast_retry):
+    _name_ok = 'BTCUSDT-trades-2022-01-01.zip'
+    _name_ng = 'BTCUSDT-trades-2022-01-02.zip'
+    for _name in [_name_ok, _name_ng]:
+        trade_zip_server['files'][f'BTCUSDT/{_name}'] = make_trade_zip_bytes(_name)
+    trade_zip_server['responses'][f'BTCUSDT/{_name_ok}'] = [(500, {}), (503, {})]
+    trade_zip_server['responses'][f'BTCUSDT/{_name_ng}'] = [(502, {})] * trades_download.async_retry_max_attempts
+    (tmp_path / 'trades' / 'BTCUSDT').mkdir(parents = True)
+
+    assert download_from_server(trade_zip_server, [_name_ok, _name_ng], str(tmp_path)) == [True, False]
+
+    assert len(trade_zip_server['requests'][f'BTCUSDT/{_name_ok}']) == 3
+    assert len(trade_zip_server['requests'][f'BTCUSDT/{_name_ng}']) == trades_download.async_retry_max_attempts
+    assert sorted(_.name for _ in (tmp_path / 'trades' / 'BTCUSDT').iterdir()) == ['BTCUSDT-trades-2022-01-01.pkl.gz']
+
+# zipにCSVがない (KeyError) などリトライしても直らない失敗は、そのファイルだけを失敗にして書きかけのファイルを残さないこと
+def test_download_async_per_file_failure(tmp_path, trade_zip_server, fast_retry):
+    _name_ok = 'BTCUSDT-trades-2022-01-01.zip'
+    _name_ng = 'BTCUSDT-trades-2022-01-02.zip'
+    trade_zip_server['files'][f'BTCUSDT/{_name_ok}'] = make_trade_zip_bytes(_name_ok)
+    trade_zip_server['files'][f'BTCUSDT/{_name_ng}'] = make_trade_zip_bytes(_name_ng, with_csv = False)
+    (tmp_path / 'trades' / 'BTCUSDT').mkdir(parents = True)
+
+    assert download_from_server(trade_zip_server, [_name_ng, _name_ok], str(tmp_path)) == [False, True]
+
+    assert len(trade_zip_server['requests'][f'BTCUSDT/{_name_ng}']) == 1
+    assert sorted(_.name for _ in (tmp_path / 'trades' / 'BTCUSDT').iterdir()) == ['BTCUSDT-trades-2022-01-01.pkl.gz']
@@ -1,101 +1,341 @@
 import pandas as pd
 import numpy as np
+import json
 from pathlib import Path
 import joblib
 import re
 import datetime
 import argparse
-from exercise_util import tqdm_joblib, identify_datafiles, target_symbols
+from exercise_core import tqdm_joblib, identify_datafiles, target_symbols
+from weighted_moment import WeightedMomentAccumulator
+from trade_size_sketch import TradeSizeHistogram
+from task_scheduler import run_task_graph
+from pipeline_metrics import task_metrics, current_task_metrics, enable_task_metrics, export_task_metrics, metrics_profilers
+from datafile_storage import datafile_extensions, datafile_extension_pattern, get_dataset_format, identify_datafile_format, find_datafile, read_datafile, write_datafile
 
 datadir = 'data/binance'
 
+# 約定金額などを重みとした加重平均 (n = 1)、加重分散 (n = 2)、加重歪度 (n = 3)、加重尖度 (n = 4) を求める関数
+# WeightedMomentAccumulatorで計算する (sum_weights, weighted_mean, weighted_varは以前の呼び出し方との互換性のために残しているが使わない)
 def calc_weighted_moment(values, weights, n, sum_weights = None, weighted_mean = None, weighted_var = None):
-    assert n > 0
+    assert n in (1, 2, 3, 4)
     assert values.shape == weights.shape
 
-    if sum_weights is not None:
-        _sum_weights = sum_weights
+    return float(WeightedMomentAccumulator.from_array(np.asarray(values, dtype = float), np.asarray(weights, dtype = float)).moment(n))
+
+# 約定履歴から、タイムバーの各ビンのOHLC、売買別の約定回数と約定金額、約定金額加重の価格モーメントをまとめて計算する関数
+# groupby().apply()でビンごとにPythonの関数を呼ぶ代わりに、ビンのインデックスとnp.bincountでベクトル化して1回のパスで計算する
+# size_sketch = Trueの場合は、約定金額のヒストグラム (TradeSizeHistogram) も計算する
+# trade_count列がある場合は、1行が同じ時刻・価格・売買方向の複数の約定をまとめたもの (aggTrade) として、その値を約定回数に数える
+def calc_bin_statistics(df_trades: pd.DataFrame = None, interval: int = None, datetime_from: datetime.datetime = None, size_sketch: bool = False) -> dict:
+    assert df_trades is not None
+    assert interval is not None
+    assert datetime_from is not None
+
+    _num_bins = 86400 // interval
+
+    _time = df_trades['time'].values.astype('datetime64[ns]').astype(np.int64)
+    _price = df_trades['price'].values.astype(float)
+    _quote_qty = df_trades['quote_qty'].values.astype(float)
+    _is_buy = (df_trades['is_buyer_maker'].values == False)
+    _trade_count = df_trades['trade_count'].values.astype(np.int64) if 'trade_count' in df_trades.columns else None
+
+    # 時刻順に並んでいない場合は、OHLCのために安定ソートしておく
+    if _time.size > 1 and np.any(_time[1:] < _time[:-1]):
+        _order = np.argsort(_time, kind = 'stable')
+        _time = _time[_order]
+        _price = _price[_order]
+        _quote_qty = _quote_qty[_order]
+        _is_buy = _is_buy[_order]
+        if _trade_count is not None:
+            _trade_count = _trade_count[_order]
+
+    # 各約定が属するビンのインデックスを求め、対象の日に含まれない約定は捨てる
+    _bin = (_time - pd.Timestamp(datetime_from).value) // (interval * 1_000_000_000)
+    _in_range = (_bin >= 0) & (_bin < _num_bins)
+    _bin = _bin[_in_range]
+    _price = _price[_in_range]
+    _quote_qty = _quote_qty[_in_range]
+    _is_buy = _is_buy[_in_range]
+    if _trade_count is not None:
+        _trade_count = _trade_count[_in_range]
+
+    return calc_group_statistics(_bin, _price, _quote_qty, _is_buy, _num_bins, size_sketch, _trade_count)
+
+# ビンのインデックスごとにOHLC、売買別の約定回数と約定金額、約定金額加重の価格モーメントをまとめて計算する関数
+# groupは約定ごとのビンのインデックス (0以上num_groups未満) で、同じビンの約定は連続して時刻順に並んでいる必要がある
+# size_sketch = Trueの場合は、ビンごとの約定金額のヒストグラムを'size_histogram'に入れる
+# trade_countに行ごとの約定回数を渡すと、約定回数を行数の代わりにその合計で数える (省略時は1行を1回とする)
+def calc_group_statistics(group: np.ndarray = None, price: np.ndarray = None, quote_qty: np.ndarray = None, is_buy: np.ndarray = None, num_groups: int = None, size_sketch: bool = False, trade_count: np.ndarray = None) -> dict:
+    assert group is not None
+    assert price is not None
+    assert quote_qty is not None
+    assert is_buy is not None
+    assert num_groups is not None
+
+    # 約定回数と約定金額
+    if trade_count is None:
+        _trade_count = np.bincount(group, minlength = num_groups)
+        _buy_trade_count = np.bincount(group, weights = is_buy, minlength = num_groups).astype(np.int64)
     else:
-        _sum_weights = np.sum(weights)
+        _trade_count = np.bincount(group, weights = trade_count, minlength = num_groups).astype(np.int64)
+        _buy_trade_count = np.bincount(group, weights = np.where(is_buy, trade_count, 0), minlength = num_groups).astype(np.int64)
+    _sell_trade_count = _trade_count - _buy_trade_count
+    _quote_qty_sum = np.bincount(group, weights = quote_qty, minlength = num_groups)
+    _buy_quote_qty = np.bincount(group, weights = np.where(is_buy, quote_qty, 0.0), minlength = num_groups)
+
+    # OHLC (約定はビンごとに連続して並んでいるので、ビンの先頭と末尾の位置からreduceatで求める)
+    _open = np.full(num_groups, np.nan)
+    _high = np.full(num_groups, np.nan)
+    _low = np.full(num_groups, np.nan)
+    _close = np.full(num_groups, np.nan)
+    if group.size > 0:
+        _starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+        _ends = np.r_[_starts[1:], group.size] - 1
+        _active_groups = group[_starts]
+        _open[_active_groups] = price[_starts]
+        _high[_active_groups] = np.maximum.reduceat(price, _starts)
+        _low[_active_groups] = np.minimum.reduceat(price, _starts)
+        _close[_active_groups] = price[_ends]
+
+    # 約定金額加重の平均と、平均まわりの2〜4次の加重モーメントの和
+    _moments = WeightedMomentAccumulator.from_array(price, quote_qty, group, num_groups)
+
+    _dict_statistics = {
+        'open': _open,
+        'high': _high,
+        'low': _low,
+        'close': _close,
+        'buy_trade_count': _buy_trade_count,
+        'sell_trade_count': _sell_trade_count,
+        'quote_qty': _quote_qty_sum,
+        'buy_quote_qty': _buy_quote_qty,
+        'vw_mean': _moments.mean,
+        'vw_m2': _moments.m2,
+        'vw_m3': _moments.m3,
+        'vw_m4': _moments.m4,
+    }
+    if size_sketch == True:
+        _dict_statistics['size_histogram'] = TradeSizeHistogram.from_array(quote_qty, group, num_groups)
+
+    return _dict_statistics
+
+# calc_bin_statisticsの結果の約定金額加重のモーメントを、ビンごとの集計器の配列にする関数
+def get_moment_accumulator(dict_statistics: dict = None) -> WeightedMomentAccumulator:
+    assert dict_statistics is not None
+
+    return WeightedMomentAccumulator(dict_statistics['buy_trade_count'] + dict_statistics['sell_trade_count'], dict_statistics['quote_qty'], np.where(dict_statistics['quote_qty'] != 0, dict_statistics['vw_mean'], 0.0), dict_statistics['vw_m2'], dict_statistics['vw_m3'], dict_statistics['vw_m4'])
+
+# calc_bin_statisticsの結果を、factor本ずつまとめた粗いビンの統計量に集約する関数
+# 加重モーメントは各ビンの加重平均と平均まわりのモーメントの和から、約定金額のヒストグラムはビンごとの和から厳密に合成するので、約定履歴を読み直す必要はない
+def rollup_bin_statistics(dict_statistics: dict = None, factor: int = None) -> dict:
+    assert dict_statistics is not None
+    assert factor is not None
+    assert len(dict_statistics['open']) % factor == 0
+
+    if factor == 1:
+        return dict_statistics
+
+    def _reshape(key):
+        return dict_statistics[key].reshape(-1, factor)
+
+    # Open/Closeは各グループで最初/最後に約定があったビンの値、High/Lowは最大/最小
+    _open = _reshape('open')
+    _close = _reshape('close')
+    _has_trade = ~np.isnan(_open)
+    _any_trade = _has_trade.any(axis = 1)
+    _rows = np.arange(_open.shape[0])
+    _first = np.argmax(_has_trade, axis = 1)
+    _last = factor - 1 - np.argmax(_has_trade[:, ::-1], axis = 1)
+    with np.errstate(all = 'ignore'):
+        _rollup_open = np.where(_any_trade, _open[_rows, _first], np.nan)
+        _rollup_close = np.where(_any_trade, _close[_rows, _last], np.nan)
+        _rollup_high = np.where(_any_trade, np.fmax.reduce(_reshape('high'), axis = 1), np.nan)
+        _rollup_low = np.where(_any_trade, np.fmin.reduce(_reshape('low'), axis = 1), np.nan)
+
+    # 加重平均まわりのモーメントの和は、各ビンの集計器を集約後の加重平均まわりに平行移動して合成する
+    _moments = get_moment_accumulator(dict_statistics).rollup(factor)
+
+    _dict_rollup = {
+        'open': _rollup_open,
+        'high': _rollup_high,
+        'low': _rollup_low,
+        'close': _rollup_close,
+        'buy_trade_count': _reshape('buy_trade_count').sum(axis = 1),
+        'sell_trade_count': _reshape('sell_trade_count').sum(axis = 1),
+        'quote_qty': _moments.sum_weights,
+        'buy_quote_qty': _reshape('buy_quote_qty').sum(axis = 1),
+        'vw_mean': _moments.mean,
+        'vw_m2': _moments.m2,
+        'vw_m3': _moments.m3,
+        'vw_m4': _moments.m4,
+    }
+    if 'size_histogram' in dict_statistics:
+        _dict_rollup['size_histogram'] = dict_statistics['size_histogram'].rollup(factor)
+
+    return _dict_rollup
+
+# calc_bin_statisticsの結果から、タイムバーファイルに保存するデータフレームを作る関数
+# 約定金額のヒストグラムがある場合は、ビンごとの約定回数と約定金額の列 (size_count_*, size_quote_*) を後ろに追加する
+def build_timebar_dataframe(dict_statistics: dict = None, index: pd.DatetimeIndex = None) -> pd.DataFrame:
+    assert dict_statistics is not None
+    assert index is not None
+
+    _trade_count = dict_statistics['buy_trade_count'] + dict_statistics['sell_trade_count']
+    _quote_qty = dict_statistics['quote_qty']
+    _buy_quote_qty = dict_statistics['buy_quote_qty']
+    _sell_quote_qty = _quote_qty - _buy_quote_qty
+
+    # 最初の約定より前と最後の約定より後のビンは、約定金額をNaNにする (約定のないビンでも、その間にあるものは0になる)
+    _active_bins = np.flatnonzero(_trade_count > 0)
+    _outside = np.ones(len(index), dtype = bool)
+    if _active_bins.size > 0:
+        _outside[_active_bins[0]:_active_bins[-1] + 1] = False
+    _buy_quote_qty = np.where(_outside, np.nan, _buy_quote_qty)
+    _sell_quote_qty = np.where(_outside, np.nan, _sell_quote_qty)
+
+    # 約定金額加重の分散、標準偏差、歪度、尖度
+    # 分散が0のビンの歪度と尖度はcalc_weighted_momentと同じく0と-3にする
+    _moments = get_moment_accumulator(dict_statistics)
+    _vw_price_var = _moments.var
+
+    _df_timebar = pd.DataFrame({
+        'open': dict_statistics['open'],
+        'high': dict_statistics['high'],
+        'low': dict_statistics['low'],
+        'close': dict_statistics['close'],
+        'buy_trade_count': dict_statistics['buy_trade_count'].astype(int),
+        'sell_trade_count': dict_statistics['sell_trade_count'].astype(int),
+        'buy_quote_qty': _buy_quote_qty,
+        'sell_quote_qty': _sell_quote_qty,
+        'vw_price_mean': _moments.mean,
+        'vw_price_var': _vw_price_var,
+        'vw_price_skew': _moments.skew,
+        'vw_price_kurt': _moments.kurt,
+        'vw_price_std': np.sqrt(_vw_price_var),
+    }, index = index)
+    if 'size_histogram' in dict_statistics:
+        _df_timebar = pd.concat([_df_timebar, pd.DataFrame(dict_statistics['size_histogram'].to_columns(), index = index)], axis = 1)
+
+    # 約定がなかった時間について、直前の値などを使ってNaNを埋めていく
+    _df_timebar['close'] = _df_timebar['close'].ffill()
+    _df_timebar['open'] = _df_timebar['open'].fillna(_df_timebar['close'])
+    _df_timebar['high'] = _df_timebar['high'].fillna(_df_timebar['close'])
+    _df_timebar['low'] = _df_timebar['low'].fillna(_df_timebar['close'])
 
-    if _sum_weights == 0:
-        return np.nan
+    return _df_timebar
+        
+# 約定履歴ファイルを1回だけ読み込み、指定された全ての時間間隔のタイムバーファイルを生成する関数
+# intervalにはint、またはintのリストを指定する。最も細かい共通の間隔でビンごとの統計量を計算し、粗い間隔はそこから集約する
+# タイムバーファイルはfmtで指定された形式 (省略時はpkl.gz) で保存する
+# previous_closesに時間間隔ごとの前日Closeを渡すと、一日の始まりのOpenがNaNの場合にその場で埋める
+# size_sketch = Trueの場合は、バーごとの約定金額のヒストグラムの列も保存する
+# 戻り値は (idx, 時間間隔ごとのマニフェストのエントリの辞書)
+def calc_timebar_from_trades(idx, filename, interval, fmt = None, previous_closes: dict = None, size_sketch: bool = False):
+    _m = re.match(f'(.+)/trades/(.+?)/.*-trades-(\\d{{4}}-\\d{{2}}-\\d{{2}}){datafile_extension_pattern}$', filename)
+    _datadir = _m.group(1)
+    _symbol = _m.group(2)
+    _date = _m.group(3)
 
-    if n == 1:
-        return np.sum(weights * values) / _sum_weights
+    with task_metrics('calc_timebar_from_trades', f'{_symbol} {_date}') as _metrics:
+        with _metrics.phase('read'):
+            _df = read_datafile(filename, columns = ['price', 'quote_qty', 'time', 'is_buyer_maker'])
+        _metrics.add_file_in(filename)
+        _metrics.add_rows(len(_df))
 
-    if weighted_mean is not None:
-        _weighted_mean = weighted_mean
-    else:
-        _weighted_mean = np.sum(weights * values) / _sum_weights
+        return (idx, write_timebar_files_from_trades(_df, _datadir, _symbol, _date, interval, fmt, previous_closes, size_sketch))
 
-    if n == 2:
-        return np.sum(weights * (values - _weighted_mean) ** 2) / _sum_weights
+# 1日分の約定履歴のデータフレーム (price, quote_qty, time, is_buyer_maker列、aggTradeの場合はtrade_count列も) から、指定された全ての時間間隔のタイムバーファイルを生成する関数
+# 約定履歴ファイルから生成する場合と、リアルタイムに受信した約定から生成する場合で同じファイルになるように、ここで書き込みまで行う
+# 戻り値は時間間隔ごとのマニフェストのエントリの辞書
+def write_timebar_files_from_trades(df_trades: pd.DataFrame = None, datadir: str = None, symbol: str = None, date_str: str = None, interval = None, fmt: str = None, previous_closes: dict = None, size_sketch: bool = False) -> dict:
+    assert df_trades is not None
+    assert datadir is not None
+    assert symbol is not None
+    assert date_str is not None
+    assert interval is not None
 
-    if weighted_var is not None:
-        _weighted_var = weighted_var
+    if isinstance(interval, (list, tuple, set)):
+        _list_intervals = sorted(set(int(_) for _ in interval))
     else:
-        _weighted_var = np.sum(weights * (values - _weighted_mean) ** 2) / _sum_weights
-    _weighted_std = np.sqrt(_weighted_var)
+        _list_intervals = [int(interval)]
+    assert len(_list_intervals) > 0
+    assert all(86400 % _ == 0 for _ in _list_intervals)
 
-    if n == 4:
-        return np.sum(weights * ((values - _weighted_mean) / _weighted_std) ** n) / _sum_weights - 3
-    return np.sum(weights * ((values - _weighted_mean) / _weighted_std) ** n) / _sum_weights
-        
-def calc_timebar_from_trades(idx, filename, interval):
-    _interval_str = f'{interval}S'
+    _fmt = get_dataset_format('timebar', fmt)
+    _ext = datafile_extensions[_fmt]
 
-    _m = re.match('(.+)/trades/(.+?)/.*-trades-(\d{4})-(\d{2})-(\d{2})\.pkl\.gz', filename)
-    _datadir = _m.group(1)
-    _symbol = _m.group(2)
-    _year = _m.group(3)
-    _month = _m.group(4)
-    _day = _m.group(5)
+    _m = re.match('(\\d{4})-(\\d{2})-(\\d{2})$', date_str)
+    _year = _m.group(1)
+    _month = _m.group(2)
+    _day = _m.group(3)
     _datetime_from = datetime.datetime(year = int(_year), month = int(_month), day = int(_day), hour = 0, minute = 0, second = 0)
     _datetime_to = datetime.datetime(year = int(_year), month = int(_month), day = int(_day), hour = 23, minute = 59, second = 59, microsecond = 999999)
 
-    _df = pd.read_pickle(filename).set_index('time', drop = True)
-
-    # リサンプルされたOHLCを作る
-    _df_timebar = _df['price'].resample(_interval_str, closed = 'left').ohlc()
-
-    # リサンプル対象がなかった時間について、直前の値などを使ってNaNを埋めていく
-    _df_timebar = _df_timebar.reindex(pd.date_range(_datetime_from, _datetime_to, freq = _interval_str, inclusive = 'both'))
-    _df_timebar['close'] = _df_timebar['close'].fillna(method = 'ffill')
-    _df_timebar['open'] = _df_timebar['open'].fillna(_df_timebar['close'])
-    _df_timebar['high'] = _df_timebar['high'].fillna(_df_timebar['close'])
-    _df_timebar['low'] = _df_timebar['low'].fillna(_df_timebar['close'])
-
-    def custom_resampler(x):
-        _total_quote_qty = x['quote_qty'].sum()
-        _buy_trade_count = len(x[x['is_buyer_maker'] == False].index)
-        _sell_trade_count = len(x) - _buy_trade_count
-        _buy_quote_qty = x.loc[x['is_buyer_maker'] == False, 'quote_qty'].sum().astype(float)
-        _sell_quote_qty = _total_quote_qty - _buy_quote_qty
-        
-        _weighted_price_mean = calc_weighted_moment(x['price'], x['quote_qty'], 1, sum_weights = _total_quote_qty)
-        _weighted_price_var = calc_weighted_moment(x['price'], x['quote_qty'], 2, sum_weights = _total_quote_qty, weighted_mean = _weighted_price_mean)
-        _weighted_price_std = np.sqrt(_weighted_price_var)
-        _weighted_price_skew = calc_weighted_moment(x['price'], x['quote_qty'], 3, sum_weights = _total_quote_qty, weighted_mean = _weighted_price_mean, weighted_var = _weighted_price_var)
-        _weighted_price_kurt = calc_weighted_moment(x['price'], x['quote_qty'], 4, sum_weights = _total_quote_qty, weighted_mean = _weighted_price_mean, weighted_var = _weighted_price_var)
-
-        return pd.Series([_buy_trade_count, _sell_trade_count, _buy_quote_qty, _sell_quote_qty, _weighted_price_mean, _weighted_price_var, _weighted_price_skew, _weighted_price_kurt, _weighted_price_std], ['buy_trade_count', 'sell_trade_count', 'buy_quote_qty', 'sell_quote_qty', 'vw_price_mean', 'vw_price_var', 'vw_price_skew', 'vw_price_kurt', 'vw_price_std'])
-
-    _df_statistics = _df.groupby(pd.Grouper(freq = _interval_str)).apply(custom_resampler)
-    _df_timebar = pd.concat([_df_timebar, _df_statistics], axis = 1)
-    _df_timebar['buy_trade_count'] = _df_timebar['buy_trade_count'].fillna(0).astype(int)
-    _df_timebar['sell_trade_count'] = _df_timebar['sell_trade_count'].fillna(0).astype(int)
+    # 全ての統計量を最も細かい共通の間隔で1回のパスでビンごとに計算する
+    _metrics = current_task_metrics()
+    _base_interval = int(np.gcd.reduce(_list_intervals))
+    with _metrics.phase('compute'):
+        _dict_base_statistics = calc_bin_statistics(df_trades, _base_interval, _datetime_from, size_sketch)
+
+    _dict_results = {}
+    for _interval in _list_intervals:
+        _interval_str = f'{_interval}S'
+        with _metrics.phase('compute'):
+            _dict_statistics = rollup_bin_statistics(_dict_base_statistics, _interval // _base_interval)
+            _df_timebar = build_timebar_dataframe(_dict_statistics, pd.date_range(_datetime_from, _datetime_to, freq = _interval_str, inclusive = 'both'))
     
-    Path(f'{_datadir}/timebar/{_symbol}/{interval}').mkdir(parents = True, exist_ok = True)
-
-    # 1行目のOpenがNaNの場合は、全ての時間足ファイルの生成が終わってから前日Closeを使ってOpenを埋める必要があるので、ファイル名でマークしておく
-    if pd.isna(_df_timebar.iloc[0, _df_timebar.columns.get_loc('open')]) == True:
-        _pickle_filename = f'{_datadir}/timebar/{_symbol}/{interval}/incomplete-{_symbol}-timebar-{interval}sec-{_year}-{_month}-{_day}.pkl.gz'
-    else:
-        _pickle_filename = f'{_datadir}/timebar/{_symbol}/{interval}/{_symbol}-timebar-{interval}sec-{_year}-{_month}-{_day}.pkl.gz'
-    _df_timebar.to_pickle(_pickle_filename)
-
-    return idx
+        Path(f'{datadir}/timebar/{symbol}/{_interval}').mkdir(parents = True, exist_ok = True)
+
+        # 1行目のOpenがNaNで前日Closeが分かっている場合は、ここで埋めてしまう
+        _previous_close = None if previous_closes is None else previous_closes.get(_interval)
+        _first_open_missing = pd.isna(_df_timebar.iloc[0, _df_timebar.columns.get_loc('open')])
+        if _first_open_missing == True and _previous_close is not None:
+            _df_timebar = fill_first_open(_df_timebar, _previous_close)
+            _first_open_missing = False
+
+        # 1行目のOpenがNaNの場合は、全ての時間足ファイルの生成が終わってから前日Closeを使ってOpenを埋める必要があるので、ファイル名でマークしておく
+        _incomplete_filename = f'{datadir}/timebar/{symbol}/{_interval}/incomplete-{symbol}-timebar-{_interval}sec-{_year}-{_month}-{_day}{_ext}'
+        _completed_filename = f'{datadir}/timebar/{symbol}/{_interval}/{symbol}-timebar-{_interval}sec-{_year}-{_month}-{_day}{_ext}'
+        if _first_open_missing == True:
+            _timebar_filename = _incomplete_filename
+            Path(_completed_filename).unlink(missing_ok = True)
+        else:
+            _timebar_filename = _completed_filename
+            Path(_incomplete_filename).unlink(missing_ok = True)
+        with _metrics.phase('serialize'):
+            write_datafile(_df_timebar, _timebar_filename, _fmt)
+        _metrics.add_file_out(_timebar_filename)
+
+        _dict_results[_interval] = {
+            'timebar_file': _timebar_filename,
+            'complete': not _first_open_missing,
+            'first_open': nan_to_none(_df_timebar.iloc[0, _df_timebar.columns.get_loc('open')]),
+            'last_close': nan_to_none(_df_timebar.iloc[-1, _df_timebar.columns.get_loc('close')]),
+            'size_sketch': size_sketch,
+        }
+
+    return _dict_results
+
+# タイムバーの1行目のOHLCを前日Closeで埋め、約定がなかった時間をその値から埋める関数
+def fill_first_open(df_timebar: pd.DataFrame = None, last_close: float = None) -> pd.DataFrame:
+    assert df_timebar is not None
+    assert last_close is not None
+
+    _list_target_columns = [df_timebar.columns.get_loc(_) for _ in ['open', 'high', 'low', 'close']]
+    df_timebar.iloc[0, _list_target_columns] = last_close
+    df_timebar['close'] = df_timebar['close'].ffill()
+    df_timebar['open'] = df_timebar['open'].fillna(df_timebar['close'])
+    df_timebar['high'] = df_timebar['high'].fillna(df_timebar['close'])
+    df_timebar['low'] = df_timebar['low'].fillna(df_timebar['close'])
+
+    return df_timebar
+
+# マニフェストに保存できるように、NaNをNoneに変換する関数
+def nan_to_none(value):
+    if value is None or pd.isna(value):
+        return None
+    return float(value)
 
 # ファイル保存ディレクトリの中を見て、まだタイムバーを生成していない日の約定履歴データファイル名を返す関数
 def identify_available_trades_files(datadir: str = None, symbol: str = None, interval: int = None) -> set:
@@ -108,126 +348,472 @@ def identify_available_trades_files(datadir: str = None, symbol: str = None, int
     Path(f'{datadir}/trades/{_symbol}').mkdir(parents = True, exist_ok = True)
     _p = Path(f'{datadir}/trades/{_symbol}')    
 
-    _set_existing_trades_filenames = set([str(_.resolve().relative_to(Path.cwd())) for _ in identify_datafiles(datadir, 'trades', _symbol)])
+    # 日付をキーにして、約定履歴ファイルの保存形式によらず比較する
+    _dict_existing_trades_filenames = {}
+    for _existing_trades_filename in identify_datafiles(datadir, 'trades', _symbol):
+        _m = re.match('.*-(\d{4})-(\d{2})-(\d{2}).*', _existing_trades_filename.name)
+        _dict_existing_trades_filenames[(_m.group(1), _m.group(2), _m.group(3))] = str(_existing_trades_filename.resolve().relative_to(Path.cwd()))
     
     _p = Path(f'{datadir}/timebar/{_symbol}/{interval}')    
     _p.mkdir(parents = True, exist_ok = True)
     
-    _set_unnecessray_trades_filenames = set()
+    _set_unnecessray_dates = set()
     _list_existing_timebar_filenames = identify_datafiles(datadir, 'timebar', _symbol, interval)
     for _existing_timebar_filename in _list_existing_timebar_filenames:
-        _stem = Path(_existing_timebar_filename).stem
-        _m = re.match('.*-(\d{4})-(\d{2})-(\d{2}).*', _stem)
-        _year = _m.group(1)
-        _month = _m.group(2)
-        _day = _m.group(3)
-        _set_unnecessray_trades_filenames.add(f'{datadir}/trades/{_symbol}/{_symbol}-trades-{_year}-{_month}-{_day}.pkl.gz')
+        _m = re.match('.*-(\d{4})-(\d{2})-(\d{2}).*', _existing_timebar_filename.name)
+        _set_unnecessray_dates.add((_m.group(1), _m.group(2), _m.group(3)))
     
-    return sorted(_set_existing_trades_filenames - _set_unnecessray_trades_filenames)
+    return sorted([_filename for _date, _filename in _dict_existing_trades_filenames.items() if _date not in _set_unnecessray_dates])
 
 # Incompleteなタイムバーファイルを完成させる関数
-def finish_incomplete_timebar_files(idx, filename, interval):
+# last_closeに前日Closeを渡した場合は、前日のタイムバーファイルを読み込まずにその値を使う
+def finish_incomplete_timebar_files(idx, filename, interval, last_close: float = None):
     assert idx is not None
     assert filename is not None
     assert interval is not None
 
-    _df_incomplete = pd.read_pickle(filename)
-
-    _m = re.match('(.+)/timebar/(.+?)/(\d+?)/incomplete-.+?-timebar-.*-(\d{4})-(\d{2})-(\d{2})\.pkl\.gz', filename)
-    _datadir = _m.group(1)
-    _symbol = _m.group(2)
-    _interval = _m.group(3)
-    _year = _m.group(4)
-    _month = _m.group(5)
-    _day = _m.group(6)
-
-    _target_date = datetime.date(year = int(_year), month = int(_month), day = int(_day))
-    _previous_date = _target_date - datetime.timedelta(days = 1)
+    with task_metrics('finish_incomplete_timebar_files', Path(filename).name) as _metrics:
+        with _metrics.phase('read'):
+            _df_incomplete = read_datafile(filename)
+        _metrics.add_file_in(filename)
+        _metrics.add_rows(len(_df_incomplete))
+
+        _m = re.match(f'(.+)/timebar/(.+?)/(\\d+?)/incomplete-.+?-timebar-.*-(\\d{{4}})-(\\d{{2}})-(\\d{{2}}){datafile_extension_pattern}$', filename)
+        _datadir = _m.group(1)
+        _symbol = _m.group(2)
+        _interval = _m.group(3)
+        _year = _m.group(4)
+        _month = _m.group(5)
+        _day = _m.group(6)
+        _fmt = identify_datafile_format(filename)
+        _ext = datafile_extensions[_fmt]
+
+        _target_date = datetime.date(year = int(_year), month = int(_month), day = int(_day))
+        _previous_date = _target_date - datetime.timedelta(days = 1)
     
-    _previous_completed_file = Path(f'{_datadir}/timebar/{_symbol}/{_interval}/{_symbol}-timebar-{_interval}sec-{_previous_date.year:04}-{_previous_date.month:02}-{_previous_date.day:02}.pkl.gz')
-    _previous_incomplete_file = Path(f'{_datadir}/timebar/{_symbol}/{_interval}/incomplete-{_symbol}-timebar-{_interval}sec-{_previous_date.year:04}-{_previous_date.month:02}-{_previous_date.day:02}.pkl.gz')
-
-    _target_file = None
-    if _previous_completed_file.exists() == True:
-        _target_file = _previous_completed_file
-    elif _previous_incomplete_file.exists() == True:
-        _target_file = _previous_incomplete_file
-
-    if _target_file is not None:
-        try:
-            _df_previous_date = pd.read_pickle(str(_target_file))
-        except Exception as e:
-            print(f'ファイル {_target_file}を読み込み中に例外{e}が発生しました')
-            raise e
-        
-        _last_close = _df_previous_date.iloc[-1, _df_previous_date.columns.get_loc('close')]
-    else:
-        # このファイルがこの銘柄の最初の日の記録なので、最終クローズは0とする
-        _last_close = 0.0
+        if last_close is not None:
+            _last_close = last_close
+        else:
+            _previous_completed_file = find_datafile(f'{_datadir}/timebar/{_symbol}/{_interval}/{_symbol}-timebar-{_interval}sec-{_previous_date.year:04}-{_previous_date.month:02}-{_previous_date.day:02}')
+            _previous_incomplete_file = find_datafile(f'{_datadir}/timebar/{_symbol}/{_interval}/incomplete-{_symbol}-timebar-{_interval}sec-{_previous_date.year:04}-{_previous_date.month:02}-{_previous_date.day:02}')
+
+            _target_file = None
+            if _previous_completed_file is not None:
+                _target_file = _previous_completed_file
+            elif _previous_incomplete_file is not None:
+                _target_file = _previous_incomplete_file
+
+            if _target_file is not None:
+                try:
+                    with _metrics.phase('read'):
+                        _df_previous_date = read_datafile(str(_target_file), columns = ['close'])
+                except Exception as e:
+                    print(f'ファイル {_target_file}を読み込み中に例外{e}が発生しました')
+                    raise e
+            
+                _last_close = _df_previous_date.iloc[-1, _df_previous_date.columns.get_loc('close')]
+            else:
+                # このファイルがこの銘柄の最初の日の記録なので、最終クローズは0とする
+                _last_close = 0.0
+
+        with _metrics.phase('compute'):
+            _df_incomplete = fill_first_open(_df_incomplete, _last_close)
+
+        # 並列処理している他のプロセスが書き込み途中のファイルを読み込まないように、一時ファイルに保存する
+        with _metrics.phase('serialize'):
+            write_datafile(_df_incomplete, f'{_datadir}/timebar/{_symbol}/{_interval}/temp-{_symbol}-timebar-{_interval}sec-{_target_date.year:04}-{_target_date.month:02}-{_target_date.day:02}{_ext}', _fmt)
+        _tempfile = Path(f'{_datadir}/timebar/{_symbol}/{_interval}/temp-{_symbol}-timebar-{_interval}sec-{_target_date.year:04}-{_target_date.month:02}-{_target_date.day:02}{_ext}')
+        _completed_file = _tempfile.rename(f'{_datadir}/timebar/{_symbol}/{_interval}/{_symbol}-timebar-{_interval}sec-{_target_date.year:04}-{_target_date.month:02}-{_target_date.day:02}{_ext}')
+        Path(filename).unlink(missing_ok = True)
+        _metrics.add_file_out(_completed_file)
+
+        return idx
+
+# 前日のタイムバーが作り直されて前日Closeが変わった場合に、完成済みのタイムバーファイルの一日の始まりを新しい前日Closeで埋め直す関数
+# 最初の約定より前のバー (約定回数が0のバー) のOHLCを空にしてから、fill_first_openで生成時と同じように埋める
+# 戻り値は (idx, 最初のOpen, 最後のClose)
+def refill_first_open(idx, filename, last_close: float = None):
+    assert idx is not None
+    assert filename is not None
+    assert last_close is not None
+
+    with task_metrics('refill_first_open', Path(filename).name) as _metrics:
+        with _metrics.phase('read'):
+            _df_timebar = read_datafile(filename)
+        _metrics.add_file_in(filename)
+        _metrics.add_rows(len(_df_timebar))
+
+        with _metrics.phase('compute'):
+            _active_bins = np.flatnonzero((_df_timebar['buy_trade_count'] + _df_timebar['sell_trade_count']).values > 0)
+            _num_leading_bins = _active_bins[0] if _active_bins.size > 0 else len(_df_timebar)
+            if _num_leading_bins > 0:
+                _list_target_columns = [_df_timebar.columns.get_loc(_) for _ in ['open', 'high', 'low', 'close']]
+                _df_timebar.iloc[:_num_leading_bins, _list_target_columns] = np.nan
+                _df_timebar = fill_first_open(_df_timebar, last_close)
+
+        # 一日の始まりから約定があった場合は、前日Closeを使っていないので書き換えない
+        if _num_leading_bins > 0:
+            _filename = Path(filename)
+            _tempfile = _filename.parent / f'temp-{_filename.name}'
+            with _metrics.phase('serialize'):
+                write_datafile(_df_timebar, str(_tempfile), identify_datafile_format(filename))
+            _tempfile.rename(_filename)
+            _metrics.add_file_out(filename)
+
+        return (idx, nan_to_none(_df_timebar.iloc[0, _df_timebar.columns.get_loc('open')]), nan_to_none(_df_timebar.iloc[-1, _df_timebar.columns.get_loc('close')]))
+
+# 銘柄・時間間隔ごとのタイムバー生成のマニフェストのファイル名を返す関数
+# マニフェストには日付ごとに、元の約定履歴ファイルのサイズと更新時刻、タイムバーファイル名、一日の始まりのOpenが埋まっているか、最初のOpenと最後のCloseを記録する
+def get_timebar_manifest_file(datadir: str = None, symbol: str = None, interval: int = None) -> Path:
+    assert datadir is not None
+    assert symbol is not None
+    assert interval is not None
 
-    _list_target_columns = [_df_incomplete.columns.get_loc(_) for _ in ['open', 'high', 'low', 'close']]
-    _df_incomplete.iloc[0, _list_target_columns] = _last_close
-    _df_incomplete['close'] = _df_incomplete['close'].fillna(method = 'ffill')
-    _df_incomplete['open'] = _df_incomplete['open'].fillna(_df_incomplete['close'])
-    _df_incomplete['high'] = _df_incomplete['high'].fillna(_df_incomplete['close'])
-    _df_incomplete['low'] = _df_incomplete['low'].fillna(_df_incomplete['close'])
+    return Path(f'{datadir}/timebar/{symbol.upper()}/{interval}/manifest.json')
+
+def read_timebar_manifest(datadir: str = None, symbol: str = None, interval: int = None) -> dict:
+    _manifest_file = get_timebar_manifest_file(datadir, symbol, interval)
+    if _manifest_file.exists() == False:
+        return None
+    with open(_manifest_file, 'r') as _f:
+        return json.load(_f)
+
+def write_timebar_manifest(datadir: str = None, symbol: str = None, interval: int = None, manifest: dict = None) -> None:
+    assert manifest is not None
+
+    _manifest_file = get_timebar_manifest_file(datadir, symbol, interval)
+    _manifest_file.parent.mkdir(parents = True, exist_ok = True)
+
+    # 書き込み途中のマニフェストが残らないように、一時ファイルに書いてからリネームする
+    _tempfile = _manifest_file.parent / f'temp-{_manifest_file.name}'
+    with open(_tempfile, 'w') as _f:
+        json.dump(manifest, _f, indent = 1, sort_keys = True)
+    _tempfile.rename(_manifest_file)
+
+# 1日分のタイムバーの生成結果 (write_timebar_files_from_tradesの戻り値) を、時間間隔ごとのマニフェストのエントリに記録する関数
+# trades_file, trades_size, trades_mtime_nsには元の約定履歴ファイルの情報を渡す (リアルタイムに受信した約定から生成した場合はNone)
+def update_timebar_manifest_entries(dict_manifests: dict = None, date_str: str = None, dict_results: dict = None, trades_file: str = None, trades_size: int = None, trades_mtime_ns: int = None) -> None:
+    assert dict_manifests is not None
+    assert date_str is not None
+    assert dict_results is not None
+
+    for _interval, _result in dict_results.items():
+        dict_manifests[_interval]['days'][date_str] = dict(trades_file = trades_file, trades_size = trades_size, trades_mtime_ns = trades_mtime_ns, **_result)
+
+# タイムバーファイルの最初のOpenと最後のCloseを読み込む関数 (マニフェストの初期化用)
+def read_timebar_boundary(idx, filename):
+    _df = read_datafile(filename, columns = ['open', 'close'])
+    return (idx, nan_to_none(_df.iloc[0, 0]), nan_to_none(_df.iloc[-1, 1]))
+
+# マニフェストがない場合に、既存の完成したタイムバーファイルからマニフェストを作る関数
+# 既存のタイムバーファイルは今ある約定履歴ファイルから生成されたものとみなす
+def bootstrap_timebar_manifest(datadir: str = None, symbol: str = None, interval: int = None, dict_trades_files: dict = None) -> dict:
+    assert dict_trades_files is not None
+
+    _manifest = {'days': {}}
+
+    _list_targets = []
+    for _timebar_file in identify_datafiles(datadir, 'timebar', symbol, interval):
+        _m = re.match('.*-(\\d{4}-\\d{2}-\\d{2})', _timebar_file.name)
+        if _m.group(1) in dict_trades_files:
+            _list_targets.append((_m.group(1), str(_timebar_file)))
+
+    if len(_list_targets) == 0:
+        return _manifest
+
+    print(f'{symbol}の{interval}秒タイムバーのマニフェストを既存の{len(_list_targets)}ファイルから作成します')
+    with tqdm_joblib(total = len(_list_targets)):
+        results = joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(read_timebar_boundary)(_idx, _filename) for _idx, (_date, _filename) in enumerate(_list_targets)])
+
+    for _idx, _first_open, _last_close in results:
+        _date, _filename = _list_targets[_idx]
+        _trades_file, _trades_size, _trades_mtime_ns = dict_trades_files[_date]
+        _manifest['days'][_date] = {
+            'trades_file': _trades_file,
+            'trades_size': _trades_size,
+            'trades_mtime_ns': _trades_mtime_ns,
+            'timebar_file': _filename,
+            'complete': True,
+            'first_open': _first_open,
+            'last_close': _last_close,
+        }
+
+    return _manifest
+
+# 銘柄ごとのタイムバー生成の計画を作る関数
+# 約定履歴ファイルの一覧 (サイズと更新時刻)、時間間隔ごとのマニフェスト、日ごとに生成が必要な時間間隔と、生成時に渡す前日Closeを返す
+# size_sketch = Trueの場合は、約定金額のヒストグラムなしで生成された日も生成し直す対象にする
+def plan_timebar_generation(datadir: str = None, symbol: str = None, list_intervals: list = None, size_sketch: bool = False) -> dict:
+    assert datadir is not None
+    assert symbol is not None
+    assert list_intervals is not None
 
-    # 並列処理している他のプロセスが書き込み途中のファイルを読み込まないように、一時ファイルに保存する
-    _df_incomplete.to_pickle(f'{_datadir}/timebar/{_symbol}/{_interval}/temp-{_symbol}-timebar-{_interval}sec-{_target_date.year:04}-{_target_date.month:02}-{_target_date.day:02}.pkl.gz')
-    _tempfile = Path(f'{_datadir}/timebar/{_symbol}/{_interval}/temp-{_symbol}-timebar-{_interval}sec-{_target_date.year:04}-{_target_date.month:02}-{_target_date.day:02}.pkl.gz')
-    _tempfile.rename(f'{_datadir}/timebar/{_symbol}/{_interval}/{_symbol}-timebar-{_interval}sec-{_target_date.year:04}-{_target_date.month:02}-{_target_date.day:02}.pkl.gz')
+    _symbol = symbol.upper()
 
-    return idx
+    # 約定履歴ファイルの一覧を日付ごとに作り、サイズと更新時刻を記録する
+    Path(f'{datadir}/trades/{_symbol}').mkdir(parents = True, exist_ok = True)
+    _dict_trades_files = {}
+    for _trades_file in identify_datafiles(datadir, 'trades', _symbol):
+        _m = re.match('.*-(\\d{4}-\\d{2}-\\d{2})', _trades_file.name)
+        _stat = _trades_file.stat()
+        _dict_trades_files[_m.group(1)] = (str(_trades_file), _stat.st_size, _stat.st_mtime_ns)
+
+    _dict_manifests = {}
+    for _interval in list_intervals:
+        _manifest = read_timebar_manifest(datadir, _symbol, _interval)
+        if _manifest is None:
+            _manifest = bootstrap_timebar_manifest(datadir, _symbol, _interval, _dict_trades_files)
+            write_timebar_manifest(datadir, _symbol, _interval, _manifest)
+        _dict_manifests[_interval] = _manifest
+
+    # 約定履歴ファイルごとに、生成が必要な時間間隔のリストを作る (マニフェストにない日と、約定履歴ファイルが変更された日と、必要なヒストグラムがない日)
+    _dict_target_intervals = {}
+    for _date, (_trades_file, _trades_size, _trades_mtime_ns) in sorted(_dict_trades_files.items()):
+        for _interval in list_intervals:
+            _entry = _dict_manifests[_interval]['days'].get(_date)
+            if _entry is None or _entry['trades_size'] != _trades_size or _entry['trades_mtime_ns'] != _trades_mtime_ns or (size_sketch == True and _entry.get('size_sketch', False) == False):
+                _dict_target_intervals.setdefault(_date, []).append(_interval)
+
+    # 前日が今回生成し直す対象でなければ、マニフェストの前日Closeを渡して一日の始まりのOpenをその場で埋める
+    _dict_previous_closes = {}
+    for _date, _list_target_intervals in _dict_target_intervals.items():
+        _previous_date = (datetime.date.fromisoformat(_date) - datetime.timedelta(days = 1)).isoformat()
+        _dict_previous_closes[_date] = {}
+        for _interval in _list_target_intervals:
+            if _interval in _dict_target_intervals.get(_previous_date, []):
+                continue
+            _previous_entry = _dict_manifests[_interval]['days'].get(_previous_date)
+            if _previous_entry is None:
+                # 前日のタイムバーがないので、最終クローズは0とする
+                _dict_previous_closes[_date][_interval] = 0.0
+            elif _previous_entry['complete'] == True and _previous_entry['last_close'] is not None:
+                _dict_previous_closes[_date][_interval] = _previous_entry['last_close']
+
+    return {
+        'symbol': _symbol,
+        'intervals': list_intervals,
+        'trades_files': _dict_trades_files,
+        'manifests': _dict_manifests,
+        'target_intervals': _dict_target_intervals,
+        'previous_closes': _dict_previous_closes,
+    }
+
+# 複数の銘柄のタイムバーファイルを、全銘柄の全ての日をまとめた1つのタスクのグラフとして1つのプロセスプールで生成する関数
+# 約定履歴ファイルからの生成は約定履歴ファイルの大きい順に実行し、incompleteなファイルの完成は日ごとに、同じ銘柄・時間間隔の前日のCloseが分かった時点で投入する
+# (前日Closeはマニフェストから決まるので、前日のタイムバーファイルの完成は待たない)
+# intervalにintのリストを指定した場合は、約定履歴ファイルを1回だけ読み込んで全ての時間間隔のタイムバーを生成する
+# タイムバーファイルはfmtで指定された形式 (省略時はpkl.gz) で保存する
+# 生成済みの日はマニフェストで管理し、新しい日と約定履歴ファイルが変更された日だけを生成し直す
+# 生成し直した日の最後のCloseが変わった場合は、翌日が生成し直す対象でなくても、翌日の一日の始まりのバーを新しいCloseで埋め直す
+# size_sketch = Trueの場合は、バーごとの約定金額のヒストグラムの列も保存する (ヒストグラムなしで生成済みの日も生成し直す)
+def generate_timebar_files_for_symbols(datadir: str = None, symbols: list = None, interval = None, fmt: str = None, max_workers: int = None, size_sketch: bool = False) -> None:
+    assert datadir is not None
+    assert symbols is not None
+    assert interval is not None
 
-# 全コア数-2個のコアで並列処理を行い、価格ファイルを処理して約定プロファイルを作成する関数
-def generate_timebar_files(datadir: str = None, symbol: str = None, interval: int = None):
+    if isinstance(interval, (list, tuple, set)):
+        _list_intervals = sorted(set(int(_) for _ in interval))
+    else:
+        _list_intervals = [int(interval)]
+
+    _dict_plans = {}
+    for _symbol in symbols:
+        _dict_plans[_symbol.upper()] = plan_timebar_generation(datadir, _symbol, _list_intervals, size_sketch)
+
+    # タイムバーを生成する (前日Closeが分からなかった日は、一日の始まりのタイムバーのOpenがNaNで、ファイル名先頭にincomplete-がついている)
+    _list_tasks = []
+    _dict_remaining = {}
+    _dict_pending = {}
+    for _symbol, _plan in _dict_plans.items():
+        _dict_remaining[_symbol] = 0
+        for _date, _list_target_intervals in sorted(_plan['target_intervals'].items()):
+            _trades_file, _trades_size, _trades_mtime_ns = _plan['trades_files'][_date]
+            _list_tasks.append({'key': ('generate', _symbol, _date), 'func': calc_timebar_from_trades, 'args': (_date, _trades_file, _list_target_intervals, fmt, _plan['previous_closes'][_date], size_sketch), 'cost': _trades_size})
+            _dict_remaining[_symbol] = _dict_remaining[_symbol] + 1
+        for _interval in _list_intervals:
+            _dict_pending[(_symbol, _interval)] = {
+                'dates': set(_plan['manifests'][_interval]['days'].keys()) | set(_plan['target_intervals'].keys()),
+                'resolved': set(),
+                'generating': set([_date for _date, _ in _plan['target_intervals'].items() if _interval in _]),
+                'targets': set([_date for _date, _ in _plan['target_intervals'].items() if _interval in _]),
+                'refilled': set(),
+                'old_last_closes': {_date: _entry['last_close'] for _date, _entry in _plan['manifests'][_interval]['days'].items()},
+                'last_closes': {},
+            }
+
+    # 完成済みの日の一日の始まりを埋めた前日Closeが、今回決まった前日Closeと違うかどうかを返す関数
+    # 生成し直した日は生成時に渡した前日Close、それ以外の日は生成前のマニフェストの前日のClose (前日がなければ0) で埋められている
+    def _needs_refill(symbol, interval, date, last_close):
+        _pending = _dict_pending[(symbol, interval)]
+        if date in _pending['refilled']:
+            return False
+        _previous_date = (datetime.date.fromisoformat(date) - datetime.timedelta(days = 1)).isoformat()
+        if date in _pending['targets']:
+            _used_close = _dict_plans[symbol]['previous_closes'].get(date, {}).get(interval)
+            return _used_close is not None and _used_close != last_close
+        return _pending['old_last_closes'].get(_previous_date, 0.0) != last_close
+
+    # 前日の最終的なCloseが決まっていれば (True, Close) を、まだ決まっていなければ (False, None) を返す関数
+    # 前日に約定があれば、前日の最後のCloseは前々日のCloseによらないので、前日の前日Closeが決まるのを待たずにマニフェストの値を使う
+    # (incompleteな日は最後のCloseがあれば約定があり、完成済みの日は最初のOpenと最後のCloseが違えば約定がある)
+    # 前日のタイムバーがない場合は、最終クローズは0とする
+    def _get_previous_close(symbol, interval, date):
+        _pending = _dict_pending[(symbol, interval)]
+        _previous_date = (datetime.date.fromisoformat(date) - datetime.timedelta(days = 1)).isoformat()
+        if _previous_date in _pending['last_closes']:
+            return (True, _pending['last_closes'][_previous_date])
+        if _previous_date in _pending['generating']:
+            return (False, None)
+        _previous_entry = _dict_plans[symbol]['manifests'][interval]['days'].get(_previous_date)
+        if _previous_entry is None:
+            return (True, 0.0)
+        if _previous_entry['last_close'] is not None and (_previous_entry['complete'] == False or _previous_entry['first_open'] != _previous_entry['last_close']):
+            return (True, _previous_entry['last_close'])
+        return (False, None)
+
+    # 同じ銘柄・時間間隔の日のうち、生成中でなく前日の最終的なCloseが決まった日ごとに、その日の扱いを決めてタスクを作る
+    # incompleteな日は完成タスクを作り、完成済みの日で前日Closeが変わっていた場合は埋め直すタスクを作る
+    # 日付順に止まらずに調べるので、ある日が生成中でも、それより後の日の完成タスクはその日の前日Closeが分かり次第投入できる
+    # datesには調べる日を渡す (その日の扱いが決まったら、翌日も続けて調べる)
+    # マニフェストは完成タスクが終わってから書き換える
+    def _release_finish_tasks(symbol, interval, dates):
+        _pending = _dict_pending[(symbol, interval)]
+        _dict_days = _dict_plans[symbol]['manifests'][interval]['days']
+        _list_new_tasks = []
+
+        # 日付の早い順に調べるように、逆順に積んで末尾から取り出す
+        _list_stack = sorted(dates, reverse = True)
+        while len(_list_stack) > 0:
+            _date = _list_stack.pop()
+            if _date not in _pending['dates'] or _date in _pending['resolved'] or _date in _pending['generating']:
+                continue
+            _known, _last_close = _get_previous_close(symbol, interval, _date)
+            if _known == False:
+                continue
+
+            _entry = _dict_days.get(_date)
+            if _entry is not None and _entry['complete'] == True:
+                if _needs_refill(symbol, interval, _date, _last_close) == True:
+                    # 埋め直しが終わるまで、この日の最終的なCloseは決まらない
+                    _filename = _entry['timebar_file']
+                    _cost = Path(_filename).stat().st_size if Path(_filename).exists() else 0
+                    _list_new_tasks.append({'key': ('refill', symbol, interval, _date), 'func': refill_first_open, 'args': (_date, _filename, _last_close), 'cost': _cost})
+                    _dict_remaining[symbol] = _dict_remaining[symbol] + 1
+                    _pending['generating'].add(_date)
+                    continue
+                _pending['last_closes'][_date] = _entry['last_close']
+            elif _entry is not None:
+                _pending['last_closes'][_date] = _entry['last_close'] if _entry['last_close'] is not None else _last_close
+                _filename = _entry['timebar_file']
+                _cost = Path(_filename).stat().st_size if Path(_filename).exists() else 0
+                _list_new_tasks.append({'key': ('finish', symbol, interval, _date), 'func': finish_incomplete_timebar_files, 'args': (_date, _filename, interval, _last_close), 'cost': _cost})
+                _dict_remaining[symbol] = _dict_remaining[symbol] + 1
+            _pending['resolved'].add(_date)
+
+            _next_date = (datetime.date.fromisoformat(_date) + datetime.timedelta(days = 1)).isoformat()
+            if _next_date in _pending['dates']:
+                _list_stack.append(_next_date)
+        return _list_new_tasks
+
+    def _on_complete(key, result):
+        _symbol = key[1]
+        _manifests = _dict_plans[_symbol]['manifests']
+        _list_new_tasks = []
+
+        if key[0] == 'generate':
+            _date, _dict_results = result
+            _next_date = (datetime.date.fromisoformat(_date) + datetime.timedelta(days = 1)).isoformat()
+            _trades_file, _trades_size, _trades_mtime_ns = _dict_plans[_symbol]['trades_files'][_date]
+            update_timebar_manifest_entries(_manifests, _date, _dict_results, _trades_file, _trades_size, _trades_mtime_ns)
+            for _interval in _dict_results.keys():
+                _dict_pending[(_symbol, _interval)]['generating'].discard(_date)
+                _list_new_tasks = _list_new_tasks + _release_finish_tasks(_symbol, _interval, [_date, _next_date])
+        elif key[0] == 'refill':
+            _interval = key[2]
+            _date = key[3]
+            _, _first_open, _last_close = result
+            _entry = _manifests[_interval]['days'][_date]
+            _entry['first_open'] = _first_open
+            _entry['last_close'] = _last_close
+            _dict_pending[(_symbol, _interval)]['refilled'].add(_date)
+            _dict_pending[(_symbol, _interval)]['generating'].discard(_date)
+            _list_new_tasks = _release_finish_tasks(_symbol, _interval, [_date])
+        else:
+            _interval = key[2]
+            _date = key[3]
+            _entry = _manifests[_interval]['days'][_date]
+            _entry['complete'] = True
+            _entry['timebar_file'] = _entry['timebar_file'].replace('/incomplete-', '/')
+            _entry['first_open'] = _get_previous_close(_symbol, _interval, _date)[1]
+            if _entry['last_close'] is None:
+                _entry['last_close'] = _entry['first_open']
+
+        # 銘柄のタスクがすべて終わったら、その銘柄のマニフェストを保存する
+        _dict_remaining[_symbol] = _dict_remaining[_symbol] - 1
+        if _dict_remaining[_symbol] == 0:
+            for _interval in _list_intervals:
+                write_timebar_manifest(datadir, _symbol, _interval, _manifests[_interval])
+        return _list_new_tasks
+
+    # 生成するものがない銘柄でも、前回の実行で残ったincompleteな日があれば完成させる
+    for _symbol in _dict_plans.keys():
+        for _interval in _list_intervals:
+            _list_tasks = _list_tasks + _release_finish_tasks(_symbol, _interval, _dict_pending[(_symbol, _interval)]['dates'])
+
+    _intervals_str = ', '.join([str(_) for _ in _list_intervals])
+    print(f'{len(_dict_plans)}銘柄の{_intervals_str}秒タイムバーファイルを約定履歴から生成します')
+    run_task_graph(_list_tasks, _on_complete, max_workers = max_workers, desc = 'timebar')
+
+    for _symbol, _plan in _dict_plans.items():
+        for _interval in _list_intervals:
+            write_timebar_manifest(datadir, _symbol, _interval, _plan['manifests'][_interval])
+
+# 1つの銘柄のタイムバーファイルを生成する関数 (generate_timebar_files_for_symbolsを1銘柄で呼ぶ)
+def generate_timebar_files(datadir: str = None, symbol: str = None, interval: int = None, fmt: str = None, size_sketch: bool = False):
     assert datadir is not None
     assert symbol is not None
     assert interval is not None
 
-    _symbol = symbol.upper()
-
-    # 処理開始前に全てのincompleteファイルを削除する
-    _list_incomplete_files = identify_datafiles(datadir, 'timebar', _symbol, interval, incomplete = True)
-    for _incomplete_file in _list_incomplete_files:
-        _incomplete_file.unlink()
-        
-    # タイムバーを生成する (この時点ではまだ一日の始まりのタイムバーのOpenがNaNで、ファイル名先頭にincomplete-がついているものが存在する可能性がある)
-    print(f'{symbol}の{interval}秒タイムバーファイルを約定履歴から生成します')
-    _set_filenames = identify_available_trades_files(datadir, symbol, interval)
-    _list_filenames = list(_set_filenames)
-    _num_rows = len(_list_filenames)
-    with tqdm_joblib(total = _num_rows):
-        results = joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(calc_timebar_from_trades)(_idx, _filename, interval) for _idx, _filename in enumerate(_list_filenames)])
-    
-    # Incompleteなファイルを完成させる
-    _list_incomplete_files = identify_datafiles(datadir, 'timebar', _symbol, interval, incomplete = True)
-    _list_filenames = sorted([str(_) for _ in _list_incomplete_files])
-    _num_rows = len(_list_filenames)
-    with tqdm_joblib(total = _num_rows):
-        results = joblib.Parallel(n_jobs = -1, timeout = 60*60*24)([joblib.delayed(finish_incomplete_timebar_files)(_idx, _filename, interval) for _idx, _filename in enumerate(_list_filenames)])
-
-    # 処理開始後に全てのincompleteファイルを削除する
-    _list_incomplete_files = identify_datafiles(datadir, 'timebar', _symbol, interval, incomplete = True)
-    for _incomplete_file in _list_incomplete_files:
-        _incomplete_file.unlink()
+    generate_timebar_files_for_symbols(datadir, [symbol], interval, fmt, size_sketch = size_sketch)
 
 # 引数処理とダウンロード関数の起動部分
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--symbol', help = 'ダウンロードする対象の銘柄 例:BTCUSDT')
-    parser.add_argument('interval', type = int, help = '生成するタイムバーの時間間隔 [秒] 例:60')
+    parser.add_argument('interval', type = float, nargs = '+', help = '生成するタイムバーの時間間隔 [秒] 複数指定すると約定履歴を1回だけ読み込んで全て生成する 例:60 300 3600 (--barがtime以外の場合はバーを閉じるしきい値)')
+    parser.add_argument('--bar', default = 'time', choices = ['time', 'tick', 'volume', 'dollar', 'imbalance'], help = '生成するバーの種類 (time以外は約定回数、約定数量、約定金額、売買の符号の累積がしきい値を超えるたびにバーを閉じる)')
+    parser.add_argument('--format', default = None, choices = [_ for _ in datafile_extensions.keys() if _ != 'compact'], help = 'タイムバーファイルの保存形式 (省略時はpickle)')
+    parser.add_argument('--size-sketch', action = 'store_true', help = 'バーごとの約定金額のヒストグラムの列 (size_count_*, size_quote_*) も保存する (中央値などの分位点や大口約定の割合の計算用)')
+    parser.add_argument('--metrics-dir', help = 'タスクごとの処理時間の内訳などを記録するディレクトリ (省略時は記録しない)')
+    parser.add_argument('--profile', choices = metrics_profilers, help = '--metrics-dirにタスクのプロファイルも保存する')
+    parser.add_argument('--profile-top', type = int, default = 10, help = 'プロファイルを残す処理時間が長かったタスクの数')
     args = parser.parse_args()
 
+    if args.metrics_dir:
+        enable_task_metrics(args.metrics_dir, args.profile)
+
     symbol = args.symbol
-    interval = args.interval
 
-    if 86400 % interval != 0:
-        print('interval は 86400秒 (1日) の約数を指定してください')
-        exit(0)
-         
     if symbol:
-        generate_timebar_files(datadir, symbol, int(interval))
+        _list_symbols = [symbol]
     else:
-        for _symbol in target_symbols.keys():
-            generate_timebar_files(datadir, _symbol, int(interval))
+        _list_symbols = list(target_symbols.keys())
+
+    if args.bar != 'time':
+        from infobar_generate import generate_infobar_files
+
+        for _symbol in _list_symbols:
+            for _threshold in args.interval:
+                generate_infobar_files(datadir, _symbol, args.bar, _threshold, args.format)
+        exit(0)
+
+    for _interval in args.interval:
+        if _interval.is_integer() == False or 86400 % int(_interval) != 0:
+            print('interval は 86400秒 (1日) の約数を指定してください')
+            exit(0)
+    intervals = [int(_) for _ in args.interval]
+
+    generate_timebar_files_for_symbols(datadir, _list_symbols, intervals, args.format, size_sketch = args.size_sketch)
+
+    if args.metrics_dir:
+        export_task_metrics(args.metrics_dir, args.profile_top)
@@ -0,0 +1,112 @@
+import re
+import datetime
+import joblib
+import numpy as np
+import pandas as pd
+from exercise_core import tqdm_joblib, identify_datafiles, target_symbols
+from datafile_storage import read_timebar_datafile
+from pipeline_metrics import task_metrics
+
+# タイムバーファイルを1日分読み込み、パネルに書き込む行の位置と値を返す関数
+# day_positionはその日の0時のバーのパネル上の行番号。欠損を表すNaNを入れるため、値はすべてfloat64にする
+def read_timebar_for_panel(symbol_idx: int, day_position: int, day_start_ns: int, interval: int, filename: str, columns: list, time_from: pd.Timestamp, time_to: pd.Timestamp):
+    # concat_timebar_filesと同じく、列を選ぶ前にすべてが0の行を取り除く
+    _df = read_timebar_datafile(filename, columns = columns, time_from = time_from, time_to = time_to)
+
+    _times = _df.index.values.astype('datetime64[ns]').view(np.int64)
+    _positions = day_position + (_times - day_start_ns) // (interval * 1_000_000_000)
+
+    return (symbol_idx, _positions, {_column: _df[_column].values.astype(np.float64) for _column in columns})
+
+# 複数銘柄のタイムバーの指定した列を、共通の時刻インデックス (時刻 × 銘柄) の2次元配列に読み込む関数
+# 時刻インデックスはタイムバーファイルと同じく各日の0時から時間間隔ごとに並べたもので、上場前の期間や約定のなかったバーはNaNになる
+# 全銘柄・全日のファイルを1回の並列処理で読み込み、列ごとに1つだけ確保した配列に、1日分の結果が届くたびに書き込む
+# (全ての日の結果を親プロセスに溜めないので、メモリ使用量はパネルの大きさと並列処理中の数日分で済む)
+# from_str, to_strの指定方法はconcat_timebar_filesと同じ。指定しない場合はいずれかの銘柄のファイルがある最初の日から最後の日までを読み込む
+# as_dataframe = Falseの場合は、'time' (datetime64[ns]) と'symbols' (銘柄のリスト) と各列の2次元配列の辞書を返す
+def load_timebar_panel(symbols: list = None, interval: int = None, columns: list = None, from_str: str = None, to_str: str = None, datadir: str = 'data/binance', as_dataframe: bool = True):
+    assert interval is not None
+    assert columns is not None
+
+    _list_symbols = list(target_symbols.keys()) if symbols is None else [_.upper() for _ in symbols]
+
+    _time_from = pd.Timestamp(from_str) if from_str is not None else None
+    _time_to = None
+    if to_str is not None:
+        if re.fullmatch('(\\d{4})-(\\d{2})-(\\d{2})', to_str):
+            _time_to = pd.Timestamp(to_str) + pd.Timedelta(days = 1)
+        else:
+            _time_to = pd.Timestamp(to_str)
+
+    # 銘柄ごとに、期間に含まれる上場日以降の日のファイルを集める
+    _list_tasks = []
+    for _symbol_idx, _symbol in enumerate(_list_symbols):
+        _listing_date = pd.Timestamp(datetime.date(*target_symbols[_symbol])) if _symbol in target_symbols else None
+        for _filename in identify_datafiles(datadir, 'timebar', _symbol, interval):
+            _m = re.match('.*-(\\d{4}-\\d{2}-\\d{2})', _filename.name)
+            _date = pd.Timestamp(_m.group(1))
+            if _listing_date is not None and _date < _listing_date:
+                continue
+            if _time_from is not None and _date + pd.Timedelta(days = 1) <= _time_from:
+                continue
+            if _time_to is not None and _date >= _time_to:
+                continue
+            _list_tasks.append((_symbol_idx, _date, str(_filename)))
+
+    # 最初の日の0時から最後の日の終わりまでの時刻インデックスを作る (1日のバーの本数は日ごとに同じ)
+    _first_date = _time_from.normalize() if _time_from is not None else min([_[1] for _ in _list_tasks], default = None)
+    _last_date = (_time_to - pd.Timedelta(nanoseconds = 1)).normalize() if _time_to is not None else max([_[1] for _ in _list_tasks], default = None)
+    if _first_date is None or _last_date is None or _last_date < _first_date:
+        _num_days = 0
+    else:
+        _num_days = (_last_date - _first_date).days + 1
+    _bars_per_day = -(-86400 // interval)
+
+    _day_offsets = np.arange(_bars_per_day, dtype = np.int64) * interval * 1_000_000_000
+    _day_starts = (_first_date.value if _num_days > 0 else 0) + np.arange(_num_days, dtype = np.int64) * 86_400_000_000_000
+    _time = (_day_starts[:, np.newaxis] + _day_offsets[np.newaxis, :]).reshape(-1)
+
+    _dict_arrays = {_column: np.full((len(_time), len(_list_symbols)), np.nan, dtype = np.float64) for _column in columns}
+
+    with task_metrics('load_timebar_panel', f'{len(_list_symbols)} symbols {interval}') as _metrics:
+        with _metrics.phase('read'):
+            with tqdm_joblib(total = len(_list_tasks)):
+                results = joblib.Parallel(n_jobs = -2, timeout = 60*60*24, return_as = 'generator_unordered')([joblib.delayed(read_timebar_for_panel)(_symbol_idx, (_date - _first_date).days * _bars_per_day, _date.value, interval, _filename, columns, _time_from, _time_to) for _symbol_idx, _date, _filename in _list_tasks])
+                for _symbol_idx, _positions, _dict_values in results:
+                    with _metrics.phase('compute'):
+                        for _column in columns:
+                            _dict_arrays[_column][_positions, _symbol_idx] = _dict_values[_column]
+                    _metrics.add_rows(len(_positions))
+        for _symbol_idx, _date, _filename in _list_tasks:
+            _metrics.add_file_in(_filename)
+
+    # 時刻で指定された期間に切り詰める (コピーせずにビューを返す)
+    _start = 0 if _time_from is None else int(np.searchsorted(_time, _time_from.value, side = 'left'))
+    _end = len(_time) if _time_to is None else int(np.searchsorted(_time, _time_to.value, side = 'left'))
+    _time = _time[_start:_end].view('datetime64[ns]')
+    for _column in columns:
+        _dict_arrays[_column] = _dict_arrays[_column][_start:_end]
+
+    if as_dataframe == False:
+        return {'time': _time, 'symbols': _list_symbols, **_dict_arrays}
+
+    _index = pd.DatetimeIndex(_time, copy = False)
+    return {_column: pd.DataFrame(_dict_arrays[_column], index = _index, columns = _list_symbols, copy = False) for _column in columns}
+
+# F&G Indexのような低頻度の系列を、パネルの時刻インデックスにas-ofで結合する関数
+# 各時刻には、インデックスの時刻からlagだけ経って利用可能になった値のうち、その時刻までで最新のものを入れる (未来の値は使わない)
+# dfにはload_fng_fileの結果のような時刻インデックスのDataFrameかSeriesを渡し、timeには結合先の時刻インデックスを渡す
+def asof_join_panel(time = None, df = None, lag: pd.Timedelta = None):
+    assert time is not None
+    assert df is not None
+
+    _index = pd.DatetimeIndex(time)
+    if df.index.is_monotonic_increasing == False:
+        df = df.sort_index()
+    _available = df.index if lag is None else df.index + pd.Timedelta(lag)
+
+    _positions = np.searchsorted(_available.values, _index.values, side = 'right') - 1
+    _result = df.iloc[np.maximum(_positions, 0)].set_axis(_index, axis = 0)
+
+    # 最初の値が利用可能になる前の時刻はNaNにする
+    return _result.where(pd.Series(_positions >= 0, index = _index), axis = 0)
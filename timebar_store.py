@@ -0,0 +1,181 @@
+import json
+import re
+import shutil
+import argparse
+from pathlib import Path
+import joblib
+import numpy as np
+import pandas as pd
+from exercise_core import tqdm_joblib, identify_datafiles, target_symbols
+from datafile_storage import read_timebar_datafile
+
+datadir = 'data/binance'
+
+# 1回の並列読み込みでまとめて追記する日数
+store_append_chunk_days = 32
+
+# 銘柄・時間間隔ごとの連結済みタイムバーストアのディレクトリを返す関数
+# ストアは列ごとの固定長dtypeのバイナリファイル (<列名>.bin) と時刻インデックス (time.bin, int64 ns) と、
+# 列のdtype、行数、取り込み済みの日付を記録したmeta.jsonからなる
+def get_timebar_store_dir(datadir: str = None, symbol: str = None, interval: int = None) -> Path:
+    assert datadir is not None
+    assert symbol is not None
+    assert interval is not None
+
+    return Path(f'{datadir}/timebar_store/{symbol.upper()}/{interval}')
+
+def read_timebar_store_meta(store_dir: Path = None) -> dict:
+    assert store_dir is not None
+
+    _meta_file = Path(store_dir) / 'meta.json'
+    if _meta_file.exists() == False:
+        return None
+    with open(_meta_file, 'r') as _f:
+        return json.load(_f)
+
+def write_timebar_store_meta(store_dir: Path = None, meta: dict = None) -> None:
+    assert store_dir is not None
+    assert meta is not None
+
+    # meta.jsonの書き換えがストア更新の確定になるので、一時ファイルに書いてからリネームする
+    _tempfile = Path(store_dir) / 'temp-meta.json'
+    with open(_tempfile, 'w') as _f:
+        json.dump(meta, _f)
+    _tempfile.rename(Path(store_dir) / 'meta.json')
+
+# タイムバーファイルを1日分読み込み、ストアに追記する配列を返す関数
+def read_timebar_for_store(idx, filename):
+    # concat_timebar_filesと同じく、すべてが0の行を取り除く
+    _df = read_timebar_datafile(filename)
+
+    _dict_arrays = {'time': _df.index.values.astype('datetime64[ns]').view(np.int64)}
+    for _column in _df.columns:
+        _dict_arrays[_column] = _df[_column].values
+
+    return (idx, _dict_arrays)
+
+# 日次のタイムバーファイルを、列ごとの連続したバイナリファイルに連結する関数
+# 取り込み済みの日より後の日だけが増えている場合は追記し、それ以外の変更があった場合は作り直す
+def build_timebar_store(datadir: str = None, symbol: str = None, interval: int = None) -> None:
+    assert datadir is not None
+    assert symbol is not None
+    assert interval is not None
+
+    _symbol = symbol.upper()
+    _store_dir = get_timebar_store_dir(datadir, _symbol, interval)
+
+    _dict_files = {}
+    for _filename in identify_datafiles(datadir, 'timebar', _symbol, interval):
+        _m = re.match('.*-(\\d{4}-\\d{2}-\\d{2})', _filename.name)
+        _dict_files[_m.group(1)] = _filename
+    _list_dates = sorted(_dict_files.keys())
+
+    # 取り込み済みの日のファイルが変更・削除されていたり、取り込み済みの最終日より前の日が増えていたら作り直す
+    _meta = read_timebar_store_meta(_store_dir)
+    if _meta is not None:
+        _dict_stored = _meta['days']
+        _last_stored_date = max(_dict_stored.keys()) if len(_dict_stored) > 0 else ''
+        for _date in _list_dates:
+            if _date in _dict_stored:
+                if _dict_stored[_date] != _dict_files[_date].stat().st_mtime_ns:
+                    _meta = None
+                    break
+            elif _date < _last_stored_date:
+                _meta = None
+                break
+        if _meta is not None and any([_ not in _dict_files for _ in _dict_stored.keys()]):
+            _meta = None
+
+    if _meta is None:
+        shutil.rmtree(_store_dir, ignore_errors = True)
+        _meta = {'length': 0, 'columns': {}, 'days': {}}
+    _store_dir.mkdir(parents = True, exist_ok = True)
+
+    # 前回の追記が途中で止まっていた場合に備えて、meta.jsonの行数に切り詰める
+    for _column, _dtype in _meta['columns'].items():
+        with open(_store_dir / f'{_column}.bin', 'r+b') as _f:
+            _f.truncate(_meta['length'] * np.dtype(_dtype).itemsize)
+
+    _list_new_dates = [_ for _ in _list_dates if _ not in _meta['days']]
+    print(f'{_symbol}の{interval}秒タイムバー{len(_list_new_dates)}日分をストアに追加します')
+
+    with tqdm_joblib(total = len(_list_new_dates)):
+        for _chunk_start in range(0, len(_list_new_dates), store_append_chunk_days):
+            _list_chunk_dates = _list_new_dates[_chunk_start:_chunk_start + store_append_chunk_days]
+            results = joblib.Parallel(n_jobs = -2, timeout = 60*60*24)([joblib.delayed(read_timebar_for_store)(_idx, str(_dict_files[_date])) for _idx, _date in enumerate(_list_chunk_dates)])
+            results.sort(key = lambda x: x[0])
+
+            for (_idx, _dict_arrays), _date in zip(results, _list_chunk_dates):
+                if len(_meta['columns']) == 0:
+                    _meta['columns'] = {_column: _array.dtype.str for _column, _array in _dict_arrays.items()}
+                assert set(_dict_arrays.keys()) == set(_meta['columns'].keys()), f'{_date}のタイムバーファイルの列がストアと一致しません'
+
+                for _column, _dtype in _meta['columns'].items():
+                    with open(_store_dir / f'{_column}.bin', 'ab') as _f:
+                        _f.write(np.ascontiguousarray(_dict_arrays[_column], dtype = _dtype).tobytes())
+                _meta['length'] = _meta['length'] + len(_dict_arrays['time'])
+                _meta['days'][_date] = _dict_files[_date].stat().st_mtime_ns
+
+            write_timebar_store_meta(_store_dir, _meta)
+
+    write_timebar_store_meta(_store_dir, _meta)
+
+# タイムバーストアをメモリマップで開き、指定された期間のタイムバーをコピーせずに返す関数
+# from_str, to_strには日付 (例:2022-01-01) か時刻 (例:2022-01-01 12:00) を指定する。to_strに日付だけを指定した場合はその日の終わりまでを返す
+# as_dataframe = Falseの場合は、'time' (datetime64[ns]) と各列の配列の辞書を返す
+# 返される配列は読み込み専用のメモリマップなので、書き換える場合はコピーすること
+def load_timebar_store(symbol: str = None, interval: int = None, from_str: str = None, to_str: str = None, columns: list = None, datadir: str = 'data/binance', as_dataframe: bool = True):
+    assert symbol is not None
+    assert interval is not None
+
+    _store_dir = get_timebar_store_dir(datadir, symbol, interval)
+    _meta = read_timebar_store_meta(_store_dir)
+    assert _meta is not None, f'{_store_dir}にタイムバーストアがありません。先にbuild_timebar_storeを実行してください'
+
+    _length = _meta['length']
+    _list_columns = [_ for _ in _meta['columns'].keys() if _ != 'time'] if columns is None else list(columns)
+
+    def _open(column):
+        if _length == 0:
+            return np.empty(0, dtype = _meta['columns'][column])
+        return np.memmap(_store_dir / f'{column}.bin', dtype = _meta['columns'][column], mode = 'r', shape = (_length,))
+
+    _time = _open('time')
+
+    # 時刻インデックスは昇順に並んでいるので、二分探索で範囲を求める
+    _start = 0
+    _end = _length
+    if from_str is not None:
+        _start = int(np.searchsorted(_time, pd.Timestamp(from_str).value, side = 'left'))
+    if to_str is not None:
+        if re.fullmatch('(\\d{4})-(\\d{2})-(\\d{2})', to_str):
+            _time_to = pd.Timestamp(to_str) + pd.Timedelta(days = 1)
+        else:
+            _time_to = pd.Timestamp(to_str)
+        _end = int(np.searchsorted(_time, _time_to.value, side = 'left'))
+
+    _dict_arrays = {'time': _time[_start:_end].view('datetime64[ns]')}
+    for _column in _list_columns:
+        _dict_arrays[_column] = _open(_column)[_start:_end]
+
+    if as_dataframe == False:
+        return _dict_arrays
+
+    _index = pd.DatetimeIndex(_dict_arrays['time'], copy = False)
+    return pd.DataFrame({_column: _dict_arrays[_column] for _column in _list_columns}, index = _index, copy = False)
+
+# 引数処理とストア構築関数の起動部分
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--symbol', help = 'ストアを構築する対象の銘柄 例:BTCUSDT')
+    parser.add_argument('interval', type = int, nargs = '+', help = 'ストアを構築するタイムバーの時間間隔 [秒] 例:60 3600')
+    args = parser.parse_args()
+
+    if args.symbol:
+        _list_symbols = [args.symbol]
+    else:
+        _list_symbols = list(target_symbols.keys())
+
+    for _symbol in _list_symbols:
+        for _interval in args.interval:
+            build_timebar_store(datadir, _symbol, _interval)
@@ -0,0 +1,390 @@
+import json
+import time
+import array
+import asyncio
+import argparse
+import datetime
+from pathlib import Path
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+from datafile_storage import datafile_extensions, read_datafile
+from weighted_moment import WeightedMomentAccumulator
+from timebar_generate import write_timebar_files_from_trades, read_timebar_manifest, write_timebar_manifest, update_timebar_manifest_entries
+
+datadir = 'data/binance'
+
+# BinanceのUSDⓈ-M先物のWebSocketのエンドポイント
+binance_stream_url = 'wss://fstream.binance.com/ws'
+
+# 再接続するまでの待ち時間 [秒] (接続に失敗するたびに倍にして、最大値で頭打ちにする)
+stream_reconnect_initial_wait = 1.0
+stream_reconnect_max_wait = 60.0
+
+# 壁時計でバーを閉じるときに、約定の配信の遅れを見込んで待つ時間 [ミリ秒]
+stream_close_delay_ms = 500
+
+# WebSocketのaggTrade/tradeメッセージを (価格, 数量, 約定金額, 約定時刻 [ms], is_buyer_maker, 約定回数) に変換する関数
+# 約定金額はメッセージに含まれないので、価格と数量の文字列から10進数で掛け算してからfloatにする (約定履歴CSVのquote_qtyと同じ値になる)
+# aggTradeは同じ価格・同じテイカー注文の約定 (最初の約定ID fから最後の約定ID lまで) を1つにまとめたものなので、約定回数はl - f + 1になる
+def parse_trade_message(message: dict = None):
+    assert message is not None
+
+    # 複数ストリームの接続ではdataの中にメッセージが入っている
+    if 'data' in message and 'stream' in message:
+        message = message['data']
+    if message.get('e') not in ('aggTrade', 'trade'):
+        return None
+
+    _price = float(message['p'])
+    _qty = float(message['q'])
+    _quote_qty = float(Decimal(message['p']) * Decimal(message['q']))
+    _trade_count = int(message['l']) - int(message['f']) + 1 if message['e'] == 'aggTrade' else 1
+
+    return (_price, _qty, _quote_qty, int(message['T']), bool(message['m']), _trade_count)
+
+# 約定履歴のデータフレームを、BinanceのWebSocketと同じ形式のaggTrade/tradeメッセージのリストにする関数 (serve_trades_replay用)
+# aggTradeでは、連続する同じ約定時刻・価格・売買方向の約定を1つのメッセージにまとめ、数量は10進数で合計する
+def make_trade_messages(df_trades: pd.DataFrame = None, symbol: str = None, stream_type: str = 'aggTrade') -> list:
+    assert df_trades is not None
+    assert symbol is not None
+    assert stream_type in ('aggTrade', 'trade')
+
+    _id = df_trades['id'].values.astype(np.int64)
+    _price = df_trades['price'].values.astype(np.float64)
+    _qty = df_trades['qty'].values.astype(np.float64)
+    _time_ms = df_trades['time'].values.astype('datetime64[ms]').astype(np.int64)
+    _is_buyer_maker = df_trades['is_buyer_maker'].values.astype(bool)
+
+    if stream_type == 'trade':
+        return [{'e': 'trade', 'E': int(_t), 's': symbol.upper(), 't': int(_i), 'p': repr(float(_p)), 'q': repr(float(_q)), 'T': int(_t), 'm': bool(_m)} for _i, _p, _q, _t, _m in zip(_id, _price, _qty, _time_ms, _is_buyer_maker)]
+
+    _starts = np.flatnonzero(np.r_[True, (_time_ms[1:] != _time_ms[:-1]) | (_price[1:] != _price[:-1]) | (_is_buyer_maker[1:] != _is_buyer_maker[:-1])])
+    _ends = np.r_[_starts[1:], _id.size]
+    _list_messages = []
+    for _agg_id, (_start, _end) in enumerate(zip(_starts, _ends)):
+        _sum_qty = sum([Decimal(repr(float(_))) for _ in _qty[_start:_end]], Decimal(0))
+        _list_messages.append({'e': 'aggTrade', 'E': int(_time_ms[_start]), 's': symbol.upper(), 'a': _agg_id, 'p': repr(float(_price[_start])), 'q': str(_sum_qty), 'f': int(_id[_start]), 'l': int(_id[_end - 1]), 'T': int(_time_ms[_start]), 'm': bool(_is_buyer_maker[_start])})
+    return _list_messages
+
+# 1本のタイムバーの統計量を、約定を1つずつ受け取りながらO(1)で更新するクラス
+# 約定金額加重の平均と平均まわりの2〜4次のモーメントの和は、WeightedMomentAccumulator.addで1つの約定を重み付きの標本として合成する式で更新する
+class RunningTimebar:
+    def __init__(self, bar_start: int = None):
+        self.bar_start = bar_start
+        self.open = np.nan
+        self.high = np.nan
+        self.low = np.nan
+        self.close = np.nan
+        self.buy_trade_count = 0
+        self.sell_trade_count = 0
+        self.buy_quote_qty = 0.0
+        self.moments = WeightedMomentAccumulator()
+
+    def update(self, price: float, quote_qty: float, is_buy: bool, trade_count: int = 1) -> None:
+        if self.buy_trade_count + self.sell_trade_count == 0:
+            self.open = price
+            self.high = price
+            self.low = price
+        else:
+            self.high = max(self.high, price)
+            self.low = min(self.low, price)
+        self.close = price
+
+        if is_buy == True:
+            self.buy_trade_count = self.buy_trade_count + trade_count
+            self.buy_quote_qty = self.buy_quote_qty + quote_qty
+        else:
+            self.sell_trade_count = self.sell_trade_count + trade_count
+
+        self.moments.add(price, quote_qty)
+
+    # タイムバーファイルと同じ列の値の辞書を返す関数
+    # 約定がなかったバーはOHLCを直前のCloseで埋め、約定金額を0にする
+    def to_row(self, last_close: float = np.nan) -> dict:
+        _has_trade = self.buy_trade_count + self.sell_trade_count > 0
+        _close = self.close if _has_trade else last_close
+
+        _sum_weights = self.moments.sum_weights
+        if _sum_weights > 0:
+            _var = self.moments.m2 / _sum_weights
+            _std = np.sqrt(_var)
+            _skew = self.moments.m3 / _sum_weights / _std ** 3 if _var > 0 else 0.0
+            _kurt = (self.moments.m4 / _sum_weights / _var ** 2 if _var > 0 else 0.0) - 3
+            _mean = self.moments.mean_
+        else:
+            _var = _std = _skew = _kurt = _mean = np.nan
+
+        return {
+            'open': self.open if _has_trade else _close,
+            'high': self.high if _has_trade else _close,
+            'low': self.low if _has_trade else _close,
+            'close': _close,
+            'buy_trade_count': self.buy_trade_count,
+            'sell_trade_count': self.sell_trade_count,
+            'buy_quote_qty': self.buy_quote_qty,
+            'sell_quote_qty': _sum_weights - self.buy_quote_qty if _has_trade else 0.0,
+            'vw_price_mean': _mean,
+            'vw_price_var': _var,
+            'vw_price_skew': _skew,
+            'vw_price_kurt': _kurt,
+            'vw_price_std': _std,
+        }
+
+# 約定を1つずつ受け取り、時間間隔ごとのタイムバーをリアルタイムに更新して、閉じたバーを購読者に配信するクラス
+# 日が変わると、その日に受信した約定からtimebar_generate.pyと同じ関数 (write_timebar_files_from_trades) でタイムバーファイルを書き込む
+# 途中から受信を始めた日と、途中で切断された日は約定が揃っていないのでファイルを書き込まない (from_day_start = Trueの場合は最初の日も書き込む)
+# 書き込んだ日はgenerate_timebar_filesと同じくマニフェストに記録するので、再起動後も前日Closeをマニフェストから求められる
+# tradeストリームの場合は約定履歴ファイルから生成したものと同じファイルになる。aggTradeストリームの場合は、約定回数とOHLCは同じになるが、
+# 約定金額は約定ごとではなくまとめた数量から計算するので、約定金額の合計とモーメントは丸め誤差の分だけ異なることがある
+# 壁時計でバーを閉じた後に届いた約定 (遅れた約定) は、配信済みのバーには加えずにlate_trade_countに数え、時刻に従ってその日のタイムバーファイルには含める
+# タイムバーファイルを書き込み済みの前日の約定が届いた場合は、dropped_trade_countに数えて捨てる
+class TimebarStream:
+    def __init__(self, symbol: str = None, intervals: list = None, datadir: str = 'data/binance', fmt: str = None, from_day_start: bool = False):
+        assert symbol is not None
+        assert intervals is not None
+        assert all(86400 % int(_) == 0 for _ in intervals)
+
+        self.symbol = symbol.upper()
+        self.intervals = sorted(set(int(_) for _ in intervals))
+        self.datadir = datadir
+        self.fmt = fmt
+        self.subscribers = []
+
+        self._bars = {}
+        self._last_closes = {_: np.nan for _ in self.intervals}
+        self._day_last_closes = {}
+        self._date = None
+        self._day_is_complete = from_day_start
+        self._has_gap = False
+        self.late_trade_count = 0
+        self.dropped_trade_count = 0
+        self._reset_day_buffer()
+
+    def _reset_day_buffer(self) -> None:
+        self._buffer_time = array.array('q')
+        self._buffer_price = array.array('d')
+        self._buffer_quote_qty = array.array('d')
+        self._buffer_is_buyer_maker = array.array('b')
+        self._buffer_trade_count = array.array('q')
+
+    # 閉じたバーを受け取る関数を登録する (callback(symbol, interval, time, row) の形で呼ばれる)
+    def add_subscriber(self, callback) -> None:
+        self.subscribers.append(callback)
+
+    def _emit(self, interval: int, bar: RunningTimebar) -> None:
+        _row = bar.to_row(self._last_closes[interval])
+        if np.isnan(_row['close']):
+            # まだ一度も約定を受信していない間の空のバーは配信しない
+            return
+        self._last_closes[interval] = _row['close']
+        _time = pd.Timestamp(bar.bar_start, unit = 'ns')
+        for _callback in self.subscribers:
+            _callback(self.symbol, interval, _time, _row)
+
+    # 指定された時刻 [ns] より前に終わるバーを全て閉じて配信する関数 (約定がなかったバーも配信する)
+    def advance_time(self, time_ns: int = None) -> None:
+        assert time_ns is not None
+
+        for _interval in self.intervals:
+            _interval_ns = _interval * 1_000_000_000
+            _bar = self._bars.get(_interval)
+            if _bar is None:
+                continue
+            while _bar.bar_start + _interval_ns <= time_ns:
+                self._emit(_interval, _bar)
+                _bar = RunningTimebar(_bar.bar_start + _interval_ns)
+            self._bars[_interval] = _bar
+
+    # WebSocketが切断されたときに呼ぶ関数
+    # 切断中の約定は受信できないので、その日を不完全にする。再接続してから約定を受信するまでに日が変わった場合は、次の日も不完全にする
+    def mark_disconnected(self) -> None:
+        self._day_is_complete = False
+        self._has_gap = True
+
+    # 約定を1つ (aggTradeの場合はtrade_count回分) 処理する関数
+    # 日が変わった場合は、前日のタイムバーファイルを書き込んでから次の日のバーを始める
+    def process_trade(self, price: float = None, qty: float = None, quote_qty: float = None, time_ms: int = None, is_buyer_maker: bool = None, trade_count: int = 1) -> None:
+        _time_ns = time_ms * 1_000_000
+        _date = pd.Timestamp(time_ms, unit = 'ms').date()
+
+        if self._date is not None and _date < self._date:
+            self.dropped_trade_count = self.dropped_trade_count + trade_count
+            print(f'{self.symbol}のタイムバーファイルを書き込み済みの{_date.isoformat()}の約定が届いたので捨てます (累計{self.dropped_trade_count}回)')
+            return
+
+        if self._date is None:
+            self._date = _date
+        elif _date > self._date:
+            self.advance_time(pd.Timestamp(_date).value)
+            self.finish_day()
+            self._date = _date
+            self._day_is_complete = not self._has_gap
+        self._has_gap = False
+
+        self.advance_time(_time_ns)
+        _is_late = False
+        for _interval in self.intervals:
+            _interval_ns = _interval * 1_000_000_000
+            if _interval not in self._bars:
+                self._bars[_interval] = RunningTimebar(_time_ns - _time_ns % _interval_ns)
+            if _time_ns < self._bars[_interval].bar_start:
+                # 壁時計で既に閉じたバーの約定
+                _is_late = True
+                continue
+            self._bars[_interval].update(price, quote_qty, is_buyer_maker == False, trade_count)
+        if _is_late == True:
+            self.late_trade_count = self.late_trade_count + trade_count
+
+        self._buffer_time.append(_time_ns)
+        self._buffer_price.append(price)
+        self._buffer_quote_qty.append(quote_qty)
+        self._buffer_is_buyer_maker.append(is_buyer_maker)
+        self._buffer_trade_count.append(trade_count)
+
+    # 受信した1日分の約定から、timebar_generate.pyと同じ関数でタイムバーファイルを書き込む関数
+    def finish_day(self) -> None:
+        if self._date is None:
+            return
+
+        _date_str = self._date.isoformat()
+        if self._day_is_complete == False:
+            print(f'{self.symbol}の{_date_str}は途中から受信したか途中で切断されたので、タイムバーファイルを書き込みません')
+            self._reset_day_buffer()
+            return
+
+        _df_trades = pd.DataFrame({
+            'price': np.frombuffer(self._buffer_price, dtype = np.float64),
+            'quote_qty': np.frombuffer(self._buffer_quote_qty, dtype = np.float64),
+            'time': np.frombuffer(self._buffer_time, dtype = np.int64).view('datetime64[ns]'),
+            'is_buyer_maker': np.frombuffer(self._buffer_is_buyer_maker, dtype = np.int8).astype(bool),
+            'trade_count': np.frombuffer(self._buffer_trade_count, dtype = np.int64),
+        })
+
+        _dict_results = write_timebar_files_from_trades(_df_trades, self.datadir, self.symbol, _date_str, self.intervals, self.fmt, self.get_previous_closes(self._date))
+        self._day_last_closes = {_date_str: {_interval: _result['last_close'] for _interval, _result in _dict_results.items()}}
+
+        _dict_manifests = {}
+        for _interval in self.intervals:
+            _manifest = read_timebar_manifest(self.datadir, self.symbol, _interval)
+            _dict_manifests[_interval] = {'days': {}} if _manifest is None else _manifest
+        update_timebar_manifest_entries(_dict_manifests, _date_str, _dict_results)
+        for _interval in self.intervals:
+            write_timebar_manifest(self.datadir, self.symbol, _interval, _dict_manifests[_interval])
+        print(f'{self.symbol}の{_date_str}のタイムバーファイルを書き込みました')
+
+        self._reset_day_buffer()
+
+    # 前日Closeを返す関数 (generate_timebar_filesと同じく、前日のタイムバーがない場合は0、分からない場合はNone)
+    def get_previous_closes(self, date: datetime.date = None) -> dict:
+        assert date is not None
+
+        _previous_date = (date - datetime.timedelta(days = 1)).isoformat()
+        if _previous_date in self._day_last_closes:
+            return {_interval: _last_close for _interval, _last_close in self._day_last_closes[_previous_date].items() if _last_close is not None}
+
+        _dict_previous_closes = {}
+        for _interval in self.intervals:
+            _manifest = read_timebar_manifest(self.datadir, self.symbol, _interval)
+            _previous_entry = None if _manifest is None else _manifest['days'].get(_previous_date)
+            if _previous_entry is None:
+                _dict_previous_closes[_interval] = 0.0
+            elif _previous_entry['complete'] == True and _previous_entry['last_close'] is not None:
+                _dict_previous_closes[_interval] = _previous_entry['last_close']
+        return _dict_previous_closes
+
+# WebSocketで約定を受信し続け、TimebarStreamに渡す関数 (aiohttpが必要)
+# 切断された場合は待ち時間を倍にしながら再接続する。use_wall_clock = Trueの場合は約定がなくても時刻が来たらバーを閉じる
+async def run_timebar_stream(stream: TimebarStream = None, url: str = None, stream_type: str = 'aggTrade', use_wall_clock: bool = True, max_messages: int = None) -> None:
+    assert stream is not None
+
+    import aiohttp
+
+    if url is None:
+        url = f'{binance_stream_url}/{stream.symbol.lower()}@{stream_type}'
+
+    async def _clock():
+        while True:
+            await asyncio.sleep(min(stream.intervals) / 2)
+            stream.advance_time((time.time_ns() // 1_000_000 - stream_close_delay_ms) * 1_000_000)
+
+    _clock_task = asyncio.create_task(_clock()) if use_wall_clock == True else None
+    _num_messages = 0
+    _wait = stream_reconnect_initial_wait
+    try:
+        async with aiohttp.ClientSession() as _session:
+            while max_messages is None or _num_messages < max_messages:
+                try:
+                    async with _session.ws_connect(url, heartbeat = 30) as _ws:
+                        _wait = stream_reconnect_initial_wait
+                        async for _message in _ws:
+                            if _message.type == aiohttp.WSMsgType.TEXT:
+                                _trade = parse_trade_message(json.loads(_message.data))
+                                if _trade is not None:
+                                    stream.process_trade(*_trade)
+                                _num_messages = _num_messages + 1
+                                if max_messages is not None and _num_messages >= max_messages:
+                                    break
+                            elif _message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                                stream.mark_disconnected()
+                                break
+                        else:
+                            # サーバーから切断された (リプレイの終わりなど)
+                            stream.mark_disconnected()
+                            if use_wall_clock == False:
+                                break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    stream.mark_disconnected()
+                    print(f'WebSocketの接続に失敗しました ({e})。{_wait:.0f}秒後に再接続します')
+                    await asyncio.sleep(_wait)
+                    _wait = min(_wait * 2, stream_reconnect_max_wait)
+    finally:
+        if _clock_task is not None:
+            _clock_task.cancel()
+
+# 保存済みの約定履歴ファイルをaggTrade/tradeメッセージとして配信するローカルのWebSocketサーバーを起動する関数 (動作確認用、aiohttpが必要)
+# 接続されるたびに、約定履歴ファイルを日付順に最初から配信して切断する (aggTradeはmake_trade_messagesで約定をまとめてf/l付きで配信する)
+async def serve_trades_replay(list_filenames: list = None, host: str = '127.0.0.1', port: int = 8765, symbol: str = 'BTCUSDT', stream_type: str = 'aggTrade'):
+    assert list_filenames is not None
+
+    from aiohttp import web
+
+    async def _handler(request):
+        _ws = web.WebSocketResponse()
+        await _ws.prepare(request)
+        for _filename in sorted(list_filenames, key = lambda x: Path(x).name):
+            _df = read_datafile(_filename, columns = ['id', 'price', 'qty', 'time', 'is_buyer_maker'])
+            for _message in make_trade_messages(_df, symbol, stream_type):
+                await _ws.send_str(json.dumps(_message))
+        await _ws.close()
+        return _ws
+
+    _app = web.Application()
+    _app.router.add_get('/ws', _handler)
+    _runner = web.AppRunner(_app)
+    await _runner.setup()
+    _site = web.TCPSite(_runner, host, port)
+    await _site.start()
+    return _runner
+
+# 引数処理とストリーム受信関数の起動部分
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--symbol', required = True, help = '受信する対象の銘柄 例:BTCUSDT')
+    parser.add_argument('interval', type = int, nargs = '+', help = '生成するタイムバーの時間間隔 [秒] 例:1 60')
+    parser.add_argument('--stream', default = 'aggTrade', choices = ['aggTrade', 'trade'], help = '受信するストリームの種類')
+    parser.add_argument('--url', default = None, help = '接続するWebSocketのURL (省略時はBinance)')
+    parser.add_argument('--format', default = None, choices = [_ for _ in datafile_extensions.keys() if _ != 'compact'], help = 'タイムバーファイルの保存形式 (省略時はpickle)')
+    parser.add_argument('--verbose', action = 'store_true', help = '閉じたバーを表示する')
+    args = parser.parse_args()
+
+    for _interval in args.interval:
+        if 86400 % _interval != 0:
+            print('interval は 86400秒 (1日) の約数を指定してください')
+            exit(0)
+
+    _stream = TimebarStream(args.symbol, args.interval, datadir, args.format)
+    if args.verbose == True:
+        _stream.add_subscriber(lambda symbol, interval, time, row: print(symbol, interval, time, row))
+
+    asyncio.run(run_timebar_stream(_stream, args.url, args.stream))
@@ -0,0 +1,109 @@
+import numpy as np
+
+# 約定金額の分布を表す、対数の固定幅のビンのヒストグラムの設定
+# ビン0は約定金額がsize_sketch_min_quote未満の約定、ビンi (1以上) は min_quote * 2^((i-1)/bins_per_octave) 以上 min_quote * 2^(i/bins_per_octave) 未満の約定で、
+# 最後のビンはそれ以上の約定もすべて含む。ビンの境界を固定しているので、ヒストグラムは足し合わせるだけで厳密に合成できる
+# (ビンの設定を変えると既存のタイムバーファイルのヒストグラムと合成できなくなるので変えないこと)
+size_sketch_min_quote = 10.0
+size_sketch_bins_per_octave = 2
+size_sketch_num_bins = 50
+
+# タイムバーファイルに保存するヒストグラムの列名 (ビンごとの約定回数と約定金額)
+size_sketch_count_columns = [f'size_count_{_:02}' for _ in range(size_sketch_num_bins)]
+size_sketch_quote_columns = [f'size_quote_{_:02}' for _ in range(size_sketch_num_bins)]
+
+# ビンの下端と上端の約定金額を返す関数 (ビン0の下端と最後のビンの上端は、隣のビンと同じ比率で外挿した値)
+def get_size_sketch_edges() -> tuple:
+    _edges = size_sketch_min_quote * 2.0 ** (np.arange(-1, size_sketch_num_bins) / size_sketch_bins_per_octave)
+    return (_edges[:-1], _edges[1:])
+
+# 約定金額のヒストグラムの集計器
+# counts, quotesは (グループ数, ビン数) の配列で、グループ (バー) ごとにビンごとの約定回数と約定金額を保持する
+# 約定金額の配列から作る (from_array)、タイムバーの列から作る (from_dataframe)、合成する (merge)、隣り合うグループをまとめる (rollup) ことができ、
+# WeightedMomentAccumulatorと同じく、細かいバーの結果から粗いバーや複数日の結果を約定履歴を読み直さずに求められる
+class TradeSizeHistogram:
+    def __init__(self, counts: np.ndarray = None, quotes: np.ndarray = None):
+        assert counts is not None
+        assert quotes is not None
+        assert counts.shape == quotes.shape
+
+        self.counts = counts
+        self.quotes = quotes
+
+    # 約定金額の配列から、グループごとのヒストグラムを作る関数
+    # groupsに約定ごとのグループのインデックス (0以上num_groups未満) を渡す。ビンのインデックスとnp.bincountで1回のパスで計算する
+    @classmethod
+    def from_array(cls, quote_qty: np.ndarray = None, groups: np.ndarray = None, num_groups: int = None):
+        assert quote_qty is not None
+        assert groups is not None
+        assert num_groups is not None
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            _bins = np.floor(np.log2(quote_qty / size_sketch_min_quote) * size_sketch_bins_per_octave) + 1
+        _bins = np.clip(np.nan_to_num(_bins, nan = 0.0, neginf = 0.0), 0, size_sketch_num_bins - 1).astype(np.int64)
+
+        _cells = groups * size_sketch_num_bins + _bins
+        _counts = np.bincount(_cells, minlength = num_groups * size_sketch_num_bins).reshape(num_groups, size_sketch_num_bins)
+        _quotes = np.bincount(_cells, weights = quote_qty, minlength = num_groups * size_sketch_num_bins).reshape(num_groups, size_sketch_num_bins)
+
+        return cls(_counts, _quotes)
+
+    # タイムバーのデータフレーム (size_count_*, size_quote_*列) からヒストグラムを作る関数
+    @classmethod
+    def from_dataframe(cls, df):
+        assert all([_ in df.columns for _ in size_sketch_count_columns]), 'タイムバーに約定金額のヒストグラムの列がありません (--size-sketchを付けて生成してください)'
+
+        return cls(df[size_sketch_count_columns].values, df[size_sketch_quote_columns].values)
+
+    # タイムバーファイルに保存する列の辞書を返す関数
+    def to_columns(self) -> dict:
+        _dict_columns = {}
+        for _bin in range(size_sketch_num_bins):
+            _dict_columns[size_sketch_count_columns[_bin]] = self.counts[:, _bin].astype(np.int64)
+        for _bin in range(size_sketch_num_bins):
+            _dict_columns[size_sketch_quote_columns[_bin]] = self.quotes[:, _bin]
+        return _dict_columns
+
+    # 2つのヒストグラムを合成した新しいヒストグラムを返す関数 (同じインデックスのグループどうしを足し合わせる)
+    def merge(self, other):
+        return TradeSizeHistogram(self.counts + other.counts, self.quotes + other.quotes)
+
+    # 隣り合うfactor個のグループをまとめて1つのグループにしたヒストグラムを返す関数
+    def rollup(self, factor: int = None):
+        assert factor is not None
+        assert self.counts.shape[0] % factor == 0
+
+        return TradeSizeHistogram(self.counts.reshape(-1, factor, size_sketch_num_bins).sum(axis = 1), self.quotes.reshape(-1, factor, size_sketch_num_bins).sum(axis = 1))
+
+    # 約定回数で数えた約定金額の分位点 (qは0〜1) を返す関数 (約定のないグループはNaN)
+    # 分位点の順位を含むビンの中で、ビンの下端から上端まで対数で線形に補間する
+    # 誤差はビンの幅の比率 2^(1/bins_per_octave) 倍 (約1.41倍) 以内だが、これはビン1から最後の1つ前のビンまでの場合だけで、
+    # 分位点がビン0 (size_sketch_min_quote未満) か最後のビン (それ以上すべて) に入る場合は、外挿したビンの端で補間した値なので誤差に上限はない
+    def quantile(self, q: float = None) -> np.ndarray:
+        assert q is not None
+        assert 0.0 <= q <= 1.0
+
+        _lower, _upper = get_size_sketch_edges()
+        _cumsum = np.cumsum(self.counts, axis = 1)
+        _total = _cumsum[:, -1]
+        _rank = q * _total
+
+        _bin = np.minimum((_cumsum < _rank[:, np.newaxis]).sum(axis = 1), size_sketch_num_bins - 1)
+        _rows = np.arange(len(_total))
+        _count = self.counts[_rows, _bin]
+        _before = _cumsum[_rows, _bin] - _count
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            _fraction = np.clip(np.where(_count > 0, (_rank - _before) / _count, 0.0), 0.0, 1.0)
+            _quantile = _lower[_bin] * (_upper[_bin] / _lower[_bin]) ** _fraction
+        return np.where(_total > 0, _quantile, np.nan)
+
+    # 約定金額がthreshold以上の約定 (大口約定) が約定金額に占める割合を返す関数 (約定のないグループはNaN)
+    # thresholdはビンの境界に丸め、下端がthreshold以上のビンを大口約定として数える
+    def large_share(self, threshold: float = None) -> np.ndarray:
+        assert threshold is not None
+
+        _lower, _ = get_size_sketch_edges()
+        _large = _lower >= threshold * (1 - 1e-9)
+        _total = self.quotes.sum(axis = 1)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.where(_total > 0, self.quotes[:, _large].sum(axis = 1) / _total, np.nan)
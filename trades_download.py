@@ -4,13 +4,47 @@ import datetime
 import time
 from pathlib import Path
 import re
+import os
+import random
+import asyncio
 import requests
 import zipfile
-from io import BytesIO
-from joblib import Parallel, delayed
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from retrying import retry
 import argparse
-from exercise_util import tqdm_joblib, identify_datafiles, target_symbols
+from tqdm.auto import tqdm
+from exercise_core import identify_datafiles, target_symbols
+from datafile_storage import datafile_extensions, get_dataset_format, strip_datafile_extension, datafile_appender
+from task_scheduler import run_task_graph
+from pipeline_metrics import task_metrics, record_task_metrics, enable_task_metrics, export_task_metrics, metrics_profilers
+
+# 約定履歴の.zipのダウンロード元 (テスト時はローカルのHTTPサーバーに差し替えられる)
+binance_data_url = 'https://data.binance.vision/data/futures/um/daily/trades'
+
+# 非同期ダウンロードのリトライ回数と待ち時間 [秒]
+async_retry_max_attempts = 5
+async_retry_base_wait = 1.0
+async_retry_max_wait = 60.0
+
+# 約定履歴CSVの列と、解析時に使う型
+trade_csv_columns = ['id', 'price', 'qty', 'quote_qty', 'time', 'is_buyer_maker']
+trade_csv_dtypes = {'id': np.int64, 'price': np.float64, 'qty': np.float64, 'quote_qty': np.float64, 'time': np.int64, 'is_buyer_maker': bool}
+
+# 約定履歴CSVを一度に解析する行数 (ワーカーあたりのメモリ使用量はこの行数に比例する)
+trade_csv_chunk_rows = 1_000_000
+
+# ダウンロードしたzipをメモリに置いておく上限 [バイト] (これを超えると一時ファイルに書き出す)
+trade_zip_spool_bytes = 64 * 1024 * 1024
+
+# ダウンロード1ワーカーあたりに見積もるメモリ使用量 [バイト] (並列数を空きメモリから決めるのに使う)
+# 列指向形式はチャンクごとに書き出すので、trade_csv_chunk_rows行のチャンクの解析に使う分だけを見積もる
+download_worker_memory_bytes = 512 * 1024 * 1024
+
+# pickleとcompactは1日分のチャンクを溜めてから結合して書き込むので、1日分の約定履歴のデータフレームの2倍 (チャンクと結合後) を加えて見積もる
+# 1日の約定件数は取引の多い日のBTCUSDTを想定し、1行のバイト数はid, price, qty, quote_qty, time (8バイト) とis_buyer_maker (1バイト) の合計
+trade_day_max_rows = 20_000_000
+trade_frame_row_bytes = 8 * 5 + 1
 
 # ファイル保存ディレクトリの中を見て、まだダウンロードしていないデータファイル名を返す関数
 def identify_not_yet_downloaded_dates(symbol: str = None, datadir: str = None) -> set:
@@ -36,88 +70,322 @@ def identify_not_yet_downloaded_dates(symbol: str = None, datadir: str = None) -
     _set_existing_filenames = set()
     for _existing_file in _list_existing_files:
         _filename = _existing_file.name
-        _set_existing_filenames.add(_filename.replace('.pkl.gz', '.zip'))
+        _set_existing_filenames.add(f'{strip_datafile_extension(_filename)}.zip')
     
     return sorted(_set_all_filenames - _set_existing_filenames)
 
-# 指定されたファイル名をもとに、.zipをダウンロードしてデータフレームを作り、pkl.gzとして保存する関数
+# ダウンロードした.zipから約定履歴のデータフレームを作り、fmtで指定された形式 (省略時はpkl.gz) で保存する関数
+# zip_sourceには.zipのファイルパスかファイルオブジェクトを指定する
+# CSVはzipから展開しながらtrade_csv_chunk_rows行ずつ解析し、列指向形式の場合はチャンクごとにファイルへ追記する
+# zipのCRCは展開しながら検証される (壊れていればzipfile.BadZipFileが発生する) ので、testzip()で事前に全体を展開することはしない
+def convert_trade_zip(zip_source = None, target_file_name: str = None, datadir: str = None, fmt: str = None) -> None:
+    assert zip_source is not None
+    assert target_file_name is not None
+    assert datadir is not None
+
+    with task_metrics('convert_trade_zip', target_file_name) as _metrics:
+        _fmt = get_dataset_format('trades', fmt)
+        _ext = datafile_extensions[_fmt]
+
+        _m = re.match('(.+)-trades.*', target_file_name)
+        _symbol = _m.group(1)
+        _stem = Path(target_file_name).stem
+        if isinstance(zip_source, (str, Path)):
+            _metrics.add_file_in(zip_source)
+
+        with zipfile.ZipFile(zip_source) as _csvzip:
+            with _csvzip.open(f'{_stem}.csv') as _csvfile:
+                if _csvfile.peek(1)[:1] == b'i':
+                    # ヘッダーラインがあるので削除しないといけない
+                    _header = 0
+                else:
+                    _header = None
+
+                try:
+                    # pickleとcompactはappenderを閉じるときにまとめて書き込むので、appender全体を書き込みの時間とする
+                    with _metrics.phase('serialize'), datafile_appender(f'{datadir}/trades/{_symbol}/temp-{_stem}{_ext}', _fmt) as _append:
+                        _reader = pd.read_csv(_csvfile, names = trade_csv_columns, dtype = trade_csv_dtypes, header = _header, chunksize = trade_csv_chunk_rows)
+                        while True:
+                            # zipの展開とCSVの解析はチャンクを取り出すときに行われる
+                            with _metrics.phase('read'):
+                                _df = next(_reader, None)
+                            if _df is None:
+                                break
+                            _metrics.add_rows(len(_df))
+                            with _metrics.phase('compute'):
+                                _df['time'] = pd.to_datetime(_df['time'], unit = 'ms')
+                            _append(_df)
+                except zipfile.BadZipFile as e:
+                    print(f'{target_file_name}が壊れています。リトライします。')
+                    raise e
+                except Exception as e:
+                    print(f'pd.read_csv({target_file_name})が例外 {e} を返しました。リトライします。')
+                    raise e
+
+        _tempfile = Path(f'{datadir}/trades/{_symbol}/temp-{_stem}{_ext}')
+        _metrics.add_file_out(_tempfile.rename(f'{datadir}/trades/{_symbol}/{_stem}{_ext}'))
+
+        return
+
+# 指定されたファイル名をもとに、.zipをダウンロードしてデータフレームを作り、fmtで指定された形式 (省略時はpkl.gz) で保存する関数
+# レスポンスはストリームで受け取り、大きなzipはメモリに置かずに一時ファイルへ書き出す
 @retry(stop_max_attempt_number = 5, wait_fixed = 1000)
-def download_trade_zip(target_file_name: str = None, datadir: str = None) -> None:
+def download_trade_zip(target_file_name: str = None, datadir: str = None, fmt: str = None, base_url: str = None) -> None:
     assert str is not None
     assert datadir is not None
     
     _m = re.match('(.+)-trades.*', target_file_name)
     _symbol = _m.group(1)
-    _stem = Path(target_file_name).stem
     
-    _url = f'https://data.binance.vision/data/futures/um/daily/trades/{_symbol}/{target_file_name}'
-    
-    _r = requests.get(_url)
-    if _r.status_code != requests.codes.ok:
-        print(f'response.get({_url})からHTTPステータスコード {_r.status_code} が返されました。このファイルをスキップします。')
-        time.sleep(1)
-        return
+    _url = f'{base_url or binance_data_url}/{_symbol}/{target_file_name}'
     
-    _csvzip = zipfile.ZipFile(BytesIO(_r.content))
-    if _csvzip.testzip() != None:
-        print(f'Corrupt zip file from {_url}. Retry.')
-        raise Exception
-    _csvraw = _csvzip.read(f'{_stem}.csv')
-    
-    if chr(_csvraw[0]) == 'i':
-        # ヘッダーラインがあるので削除しないといけない
-        _header = 0
-    else:
-        _header = None
-    
-    try:
-        _df = pd.read_csv(BytesIO(_csvraw), names = ['id', 'price', 'qty', 'quote_qty', 'time', 'is_buyer_maker'], dtype = {0: int, 1: float, 2: float, 3: float, 4: float, 5: bool}, header = _header)
-    except Exception as e:
-        print(f'pd.read_csv({_url})が例外 {e} を返しました。リトライします。')
-        raise e
-        
-    _df['time'] = pd.to_datetime(_df['time'] , unit = 'ms')
-    _df.to_pickle(f'{datadir}/trades/{_symbol}/temp-{_stem}.pkl.gz')
-    _tempfile = Path(f'{datadir}/trades/{_symbol}/temp-{_stem}.pkl.gz')
-    _tempfile.rename(f'{datadir}/trades/{_symbol}/{_stem}.pkl.gz')
+    with task_metrics('download_trade_zip', target_file_name) as _metrics, requests.get(_url, stream = True) as _r:
+        if _r.status_code != requests.codes.ok:
+            print(f'response.get({_url})からHTTPステータスコード {_r.status_code} が返されました。このファイルをスキップします。')
+            time.sleep(1)
+            return
+
+        with tempfile.SpooledTemporaryFile(max_size = trade_zip_spool_bytes, dir = f'{datadir}/trades/{_symbol}') as _zipfile:
+            with _metrics.phase('download'):
+                for _chunk in _r.iter_content(chunk_size = 1 << 20):
+                    _zipfile.write(_chunk)
+                    _metrics.add_bytes_in(len(_chunk))
+            _zipfile.seek(0)
+            convert_trade_zip(_zipfile, target_file_name, datadir, fmt)
 
     return
 
-# joblibを使って4並列でダウンロードジョブを実行する関数
-def download_trade_from_binance(symbol: str = None) -> None:
-    assert symbol is not None
-    
-    _datadir = 'data/binance'    
-    _symbol = symbol.upper()
+# 空きメモリ [バイト] を返す関数 (Linuxではページキャッシュを含めた/proc/meminfoのMemAvailableを使う)
+def get_available_memory_bytes() -> int:
+    try:
+        with open('/proc/meminfo', 'r') as _f:
+            for _line in _f:
+                if _line.startswith('MemAvailable:'):
+                    return int(_line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# 約定履歴の保存形式ごとに、ダウンロードと変換の1ワーカーあたりのメモリ使用量 [バイト] を見積もる関数
+def estimate_download_worker_memory_bytes(fmt: str = None) -> int:
+    _fmt = get_dataset_format('trades', fmt)
+    if _fmt in ['pickle', 'compact']:
+        return download_worker_memory_bytes + 2 * trade_day_max_rows * trade_frame_row_bytes
+    return download_worker_memory_bytes
+
+# 空きメモリとCPU数から、約定履歴のダウンロードと変換を並列に実行するワーカー数を決める関数
+def estimate_download_n_jobs(fmt: str = None) -> int:
+    _cpu_count = os.cpu_count() or 1
+    _available_bytes = get_available_memory_bytes()
+    if _available_bytes is None:
+        return _cpu_count
+
+    return int(max(1, min(_cpu_count, _available_bytes // estimate_download_worker_memory_bytes(fmt))))
+
+# HTTPレスポンスのRetry-Afterヘッダーから待ち時間 [秒] を求める関数 (ヘッダーがなければNone)
+def parse_retry_after(value: str = None):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        _retry_at = pd.Timestamp(value)
+        return max(0.0, (_retry_at - pd.Timestamp.now(tz = _retry_at.tz)).total_seconds())
+    except ValueError:
+        return None
+
+# 1ファイル分のダウンロードで作られる書きかけのファイル (temp-付きの.zipと変換中のデータファイル) を削除する関数
+def remove_partial_trade_files(target_file_name: str = None, datadir: str = None, fmt: str = None) -> None:
+    assert target_file_name is not None
+    assert datadir is not None
+
+    _m = re.match('(.+)-trades.*', target_file_name)
+    _symbol = _m.group(1)
+    _stem = Path(target_file_name).stem
+    _ext = datafile_extensions[get_dataset_format('trades', fmt)]
+    Path(f'{datadir}/trades/{_symbol}/temp-{target_file_name}').unlink(missing_ok = True)
+    Path(f'{datadir}/trades/{_symbol}/temp-{_stem}{_ext}').unlink(missing_ok = True)
+
+# 非同期で1ファイル分の.zipをダウンロードし、CSVの解析と保存はプロセスプールで行う関数
+# レスポンスはメモリに溜めずにtemp-付きの.zipファイルへストリームで書き出す
+# HTTP 429/418の場合はRetry-Afterに従って全てのダウンロードを一時停止し、5xxや通信のエラーは指数バックオフでリトライする
+# リトライしても直らない例外 (ディスクの書き込みエラー、zipにCSVがない、プロセスプールのワーカーが落ちたなど) はこのファイルだけの失敗として表示し、
+# 書きかけのファイルを削除してFalseを返す (他のファイルのダウンロードは続ける)
+# 他のダウンロードと並行して進むのでtask_metricsは使えないため、受信にかかった時間とバイト数はrecord_task_metricsでdownloadの内訳として記録する
+async def download_trade_zip_async(session = None, process_pool = None, target_file_name: str = None, datadir: str = None, fmt: str = None, base_url: str = None, rate_limit: dict = None) -> bool:
+    assert session is not None
+    assert process_pool is not None
+    assert target_file_name is not None
+    assert datadir is not None
+    assert rate_limit is not None
+
+    import aiohttp
+
+    _m = re.match('(.+)-trades.*', target_file_name)
+    _symbol = _m.group(1)
+    _url = f'{base_url or binance_data_url}/{_symbol}/{target_file_name}'
+    _zipfile = Path(f'{datadir}/trades/{_symbol}/temp-{target_file_name}')
+    _loop = asyncio.get_running_loop()
+
+    for _attempt in range(async_retry_max_attempts):
+        _backoff = min(async_retry_max_wait, async_retry_base_wait * 2 ** _attempt) * (0.5 + random.random())
+
+        # 他のダウンロードがレート制限を受けている間は待つ
+        _wait = rate_limit['until'] - _loop.time()
+        if _wait > 0:
+            await asyncio.sleep(_wait)
+
+        try:
+            async with session.get(_url) as _r:
+                if _r.status in (429, 418):
+                    _retry_after = parse_retry_after(_r.headers.get('Retry-After'))
+                    _wait = _retry_after if _retry_after is not None else _backoff
+                    rate_limit['until'] = max(rate_limit['until'], _loop.time() + _wait)
+                    print(f'{_url}からHTTPステータスコード {_r.status} が返されました。{_wait:.1f}秒待ってリトライします。')
+                    continue
+                if _r.status >= 500:
+                    print(f'{_url}からHTTPステータスコード {_r.status} が返されました。{_backoff:.1f}秒待ってリトライします。')
+                    await asyncio.sleep(_backoff)
+                    continue
+                if _r.status != 200:
+                    print(f'{_url}からHTTPステータスコード {_r.status} が返されました。このファイルをスキップします。')
+                    return False
+
+                _started_at = datetime.datetime.now().isoformat(timespec = 'milliseconds')
+                _start = time.perf_counter()
+                _bytes_in = 0
+                with open(_zipfile, 'wb') as _f:
+                    async for _chunk in _r.content.iter_chunked(1 << 20):
+                        _f.write(_chunk)
+                        _bytes_in = _bytes_in + len(_chunk)
+                _seconds = time.perf_counter() - _start
+                record_task_metrics('download_trade_zip', target_file_name, _started_at, _seconds, {'download': _seconds}, bytes_in = _bytes_in)
+
+            await _loop.run_in_executor(process_pool, convert_trade_zip, str(_zipfile), target_file_name, datadir, fmt)
+            _zipfile.unlink()
+            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError, zipfile.BadZipFile, ValueError) as e:
+            print(f'{_url}のダウンロード中に例外 {e!r} が発生しました。{_backoff:.1f}秒待ってリトライします。')
+            remove_partial_trade_files(target_file_name, datadir, fmt)
+            await asyncio.sleep(_backoff)
+        except Exception as e:
+            print(f'{_url}のダウンロード中に例外 {e!r} が発生しました。このファイルをスキップします。')
+            remove_partial_trade_files(target_file_name, datadir, fmt)
+            return False
+
+    print(f'{_url}のダウンロードに{async_retry_max_attempts}回失敗しました。このファイルをスキップします。')
+    remove_partial_trade_files(target_file_name, datadir, fmt)
+    return False
+
+# 共有のコネクションプールを使って、複数の.zipを非同期に並行ダウンロードする関数
+# concurrencyは同時に張るHTTPコネクション数、n_workersはCSVを解析するプロセス数 (省略時は空きメモリから決める)
+# base_urlを指定すると、binance_data_urlの代わりにそのURLからダウンロードする (ミラーやテスト用のサーバーなど)
+# 戻り値はファイルごとの成否 (True/False) のリストで、失敗したファイルは最後にまとめて表示する
+async def download_trade_files_async(target_file_names: list = None, datadir: str = None, fmt: str = None, concurrency: int = 8, n_workers: int = None, base_url: str = None) -> list:
+    assert target_file_names is not None
+    assert datadir is not None
+
+    import aiohttp
+
+    _connector = aiohttp.TCPConnector(limit = concurrency, limit_per_host = concurrency)
+    _timeout = aiohttp.ClientTimeout(total = None, sock_connect = 30, sock_read = 60)
+    _rate_limit = {'until': 0.0}
+
+    if n_workers is None:
+        n_workers = estimate_download_n_jobs(fmt)
+
+    with ProcessPoolExecutor(max_workers = n_workers) as _process_pool:
+        async with aiohttp.ClientSession(connector = _connector, timeout = _timeout) as _session:
+            with tqdm(total = len(target_file_names), miniters = 1, smoothing = 0) as _pbar:
+                async def _download(target_file_name):
+                    try:
+                        return await download_trade_zip_async(_session, _process_pool, target_file_name, datadir, fmt, base_url, _rate_limit)
+                    finally:
+                        _pbar.update(1)
+
+                _list_results = await asyncio.gather(*[_download(_) for _ in target_file_names], return_exceptions = True)
+
+    _list_failed = []
+    for _target_file_name, _result in zip(target_file_names, _list_results):
+        if isinstance(_result, BaseException):
+            print(f'{_target_file_name}のダウンロード中に例外 {_result!r} が発生しました。')
+            remove_partial_trade_files(_target_file_name, datadir, fmt)
+        if _result != True:
+            _list_failed.append(_target_file_name)
+    if len(_list_failed) > 0:
+        print(f'{len(_list_failed)}個のファイルのダウンロードに失敗しました: {", ".join(_list_failed)}')
+
+    return [_ == True for _ in _list_results]
+
+# 複数の銘柄の約定履歴ファイルを、全銘柄の未ダウンロードの日をまとめて1つのプロセスプールでダウンロードする関数
+# 並列数は空きメモリと保存形式から決める
+# use_async = Trueの場合は、asyncioと共有のコネクションプールでダウンロードし、CSVの解析はプロセスプールで行う
+# base_urlを指定すると、binance_data_urlの代わりにそのURLからダウンロードする
+def download_trades_for_symbols(symbols: list = None, fmt: str = None, use_async: bool = False, concurrency: int = 8, base_url: str = None) -> None:
+    assert symbols is not None
+
+    _datadir = 'data/binance'
+    _list_symbols = [_.upper() for _ in symbols]
 
     # 処理開始前に全ての未完了ファイルを削除する
-    _list_incomplete_files = identify_datafiles(_datadir, 'trades', _symbol, incomplete = True)
-    for _incomplete_file in _list_incomplete_files:
-        _incomplete_file.unlink()
+    for _symbol in _list_symbols:
+        _list_incomplete_files = identify_datafiles(_datadir, 'trades', _symbol, incomplete = True)
+        for _incomplete_file in _list_incomplete_files:
+            _incomplete_file.unlink()
 
-    _set_target_files = identify_not_yet_downloaded_dates(_symbol, _datadir)  
-    _num_files = len(_set_target_files)
-    print(f'{symbol}の約定履歴ファイルを{_num_files}個ダウンロードします')
-    
-    with tqdm_joblib(total = _num_files):
-        r = Parallel(n_jobs = -1, timeout = 60*60*24)([delayed(download_trade_zip)(_f, _datadir) for _f in _set_target_files])
+    _list_target_files = []
+    for _symbol in _list_symbols:
+        _set_target_files = identify_not_yet_downloaded_dates(_symbol, _datadir)
+        print(f'{_symbol}の約定履歴ファイルを{len(_set_target_files)}個ダウンロードします')
+        _list_target_files = _list_target_files + sorted(_set_target_files)
+
+    _n_jobs = estimate_download_n_jobs(fmt)
+
+    if use_async == True:
+        asyncio.run(download_trade_files_async(_list_target_files, _datadir, fmt, concurrency, _n_jobs, base_url))
+    else:
+        # ダウンロード前にはファイルの大きさが分からないので、新しい日 (約定が多い) から順に1ファイルずつ投入する
+        _list_tasks = [{'key': _f, 'func': download_trade_zip, 'args': (_f, _datadir, fmt, base_url), 'cost': _idx} for _idx, _f in enumerate(sorted(_list_target_files, key = lambda x: x[-14:]))]
+        run_task_graph(_list_tasks, max_workers = _n_jobs, batch_cost = 0, desc = 'download')
 
     # 処理開始後に全ての未完了ファイルを削除する
-    _list_incomplete_files = identify_datafiles(_datadir, 'trades', _symbol, incomplete = True)
-    for _incomplete_file in _list_incomplete_files:
-        _incomplete_file.unlink()
+    for _symbol in _list_symbols:
+        _list_incomplete_files = identify_datafiles(_datadir, 'trades', _symbol, incomplete = True)
+        for _incomplete_file in _list_incomplete_files:
+            _incomplete_file.unlink()
 
-    return
+# 1つの銘柄の約定履歴ファイルをダウンロードする関数 (download_trades_for_symbolsを1銘柄で呼ぶ)
+def download_trade_from_binance(symbol: str = None, fmt: str = None, use_async: bool = False, concurrency: int = 8, base_url: str = None) -> None:
+    assert symbol is not None
+
+    download_trades_for_symbols([symbol], fmt, use_async, concurrency, base_url)
 
 # 引数処理とダウンロード関数の起動部分
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--symbol', help = 'ダウンロードする対象の銘柄 例:BTCUSDT')
+    parser.add_argument('--format', default = None, choices = list(datafile_extensions.keys()), help = '約定履歴ファイルの保存形式 (省略時はpickle)')
+    parser.add_argument('--async', dest = 'use_async', action = 'store_true', help = 'asyncioと共有のコネクションプールでダウンロードする (aiohttpが必要)')
+    parser.add_argument('--concurrency', type = int, default = 8, help = '--async時に同時に張るHTTPコネクション数')
+    parser.add_argument('--base-url', default = None, help = f'約定履歴の.zipのダウンロード元 (省略時は{binance_data_url})')
+    parser.add_argument('--metrics-dir', help = 'タスクごとの処理時間の内訳などを記録するディレクトリ (省略時は記録しない)')
+    parser.add_argument('--profile', choices = metrics_profilers, help = '--metrics-dirにタスクのプロファイルも保存する')
+    parser.add_argument('--profile-top', type = int, default = 10, help = 'プロファイルを残す処理時間が長かったタスクの数')
     args = parser.parse_args()
 
+    if args.metrics_dir:
+        enable_task_metrics(args.metrics_dir, args.profile)
+
     symbol = args.symbol
     if symbol:
-        download_trade_from_binance(symbol)
+        download_trades_for_symbols([symbol], args.format, args.use_async, args.concurrency, args.base_url)
     else:
-        for _symbol in target_symbols.keys():
-            download_trade_from_binance(_symbol)
+        download_trades_for_symbols(list(target_symbols.keys()), args.format, args.use_async, args.concurrency, args.base_url)
+
+    if args.metrics_dir:
+        export_task_metrics(args.metrics_dir, args.profile_top)
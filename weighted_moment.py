@@ -0,0 +1,171 @@
+import numpy as np
+
+# 加重平均と、加重平均まわりの2〜4次のモーメントの和 (M2, M3, M4) を保持する集計器
+# 各フィールドはスカラーでも、グループごとの値を並べた配列でもよく、配列の場合はグループごとに独立に計算する
+# 値の配列から作る (from_array)、1つずつ値を追加する (add)、2つの集計器を合成する (merge)、隣り合うグループをまとめる (rollup) ことができ、
+# 合成は加重版のPébayの式で行うので、細かいグループの集計結果から粗いグループの結果を元の値を読み直さずに厳密に求められる
+# 重みの合計が0のグループの平均は内部では0として持ち、mean, var, skew, kurtではNaNを返す
+class WeightedMomentAccumulator:
+    def __init__(self, count = 0, sum_weights = 0.0, mean = 0.0, m2 = 0.0, m3 = 0.0, m4 = 0.0):
+        self.count = count
+        self.sum_weights = sum_weights
+        self.mean_ = mean
+        self.m2 = m2
+        self.m3 = m3
+        self.m4 = m4
+
+    # 値と重みの配列から集計器を作る関数
+    # groupsに値ごとのグループのインデックス (0以上num_groups未満) を渡すと、グループごとの集計器を配列で作る
+    # 数値誤差を抑えるため、先に加重平均を求めてから偏差でモーメントの和を計算する
+    @classmethod
+    def from_array(cls, values: np.ndarray = None, weights: np.ndarray = None, groups: np.ndarray = None, num_groups: int = None):
+        assert values is not None
+        assert weights is not None
+        assert values.shape == weights.shape
+
+        if groups is None:
+            _sum_weights = np.sum(weights)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                _mean = np.sum(weights * values) / _sum_weights if _sum_weights != 0 else 0.0
+            _deviation = values - _mean
+            _weighted_deviation_2 = weights * _deviation ** 2
+            return cls(values.size, _sum_weights, _mean, np.sum(_weighted_deviation_2), np.sum(_weighted_deviation_2 * _deviation), np.sum(_weighted_deviation_2 * _deviation ** 2))
+
+        assert num_groups is not None
+        _count = np.bincount(groups, minlength = num_groups)
+        _sum_weights = np.bincount(groups, weights = weights, minlength = num_groups)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            _mean = np.bincount(groups, weights = weights * values, minlength = num_groups) / _sum_weights
+        _mean = np.where(_sum_weights != 0, _mean, 0.0)
+        _deviation = values - _mean[groups]
+        _weighted_deviation_2 = weights * _deviation ** 2
+        _m2 = np.bincount(groups, weights = _weighted_deviation_2, minlength = num_groups)
+        _m3 = np.bincount(groups, weights = _weighted_deviation_2 * _deviation, minlength = num_groups)
+        _m4 = np.bincount(groups, weights = _weighted_deviation_2 * _deviation ** 2, minlength = num_groups)
+
+        return cls(_count, _sum_weights, _mean, _m2, _m3, _m4)
+
+    # 値を1つ (配列の場合はグループごとに1つずつ) 追加する関数 (ストリーミング処理用)
+    # 高次のモーメントから、更新前の低次のモーメントを使って更新する
+    # スカラーの場合は約定ごとに呼ばれるので、numpyの関数を使わずにPythonのfloatのまま計算する
+    def add(self, value, weight) -> None:
+        self.count = self.count + 1
+
+        if np.ndim(weight) == 0 and np.ndim(self.sum_weights) == 0:
+            if weight <= 0:
+                return
+            self.m4, self.m3, self.m2, self.mean_, self.sum_weights = self._add_terms(value, weight)
+            return
+
+        _valid = np.asarray(weight) > 0
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            _m4, _m3, _m2, _mean, _w = self._add_terms(value, weight)
+        self.m4 = np.where(_valid, _m4, self.m4)
+        self.m3 = np.where(_valid, _m3, self.m3)
+        self.m2 = np.where(_valid, _m2, self.m2)
+        self.mean_ = np.where(_valid, _mean, self.mean_)
+        self.sum_weights = np.where(_valid, _w, self.sum_weights)
+
+    def _add_terms(self, value, weight):
+        _w_a = self.sum_weights
+        _w = _w_a + weight
+        _delta = value - self.mean_
+        _delta_w = _delta / _w
+        _m4 = self.m4 + _delta * _delta_w ** 3 * _w_a * weight * (_w_a ** 2 - _w_a * weight + weight ** 2) + 6 * _delta_w ** 2 * weight ** 2 * self.m2 - 4 * _delta_w * weight * self.m3
+        _m3 = self.m3 + _delta * _delta_w ** 2 * _w_a * weight * (_w_a - weight) - 3 * _delta_w * weight * self.m2
+        _m2 = self.m2 + _delta * _delta_w * _w_a * weight
+        _mean = self.mean_ + _delta_w * weight
+
+        return (_m4, _m3, _m2, _mean, _w)
+
+    # 値の配列を追加する関数 (追加する値だけで集計器を作ってから合成する)
+    def update(self, values: np.ndarray = None, weights: np.ndarray = None, groups: np.ndarray = None, num_groups: int = None) -> None:
+        _other = WeightedMomentAccumulator.from_array(values, weights, groups, num_groups)
+        _merged = self.merge(_other)
+        self.count = _merged.count
+        self.sum_weights = _merged.sum_weights
+        self.mean_ = _merged.mean_
+        self.m2 = _merged.m2
+        self.m3 = _merged.m3
+        self.m4 = _merged.m4
+
+    # 2つの集計器を合成した新しい集計器を返す関数 (Pébayの式の加重版)
+    # 配列の場合は同じインデックスのグループどうしを合成する
+    def merge(self, other):
+        _w_a = self.sum_weights
+        _w_b = other.sum_weights
+        _w = _w_a + _w_b
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            _delta = np.where(_w_a * _w_b != 0, other.mean_ - self.mean_, 0.0)
+            _ratio_a = np.where(_w != 0, _w_a / _w, 0.0)
+            _ratio_b = np.where(_w != 0, _w_b / _w, 0.0)
+
+        _mean = np.where(_w_b == 0, self.mean_, np.where(_w_a == 0, other.mean_, self.mean_ + _delta * _ratio_b))
+        _m2 = self.m2 + other.m2 + _delta ** 2 * _w_a * _ratio_b
+        _m3 = self.m3 + other.m3 + _delta ** 3 * _w_a * _ratio_b * (_ratio_a - _ratio_b) + 3 * _delta * (_ratio_a * other.m2 - _ratio_b * self.m2)
+        _m4 = self.m4 + other.m4 + _delta ** 4 * _w_a * _ratio_b * (_ratio_a ** 2 - _ratio_a * _ratio_b + _ratio_b ** 2) + 6 * _delta ** 2 * (_ratio_a ** 2 * other.m2 + _ratio_b ** 2 * self.m2) + 4 * _delta * (_ratio_a * other.m3 - _ratio_b * self.m3)
+
+        return WeightedMomentAccumulator(self.count + other.count, _w, _mean, _m2, _m3, _m4)
+
+    # 配列の集計器で、隣り合うfactor個のグループをまとめて1つのグループにした集計器を返す関数
+    # 各グループの平均まわりのモーメントの和を、まとめた後の平均まわりに平行移動してから足し合わせる (多数のグループを一度に合成するPébayの式と同じ)
+    def rollup(self, factor: int = None):
+        assert factor is not None
+        assert np.size(self.sum_weights) % factor == 0
+
+        def _reshape(array):
+            return np.asarray(array).reshape(-1, factor)
+
+        _weights = _reshape(self.sum_weights)
+        _valid = _weights != 0
+        _means = np.where(_valid, _reshape(self.mean_), 0.0)
+        _m2 = np.where(_valid, _reshape(self.m2), 0.0)
+        _m3 = np.where(_valid, _reshape(self.m3), 0.0)
+        _m4 = np.where(_valid, _reshape(self.m4), 0.0)
+        _sum_weights = _weights.sum(axis = 1)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            _rollup_mean = (_weights * _means).sum(axis = 1) / _sum_weights
+        _rollup_mean = np.where(_sum_weights != 0, _rollup_mean, 0.0)
+        _delta = np.where(_valid, _means - _rollup_mean[:, np.newaxis], 0.0)
+        _rollup_m2 = (_m2 + _weights * _delta ** 2).sum(axis = 1)
+        _rollup_m3 = (_m3 + 3 * _delta * _m2 + _weights * _delta ** 3).sum(axis = 1)
+        _rollup_m4 = (_m4 + 4 * _delta * _m3 + 6 * _delta ** 2 * _m2 + _weights * _delta ** 4).sum(axis = 1)
+
+        return WeightedMomentAccumulator(_reshape(self.count).sum(axis = 1), _sum_weights, _rollup_mean, _rollup_m2, _rollup_m3, _rollup_m4)
+
+    # 加重平均 (重みの合計が0ならNaN)
+    @property
+    def mean(self):
+        return np.where(self.sum_weights != 0, self.mean_, np.nan)[()]
+
+    # 加重分散 (重みの合計が0ならNaN)
+    @property
+    def var(self):
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.where(self.sum_weights != 0, self.m2 / self.sum_weights, np.nan)[()]
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    # 加重歪度 (分散が0なら0、重みの合計が0ならNaN)
+    @property
+    def skew(self):
+        _var = self.var
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            _skew = np.where(_var > 0, self.m3 / self.sum_weights / np.sqrt(_var) ** 3, 0.0)
+        return np.where(np.isnan(_var), np.nan, _skew)[()]
+
+    # 加重尖度 (正規分布で0になるように3を引いた値。分散が0なら-3、重みの合計が0ならNaN)
+    @property
+    def kurt(self):
+        _var = self.var
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            _kurt = np.where(_var > 0, self.m4 / self.sum_weights / _var ** 2, 0.0) - 3
+        return np.where(np.isnan(_var), np.nan, _kurt)[()]
+
+    # n次のモーメント (1: 平均、2: 分散、3: 歪度、4: 尖度) を返す関数
+    def moment(self, n: int = None):
+        assert n in (1, 2, 3, 4)
+
+        return [self.mean, self.var, self.skew, self.kurt][n - 1]